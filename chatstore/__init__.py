@@ -0,0 +1,38 @@
+"""
+Account, mailbox, message history and attachment storage shared by the wire protocol and gRPC servers,
+and the account cache shared by their clients.
+"""
+from .base import ChatStore
+from .memory import MemoryChatStore
+from .journal import JournalChatStore
+from .sqlite_store import SQLiteChatStore
+from .history import HistoryStore
+from .attachments import AttachmentStore
+from .cache import AccountCache
+
+
+def open_store(spec: str = "memory") -> ChatStore:
+    """
+    Create a store from a short description, e.g. from a command line flag.
+
+    Parameters:
+    spec (str, optional): "memory", "journal:<path>" for a JournalChatStore or "sqlite:<path>"
+        for an SQLiteChatStore. Defaults to "memory".
+
+    Returns:
+    ChatStore: The store.
+
+    Raises:
+    ValueError: If the description is not understood.
+    """
+    kind, _, argument = spec.partition(":")
+    if kind == "memory":
+        return MemoryChatStore()
+    if kind == "journal" and argument:
+        return JournalChatStore(argument)
+    if kind == "sqlite" and argument:
+        return SQLiteChatStore(argument)
+    raise ValueError(f"Unknown store {spec!r}, expected 'memory', 'journal:<path>' or 'sqlite:<path>'")
+
+
+__all__ = ["ChatStore", "MemoryChatStore", "JournalChatStore", "SQLiteChatStore", "HistoryStore", "AttachmentStore", "AccountCache", "open_store"]
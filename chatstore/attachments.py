@@ -0,0 +1,112 @@
+import json
+import os
+import secrets
+
+
+class Upload:
+    """
+    An attachment being received, spooled to a temporary file chunk by chunk.
+
+    Attributes:
+        id (str): The attachment's id, once committed.
+        info (dict): The sender, receiver, file name and expected size.
+        size (int): The bytes written so far.
+        next_index (int): The chunk index expected next.
+    """
+    def __init__(self, store, id, info):
+        self.store = store
+        self.id = id
+        self.info = info
+        self.size = 0
+        self.next_index = 1
+        self.spool_path = os.path.join(store.spool, f"{id}.part")
+        self.file = open(self.spool_path, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        """
+        Make the attachment available for download.
+
+        Returns:
+        dict: The attachment's info, with its final size.
+        """
+        self.file.close()
+        self.info["size"] = self.size
+        with open(self.store.path(self.id) + ".json", "w") as f:
+            json.dump(self.info, f)
+        os.replace(self.spool_path, self.store.path(self.id))
+        return self.info
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.spool_path)
+        except FileNotFoundError:
+            pass
+
+
+class AttachmentStore:
+    """
+    Files sent between users, kept on disk so neither direction holds one in memory.
+
+    Uploads are written to a spool directory as their chunks arrive and moved
+    into place once complete, so a download never sees a partial file. Ids are
+    random, and only the sender and receiver of an attachment may read it.
+
+    Parameters:
+        directory (str): Where attachments are kept. Created if missing.
+        max_size (int, optional): The largest attachment accepted, in bytes. Defaults to 100 MiB.
+    """
+    def __init__(self, directory, max_size=100 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.spool = os.path.join(directory, "incoming")
+        os.makedirs(self.spool, exist_ok=True)
+        # Uploads cut short by a crash are never committed
+        for name in os.listdir(self.spool):
+            os.remove(os.path.join(self.spool, name))
+
+    def path(self, id):
+        return os.path.join(self.directory, id)
+
+    def begin(self, sender, receiver, filename, size):
+        """
+        Start receiving an attachment.
+
+        Parameters:
+        sender (str): Who is sending it.
+        receiver (str): Who it is for.
+        filename (str): The name to offer the receiver. Only the last path component is kept.
+        size (int): The size the sender announced.
+
+        Returns:
+        Upload: The upload to write the chunks to.
+
+        Raises:
+        ValueError: If the attachment is larger than max_size.
+        """
+        if size > self.max_size:
+            raise ValueError(f"Attachments are limited to {self.max_size} bytes")
+        info = {"sender": sender, "receiver": receiver, "filename": os.path.basename(filename) or "attachment", "size": size}
+        return Upload(self, secrets.token_hex(16), info)
+
+    def info(self, id, username):
+        """
+        Look up an attachment for a user who wants to download it.
+
+        Returns:
+        dict: The attachment's info, or None if it does not exist or is not the user's to read.
+        """
+        if not id or not all(c in "0123456789abcdef" for c in id):
+            return None
+        try:
+            with open(self.path(id) + ".json") as f:
+                info = json.load(f)
+        except FileNotFoundError:
+            return None
+        if username not in (info["sender"], info["receiver"]):
+            return None
+        return info
@@ -0,0 +1,172 @@
+import threading
+
+
+class ChatStore:
+    """
+    The accounts and undelivered messages of the chat service, independent of the protocol serving them.
+
+    Implementations must be thread-safe. Messages are (sender, text) pairs;
+    each frontend formats them for display. Frontends that push messages as
+    they arrive register a waiter callback per user, which is called after
+    every enqueue for that user and when the account is deleted.
+
+    Every account created or deleted bumps the registry version, and
+    registry listeners are told of the change with its version, in version
+    order, so frontends can keep clients' account caches up to date.
+
+    Parameters:
+        shards (int, optional): Lock shards for the waiter registry. Defaults to 64.
+    """
+    def __init__(self, shards: int = 64):
+        self.waiters = [{} for _ in range(shards)]
+        self.waiter_locks = [threading.Lock() for _ in range(shards)]
+        self.registry_version = 0
+        self.registry_lock = threading.Lock()
+        self.registry_listeners = []
+
+    def create_account(self, username: str) -> bool:
+        """
+        Returns:
+        bool: True if the account was created, False if it already existed.
+        """
+        raise NotImplementedError
+
+    def delete_account(self, username: str) -> bool:
+        """
+        Delete an account and its undelivered messages.
+
+        Returns:
+        bool: True if the account existed.
+        """
+        raise NotImplementedError
+
+    def exists(self, username: str) -> bool:
+        raise NotImplementedError
+
+    def __contains__(self, username: str) -> bool:
+        return self.exists(username)
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def __bool__(self) -> bool:
+        # A store is never falsy, however many accounts it holds
+        return True
+
+    def search(self, pattern: str, limit: int = None, after: str = "") -> "list[str]":
+        """
+        Find usernames matching a shell-style pattern, as understood by fnmatch.fnmatchcase.
+
+        Parameters:
+        pattern (str): The pattern, e.g. "bob*". Use glob.escape() to look for a literal substring.
+        limit (int, optional): The most names to return. Defaults to no limit.
+        after (str, optional): Only return names sorting after this one, for paging. Defaults to the start.
+
+        Returns:
+        list: Matching usernames in sorted order.
+        """
+        raise NotImplementedError
+
+    def enqueue(self, username: str, sender: str, text: str) -> bool:
+        """
+        Add a message to a user's mailbox and wake the user's waiters.
+
+        Returns:
+        bool: True if the message was queued, False if the user does not exist.
+        """
+        raise NotImplementedError
+
+    def drain(self, username: str) -> "list[tuple[str, str]]":
+        """
+        Take all of a user's undelivered messages, atomically with respect to enqueue.
+
+        Returns:
+        list: (sender, text) pairs, oldest first. Empty if there are none or the user does not exist.
+        """
+        raise NotImplementedError
+
+    def pending(self, username: str) -> "list[tuple[str, str]]":
+        """
+        Returns:
+        list: A copy of the user's undelivered messages, left in the mailbox.
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def snapshot(self):
+        """
+        The accounts and undelivered messages, for another process taking the server over to restore.
+
+        Returns:
+        dict: The mailbox of each account, or None for stores the other process reopens from disk.
+        """
+        return None
+
+    def restore(self, snapshot) -> None:
+        """
+        Load what snapshot() returned in another process. The registry version is left to the caller.
+        """
+        pass
+
+    def prewarm(self) -> None:
+        """
+        Load into memory whatever the first requests would otherwise wait on the disk for.
+        Stores that keep everything in memory have nothing to do.
+        """
+        pass
+
+    def add_registry_listener(self, callback) -> None:
+        """
+        Register a callback to run as callback(version, created, username) for every account
+        created or deleted. It runs under the registry lock, so it must not block.
+        """
+        with self.registry_lock:
+            self.registry_listeners.append(callback)
+
+    def remove_registry_listener(self, callback) -> None:
+        with self.registry_lock:
+            if callback in self.registry_listeners:
+                self.registry_listeners.remove(callback)
+
+    def registry_changed(self, created: bool, username: str) -> None:
+        """
+        Bump the registry version and tell the registry listeners. Implementations call this
+        after every create and delete, ordered with any other change to the same account.
+        """
+        with self.registry_lock:
+            self.registry_version += 1
+            for callback in self.registry_listeners:
+                callback(self.registry_version, created, username)
+
+    def _waiter_shard(self, username: str):
+        index = hash(username) % len(self.waiters)
+        return self.waiters[index], self.waiter_locks[index]
+
+    def add_waiter(self, username: str, callback) -> None:
+        """
+        Register a callback to run when a message is queued for `username` or the account is deleted.
+        """
+        waiters, lock = self._waiter_shard(username)
+        with lock:
+            waiters.setdefault(username, []).append(callback)
+
+    def remove_waiter(self, username: str, callback) -> None:
+        waiters, lock = self._waiter_shard(username)
+        with lock:
+            callbacks = waiters.get(username, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+                if not callbacks:
+                    del waiters[username]
+
+    def notify(self, username: str) -> None:
+        """
+        Run the user's waiter callbacks, outside the registry lock.
+        """
+        waiters, lock = self._waiter_shard(username)
+        with lock:
+            callbacks = list(waiters.get(username, ()))
+        for callback in callbacks:
+            callback()
@@ -0,0 +1,163 @@
+import bisect
+import collections
+import fnmatch
+import threading
+
+
+class AccountCache:
+    """
+    A client's cache of which accounts exist and of account search results, kept current by the server.
+
+    The server numbers every account created or deleted with a registry
+    version, and pushes each change to clients watching the registry. Changes
+    are applied to the cache in place: a new account is added to every cached
+    result whose pattern it matches, a deleted one is removed. A result is only
+    cached if it is at least as new as the changes already applied, and a change
+    the cache has already seen is skipped, so results and changes can arrive in
+    any order. A server restart shows as a new epoch and empties the cache.
+
+    The cache is only used while `live`, i.e. between the answer to a watch
+    request and the loss of the connection that carries the changes.
+
+    All methods are thread-safe.
+
+    Parameters:
+        max_names (int, optional): Usernames whose existence is remembered. Defaults to 10000.
+        max_queries (int, optional): Search results remembered. Defaults to 256.
+    """
+    def __init__(self, max_names=10000, max_queries=256):
+        self.max_names = max_names
+        self.max_queries = max_queries
+        self.lock = threading.Lock()
+        self.live = False
+        self.epoch = None
+        self.version = 0
+        # Both least recently used first
+        self.names = collections.OrderedDict()
+        self.queries = collections.OrderedDict()
+
+    def watching(self, epoch, version):
+        """
+        Start using the cache, once the server has answered a watch request.
+
+        Parameters:
+        epoch (str): The server's epoch, which changes when it restarts.
+        version (int): The registry version when the watch started.
+        """
+        with self.lock:
+            if epoch != self.epoch:
+                self._reset(epoch)
+            self.version = max(self.version, version)
+            self.live = True
+
+    def stop(self):
+        """
+        Stop using the cache, e.g. when the connection is lost and changes may be missed.
+        """
+        with self.lock:
+            self.live = False
+            self._reset(None)
+
+    def _reset(self, epoch):
+        self.epoch = epoch
+        self.version = 0
+        self.names.clear()
+        self.queries.clear()
+
+    def exists(self, username):
+        """
+        Returns:
+        bool: Whether the account exists, or None if the cache does not know.
+        """
+        with self.lock:
+            if not self.live:
+                return None
+            exists = self.names.get(username)
+            if exists is not None:
+                self.names.move_to_end(username)
+            return exists
+
+    def search(self, pattern):
+        """
+        Returns:
+        list: The cached result of a search for `pattern`, or None if there is none.
+        """
+        with self.lock:
+            if not self.live:
+                return None
+            names = self.queries.get(pattern)
+            if names is None:
+                return None
+            self.queries.move_to_end(pattern)
+            return list(names)
+
+    def put_search(self, pattern, names, epoch, version):
+        """
+        Cache the result of a search, unless a change since has already been applied.
+
+        Parameters:
+        pattern (str): The shell-style pattern searched for.
+        names (list): The matching usernames, sorted.
+        epoch (str): The server's epoch when it answered.
+        version (int): The registry version the server answered at.
+        """
+        with self.lock:
+            if not self.live or epoch != self.epoch or version < self.version:
+                return
+            self.queries[pattern] = list(names)
+            self.queries.move_to_end(pattern)
+            if len(self.queries) > self.max_queries:
+                self.queries.popitem(last=False)
+            for name in names:
+                self._remember(name, True)
+            if not has_magic(pattern):
+                # A pattern without wildcards names one account, which the result shows exists or not
+                self._remember(pattern, bool(names))
+
+    def _remember(self, username, exists):
+        self.names[username] = exists
+        self.names.move_to_end(username)
+        if len(self.names) > self.max_names:
+            self.names.popitem(last=False)
+
+    def apply(self, epoch, changes):
+        """
+        Apply account changes pushed by the server.
+
+        Parameters:
+        epoch (str): The server's epoch.
+        changes (list): (version, created, username) triples, oldest first.
+        """
+        with self.lock:
+            if epoch != self.epoch:
+                self._reset(epoch)
+            for version, created, username in changes:
+                if version <= self.version:
+                    continue
+                self.version = version
+                self._update(created, username)
+
+    def note(self, created, username):
+        """
+        Apply a change this client made itself, so it reads its own writes before the push arrives.
+        Applying the same change again when it is pushed does nothing.
+        """
+        with self.lock:
+            self._update(created, username)
+
+    def _update(self, created, username):
+        if username in self.names:
+            self.names[username] = created
+        for pattern, names in self.queries.items():
+            if not fnmatch.fnmatchcase(username, pattern):
+                continue
+            i = bisect.bisect_left(names, username)
+            present = i < len(names) and names[i] == username
+            if created and not present:
+                names.insert(i, username)
+            elif not created and present:
+                del names[i]
+
+
+def has_magic(pattern):
+    return any(c in pattern for c in "*?[")
@@ -0,0 +1,409 @@
+import bisect
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+
+from .index import MessageIndex
+
+# Keep an index entry for every this many records of a segment
+INDEX_EVERY = 64
+
+
+def parse_page_token(token):
+    """
+    Split a range() page token into its segment id and offset.
+
+    Raises:
+    ValueError: If the token is malformed or negative.
+    """
+    segment, _, offset = token.partition(":")
+    segment, offset = int(segment), int(offset)
+    if segment < 0 or offset < 0:
+        raise ValueError(f"Invalid page token {token!r}")
+    return segment, offset
+
+
+def check_record_boundary(f, offset, size):
+    """
+    Raises:
+    ValueError: If `offset` is not where a record of the open segment file starts.
+    """
+    if offset >= size:
+        raise ValueError(f"Page token offset {offset} is past the end of the segment")
+    if offset:
+        f.seek(offset - 1)
+        if f.read(1) != b"\n":
+            raise ValueError(f"Page token offset {offset} is not at a record")
+
+
+class Segment:
+    """
+    One file of a conversation's history: records in time order, one JSON line each.
+
+    Attributes:
+        id (int): The segment's number within the conversation, increasing with time.
+        path (str): The file.
+        first_ts (float): The timestamp of the first record.
+        last_ts (float): The timestamp of the last record.
+        count (int): The number of records.
+        size (int): The file size in bytes.
+        index (list): (timestamp, offset) of every INDEX_EVERY-th record, for seeking by time.
+        users (tuple): The two users of the conversation.
+        expired (bool): Whether retention has deleted the file.
+    """
+    def __init__(self, id, path, users):
+        self.id = id
+        self.path = path
+        self.users = users
+        self.expired = False
+        self.first_ts = None
+        self.last_ts = None
+        self.count = 0
+        self.size = 0
+        self.index = []
+
+    def track(self, ts, length):
+        """
+        Account for a record of `length` bytes appended at the end of the file.
+        """
+        if self.count % INDEX_EVERY == 0:
+            self.index.append((ts, self.size))
+        if self.first_ts is None:
+            self.first_ts = ts
+        self.last_ts = ts
+        self.count += 1
+        self.size += length
+
+    def seek_offset(self, ts):
+        """
+        Returns:
+        int: An offset at or before the first record at or after `ts`.
+        """
+        i = bisect.bisect_left(self.index, (ts,)) - 1
+        return self.index[max(i, 0)][1] if self.index else 0
+
+
+class Conversation:
+    """
+    The history of the messages between two users, as a list of segments.
+    """
+    def __init__(self, directory, users):
+        self.directory = directory
+        self.users = users
+        self.lock = threading.Lock()
+        self.segments = []
+        self.file = None
+        # Segment ids are never reused, so page tokens stay valid across expiry
+        self.next_id = 0
+
+    def load(self, on_record):
+        """
+        Read the conversation's segments back, calling on_record(segment, offset, record) for each record.
+        """
+        names = [name for name in os.listdir(self.directory) if name.endswith(".seg")]
+        for name in sorted(names, key=lambda n: int(n.split(".")[0])):
+            segment = Segment(int(name.split(".")[0]), os.path.join(self.directory, name), self.users)
+            with open(segment.path, "r+b") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Cut short by a crash, drop the partial record before appending after it
+                        f.truncate(segment.size)
+                        break
+                    record = json.loads(line)
+                    on_record(segment, segment.size, record)
+                    segment.track(record[0], len(line))
+            self.next_id = segment.id + 1
+            if segment.count:
+                self.segments.append(segment)
+
+    def append(self, record, segment_records, segment_span):
+        """
+        Write a record at the end of the newest segment, starting a new one when it is full.
+        Must be called with the conversation's lock held.
+
+        Returns:
+        tuple: The segment and the offset the record was written at.
+        """
+        ts = record[0]
+        current = self.segments[-1] if self.segments else None
+        if current is None or current.count >= segment_records or ts - current.first_ts >= segment_span:
+            if self.file:
+                self.file.close()
+            current = Segment(self.next_id, os.path.join(self.directory, f"{self.next_id}.seg"), self.users)
+            self.next_id += 1
+            self.segments.append(current)
+            self.file = None
+        if self.file is None:
+            self.file = open(current.path, "ab")
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        offset = current.size
+        self.file.write(line)
+        self.file.flush()
+        current.track(ts, len(line))
+        return current, offset
+
+
+class HistoryStore:
+    """
+    A durable, time-ordered log of every message, kept per conversation.
+
+    Each conversation is a directory of segment files. Records are appended in
+    time order, and each segment keeps a sparse in-memory index of timestamps
+    to file offsets, so a time range is read with one seek per segment plus a
+    short scan. Retention is per segment: a background thread deletes whole
+    segments once their newest message is older than the TTL, so old history
+    is dropped without rewriting anything.
+
+    Every message also gets an id, in the order messages are recorded, and is
+    filed in a MessageIndex under both of its users, so a user can search
+    their messages by word. An id maps to the segment and offset of its record,
+    which costs 16 bytes a message in memory.
+
+    Unlike a mailbox, reading history does not consume it.
+
+    Parameters:
+        directory (str): Where the history is kept. Created if missing.
+        ttl (float, optional): Seconds messages are kept. Defaults to forever.
+        segment_records (int, optional): Records per segment file. Defaults to 4096.
+        segment_span (float, optional): Seconds of history per segment file; also the granularity
+            of the TTL. Defaults to 3600.
+        compact_interval (float, optional): Seconds between retention passes. Defaults to 60.
+    """
+    def __init__(self, directory, ttl=None, segment_records=4096, segment_span=3600.0, compact_interval=60.0):
+        self.directory = directory
+        self.ttl = ttl
+        self.segment_records = segment_records
+        self.segment_span = segment_span
+        self.lock = threading.Lock()
+        self.conversations = {}
+        self.closed = threading.Event()
+        # Message ids below base_id have expired; id i's record is at
+        # message_offsets[i - base_id] in message_segments[i - base_id]
+        self.ids_lock = threading.Lock()
+        self.base_id = 0
+        self.message_segments = []
+        self.message_offsets = array("Q")
+        self.index = MessageIndex()
+        os.makedirs(directory, exist_ok=True)
+
+        records = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            with open(os.path.join(path, "users")) as f:
+                conversation = Conversation(path, tuple(json.load(f)))
+            conversation.load(lambda segment, offset, record: records.append((record[0], segment, offset, record[2])))
+            self.conversations[name] = conversation
+        # Conversations are each in time order, ids must be in time order across them
+        records.sort(key=lambda record: record[0])
+        for _, segment, offset, text in records:
+            self._assign_id(segment, offset, text)
+        if ttl is not None:
+            self.compactor = threading.Thread(target=self._compact_loop, args=(compact_interval,), daemon=True)
+            self.compactor.start()
+
+    @staticmethod
+    def conversation_key(a, b):
+        """
+        Returns:
+        str: A file name safe key for the conversation between two users, whichever sent the message.
+        """
+        first, second = sorted((a, b))
+        return hashlib.sha1(f"{first}\0{second}".encode("utf-8")).hexdigest()
+
+    def _conversation(self, a, b, create=False):
+        key = self.conversation_key(a, b)
+        with self.lock:
+            conversation = self.conversations.get(key)
+            if conversation is None and create:
+                conversation = Conversation(os.path.join(self.directory, key), tuple(sorted((a, b))))
+                os.makedirs(conversation.directory, exist_ok=True)
+                with open(os.path.join(conversation.directory, "users"), "w") as f:
+                    json.dump(conversation.users, f)
+                self.conversations[key] = conversation
+            return conversation
+
+    def _assign_id(self, segment, offset, text):
+        with self.ids_lock:
+            message_id = self.base_id + len(self.message_segments)
+            self.message_segments.append(segment)
+            self.message_offsets.append(offset)
+            # Under the same lock, so posting lists stay in id order
+            self.index.add(message_id, set(segment.users), text)
+
+    def append(self, sender, receiver, text, timestamp=None):
+        """
+        Record a message.
+
+        Parameters:
+        sender (str): Who sent it.
+        receiver (str): Who it was sent to.
+        text (str): The message.
+        timestamp (float, optional): When it was sent, as a Unix time. Defaults to now.
+
+        Returns:
+        float: The timestamp recorded. Never earlier than the conversation's previous message,
+            so a conversation stays in time order even if the clock steps back.
+        """
+        conversation = self._conversation(sender, receiver, create=True)
+        with conversation.lock:
+            ts = time.time() if timestamp is None else timestamp
+            if conversation.segments and conversation.segments[-1].last_ts > ts:
+                ts = conversation.segments[-1].last_ts
+            segment, offset = conversation.append((ts, sender, text), self.segment_records, self.segment_span)
+        self._assign_id(segment, offset, text)
+        return ts
+
+    def range(self, a, b, start=0.0, end=float("inf"), limit=100, page_token=""):
+        """
+        Read a conversation between two timestamps, oldest first.
+
+        Parameters:
+        a (str): One user of the conversation.
+        b (str): The other user.
+        start (float, optional): The earliest timestamp, inclusive. Defaults to the beginning.
+        end (float, optional): The latest timestamp, exclusive. Defaults to no limit.
+        limit (int, optional): The most messages to return. Defaults to 100.
+        page_token (str, optional): The token returned with the previous page. Defaults to the first page.
+
+        Returns:
+        tuple: A list of (timestamp, sender, text) and the token for the next page, empty on the last page.
+
+        Raises:
+        ValueError: If the page token is not one handed out for this conversation.
+        """
+        conversation = self._conversation(a, b)
+        if conversation is None:
+            return [], ""
+        with conversation.lock:
+            segments = list(conversation.segments)
+        cursor_segment, cursor_offset = -1, 0
+        if page_token:
+            cursor_segment, cursor_offset = parse_page_token(page_token)
+
+        results = []
+        for segment in segments:
+            if segment.id < cursor_segment or segment.last_ts < start:
+                continue
+            if segment.first_ts >= end:
+                break
+            offset = cursor_offset if segment.id == cursor_segment else segment.seek_offset(start)
+            # Only read what was complete when we looked, a writer may be appending
+            stop = segment.size
+            try:
+                f = open(segment.path, "rb")
+            except FileNotFoundError:
+                # Expired while we were reading
+                continue
+            with f:
+                if segment.id == cursor_segment:
+                    check_record_boundary(f, offset, stop)
+                f.seek(offset)
+                while offset < stop:
+                    line = f.readline()
+                    ts, sender, text = json.loads(line)
+                    if ts >= end:
+                        return results, ""
+                    if ts >= start:
+                        if len(results) == limit:
+                            return results, f"{segment.id}:{offset}"
+                        results.append((ts, sender, text))
+                    offset += len(line)
+        return results, ""
+
+    def compact(self, now=None):
+        """
+        Delete every segment whose newest message is older than the TTL.
+
+        Returns:
+        int: The number of segments deleted.
+        """
+        if self.ttl is None:
+            return 0
+        cutoff = (time.time() if now is None else now) - self.ttl
+        with self.lock:
+            conversations = list(self.conversations.values())
+        removed = 0
+        for conversation in conversations:
+            with conversation.lock:
+                expired = [s for s in conversation.segments if s.last_ts < cutoff]
+                for segment in expired:
+                    if segment is conversation.segments[-1] and conversation.file:
+                        conversation.file.close()
+                        conversation.file = None
+                    os.remove(segment.path)
+                    segment.expired = True
+                    conversation.segments.remove(segment)
+                removed += len(expired)
+        if removed:
+            with self.ids_lock:
+                # Ids are in time order, so most expired messages are a prefix
+                cut = 0
+                while cut < len(self.message_segments) and self.message_segments[cut].expired:
+                    cut += 1
+                del self.message_segments[:cut]
+                del self.message_offsets[:cut]
+                self.base_id += cut
+            self.index.discard_below(self.base_id)
+            logging.info(f"[HISTORY] Dropped {removed} expired segments")
+        return removed
+
+    def search(self, username, query, limit=20, page_token=""):
+        """
+        Find a user's messages, sent or received, that contain every word of `query`.
+
+        Parameters:
+        username (str): Whose messages to search.
+        query (str): The words to look for, in any order and case.
+        limit (int, optional): The most messages to return. Defaults to 20.
+        page_token (str, optional): The token returned with the previous page. Defaults to the first page.
+
+        Returns:
+        tuple: A list of (timestamp, sender, receiver, text), newest first, and the token for the
+            next page, empty on the last page.
+        """
+        before = int(page_token) if page_token else None
+        results = []
+        while len(results) < limit:
+            wanted = limit - len(results)
+            ids = self.index.search(username, query, wanted, before)
+            for message_id in ids:
+                with self.ids_lock:
+                    i = message_id - self.base_id
+                    if i < 0:
+                        continue
+                    segment, offset = self.message_segments[i], self.message_offsets[i]
+                # Expired messages after the prefix cut are only skipped here
+                if segment.expired:
+                    continue
+                try:
+                    with open(segment.path, "rb") as f:
+                        f.seek(offset)
+                        ts, sender, text = json.loads(f.readline())
+                except FileNotFoundError:
+                    continue
+                receiver = segment.users[1] if sender == segment.users[0] else segment.users[0]
+                results.append((ts, sender, receiver, text))
+            if len(ids) < wanted:
+                return results, ""
+            before = ids[-1]
+        return results, str(before)
+
+    def _compact_loop(self, interval):
+        while not self.closed.wait(interval):
+            try:
+                self.compact()
+            except OSError as e:
+                logging.error(f"[HISTORY] Compaction failed: {e}")
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            for conversation in self.conversations.values():
+                with conversation.lock:
+                    if conversation.file:
+                        conversation.file.close()
+                        conversation.file = None
@@ -0,0 +1,215 @@
+import bisect
+import fnmatch
+import re
+import threading
+from array import array
+
+N = 3
+WORD = re.compile(r"\w+")
+
+
+def ngrams(text: str) -> "set[str]":
+    return {text[i:i + N] for i in range(len(text) - N + 1)}
+
+
+def tokenize(text: str) -> "set[str]":
+    """
+    Returns:
+    set: The distinct lowercased words of `text`.
+    """
+    return set(WORD.findall(text.lower()))
+
+
+def literal_runs(pattern: str) -> "tuple[list[str], str]":
+    """
+    Split a shell-style pattern into the literal text every match must contain.
+
+    Single-character classes such as "[*]", which glob.escape() produces, count
+    as literal characters; any other wildcard ends a run.
+
+    Returns:
+    tuple: The literal runs, and the literal prefix every match starts with ("" if none).
+    """
+    runs, run, prefix, i = [], "", None, 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c in "*?":
+            literal = None
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end == -1:
+                # fnmatch treats an unclosed bracket as a literal
+                literal = c
+            else:
+                members = pattern[i + 1:end]
+                literal = members if len(members) == 1 and members not in "!^" else None
+                i = end
+        else:
+            literal = c
+        if literal is None:
+            if prefix is None:
+                prefix = run
+            runs.append(run)
+            run = ""
+        else:
+            run += literal
+        i += 1
+    runs.append(run)
+    if prefix is None:
+        # No wildcards at all: the whole pattern is literal
+        prefix = run
+    return [r for r in runs if r], prefix
+
+
+class PatternIndex:
+    """
+    A username index for shell-style pattern search, updated as accounts come and go.
+
+    Each username is filed under every trigram it contains. A pattern with
+    literal runs of three or more characters only has to check the names
+    sharing all of their trigrams, instead of every account; a pattern with a
+    literal prefix only has to check the names in that prefix's range of the
+    sorted name list. Other patterns fall back to a scan, which stops as soon
+    as `limit` names are found. Results come back in username order, so a page
+    can be resumed from the last name of the previous one.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.names = []
+
+    def add(self, username: str) -> None:
+        with self.lock:
+            i = bisect.bisect_left(self.names, username)
+            if i < len(self.names) and self.names[i] == username:
+                return
+            self.names.insert(i, username)
+            for gram in ngrams(username):
+                self.postings.setdefault(gram, set()).add(username)
+
+    def remove(self, username: str) -> None:
+        with self.lock:
+            i = bisect.bisect_left(self.names, username)
+            if i == len(self.names) or self.names[i] != username:
+                return
+            del self.names[i]
+            for gram in ngrams(username):
+                names = self.postings[gram]
+                names.discard(username)
+                if not names:
+                    del self.postings[gram]
+
+    def search(self, pattern: str, limit: int = None, after: str = "") -> "list[str]":
+        """
+        Find usernames matching `pattern`. See ChatStore.search.
+        """
+        runs, prefix = literal_runs(pattern)
+        grams = set().union(*(ngrams(run) for run in runs))
+        match = re.compile(fnmatch.translate(pattern)).match
+        with self.lock:
+            if grams:
+                postings = sorted((self.postings.get(g, ()) for g in grams), key=len)
+                if not postings[0]:
+                    return []
+                candidates = sorted(set(postings[0]).intersection(*postings[1:]))
+            else:
+                candidates = self.names
+            start = bisect.bisect_left(candidates, max(prefix, after))
+            results = []
+            for i in range(start, len(candidates)):
+                name = candidates[i]
+                if not name.startswith(prefix):
+                    # Sorted, so nothing further on shares the prefix
+                    break
+                if name == after:
+                    continue
+                # Sharing every trigram does not guarantee a match
+                if match(name):
+                    results.append(name)
+                    if limit is not None and len(results) == limit:
+                        break
+            return results
+
+
+class MessageIndex:
+    """
+    A per-user inverted index from words to the ids of the messages containing them.
+
+    Message ids must be added in increasing order, which makes every posting
+    list a sorted array('Q') of 8 bytes an entry and puts the newest messages
+    at the end. A search walks the shortest posting list of the query's words
+    from the end and checks each id against the others by binary search, so it
+    costs time proportional to the matches found rather than to how many
+    messages the user has, and stops once `limit` matches are found.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # username -> word -> ids
+        self.postings = {}
+
+    def add(self, message_id: int, usernames, text: str) -> None:
+        """
+        File a message under each of its words for each user who can see it.
+        """
+        words = tokenize(text)
+        with self.lock:
+            for username in usernames:
+                postings = self.postings.setdefault(username, {})
+                for word in words:
+                    ids = postings.get(word)
+                    if ids is None:
+                        ids = postings[word] = array("Q")
+                    ids.append(message_id)
+
+    def search(self, username: str, query: str, limit: int = 20, before: int = None) -> "list[int]":
+        """
+        Find the messages a user can see that contain every word of `query`.
+
+        Parameters:
+        username (str): Whose messages to search.
+        query (str): The words to look for, in any order and case.
+        limit (int, optional): The most ids to return. Defaults to 20.
+        before (int, optional): Only return ids below this one, to resume from the last id
+            of the previous page. Defaults to no bound.
+
+        Returns:
+        list: The matching message ids, newest first.
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+        with self.lock:
+            postings = self.postings.get(username, {})
+            lists = sorted((postings.get(word) for word in words), key=lambda ids: len(ids) if ids else 0)
+            if not lists[0]:
+                return []
+            shortest, others = lists[0], lists[1:]
+            end = len(shortest) if before is None else bisect.bisect_left(shortest, before)
+            results = []
+            for i in range(end - 1, -1, -1):
+                message_id = shortest[i]
+                for ids in others:
+                    j = bisect.bisect_left(ids, message_id)
+                    if j == len(ids) or ids[j] != message_id:
+                        break
+                else:
+                    results.append(message_id)
+                    if len(results) == limit:
+                        break
+            return results
+
+    def discard_below(self, message_id: int) -> None:
+        """
+        Drop every id below `message_id`, e.g. once those messages have expired.
+        """
+        with self.lock:
+            for postings in self.postings.values():
+                for word in list(postings):
+                    ids = postings[word]
+                    cut = bisect.bisect_left(ids, message_id)
+                    if cut == len(ids):
+                        del postings[word]
+                    elif cut:
+                        del ids[:cut]
+            for username in [u for u, postings in self.postings.items() if not postings]:
+                del self.postings[username]
@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import threading
+
+from .memory import MemoryChatStore
+
+
+class JournalChatStore(MemoryChatStore):
+    """
+    A MemoryChatStore that survives restarts by logging every change to an append-only journal.
+
+    Each change is one JSON line, written and flushed before the call returns,
+    and the journal is replayed into memory on startup. Reads are served from
+    memory. Once the journal holds many more records than there is live data,
+    it is rewritten as a snapshot of the current state.
+
+    Parameters:
+        path (str): The journal file. Created if missing.
+        fsync (bool, optional): fsync after every change, so it survives a power failure,
+            not just a crash of the process. Defaults to False.
+        compact_min_records (int, optional): Never compact a journal shorter than this. Defaults to 10000.
+        shards (int, optional): See MemoryChatStore.
+    """
+    def __init__(self, path: str, fsync: bool = False, compact_min_records: int = 10000, shards: int = 64):
+        super().__init__(shards)
+        self.path = path
+        self.fsync = fsync
+        self.compact_min_records = compact_min_records
+        # Orders journal records the same way as the changes they describe
+        self.journal_lock = threading.Lock()
+        self.records = self._replay()
+        self.journal = open(path, "a", encoding="utf-8")
+
+    def _replay(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        apply = {
+            "create": lambda args: MemoryChatStore.create_account(self, *args),
+            "delete": lambda args: self._remove(*args),
+            "enqueue": lambda args: self._append(*args),
+            "drain": lambda args: MemoryChatStore.drain(self, *args),
+        }
+        records = 0
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    op, *args = json.loads(line)
+                except ValueError:
+                    # A record cut short by a crash; everything before it is intact
+                    logging.warning(f"[JOURNAL] Ignoring a torn record at the end of {self.path}")
+                    break
+                apply[op](args)
+                records += 1
+        logging.info(f"[JOURNAL] Replayed {records} records, {len(self)} accounts")
+        return records
+
+    def _log(self, *record) -> None:
+        """
+        Append a record. Must be called with journal_lock held.
+        """
+        self.journal.write(json.dumps(record) + "\n")
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+        self.records += 1
+        if self.records >= self.compact_min_records and self.records > 2 * self._live_records():
+            self._compact()
+
+    def _live_records(self) -> int:
+        return sum(len(shard) + sum(map(len, shard.values())) for shard in self.shards)
+
+    def _compact(self) -> None:
+        """
+        Rewrite the journal as the records needed to rebuild the current state.
+        Must be called with journal_lock held, which keeps every writer out.
+        """
+        tmp = f"{self.path}.tmp"
+        records = 0
+        with open(tmp, "w", encoding="utf-8") as f:
+            for shard in self.shards:
+                for username, mailbox in list(shard.items()):
+                    f.write(json.dumps(("create", username)) + "\n")
+                    for sender, text in mailbox:
+                        f.write(json.dumps(("enqueue", username, sender, text)) + "\n")
+                    records += 1 + len(mailbox)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal.close()
+        os.replace(tmp, self.path)
+        self.journal = open(self.path, "a", encoding="utf-8")
+        logging.info(f"[JOURNAL] Compacted {self.records} records into {records}")
+        self.records = records
+
+    def create_account(self, username: str) -> bool:
+        with self.journal_lock:
+            created = super().create_account(username)
+            if created:
+                self._log("create", username)
+        return created
+
+    def delete_account(self, username: str) -> bool:
+        with self.journal_lock:
+            deleted = self._remove(username)
+            if deleted:
+                self._log("delete", username)
+        # Waiters are woken once the lock is released, as they may call back into the store
+        if deleted:
+            self.notify(username)
+        return deleted
+
+    def enqueue(self, username: str, sender: str, text: str) -> bool:
+        with self.journal_lock:
+            queued = self._append(username, sender, text)
+            if queued:
+                self._log("enqueue", username, sender, text)
+        if queued:
+            self.notify(username)
+        return queued
+
+    def drain(self, username: str) -> "list[tuple[str, str]]":
+        with self.journal_lock:
+            messages = super().drain(username)
+            if messages:
+                self._log("drain", username)
+        return messages
+
+    def snapshot(self):
+        # Everything is in the journal, which the other process replays
+        return None
+
+    def restore(self, snapshot) -> None:
+        pass
+
+    def close(self) -> None:
+        with self.journal_lock:
+            self.journal.close()
@@ -0,0 +1,113 @@
+import threading
+
+from .base import ChatStore
+from .index import PatternIndex
+
+
+class MemoryChatStore(ChatStore):
+    """
+    A ChatStore held in memory.
+
+    Accounts are spread over shards by hash, each with its own lock, so requests
+    for different users rarely wait on each other. Every operation holds a
+    single shard lock, which also makes `drain` atomic with respect to
+    concurrent enqueues: the mailbox list is swapped for a new one, so draining
+    is O(1) under the lock. Membership checks are a single dict lookup.
+
+    Parameters:
+        shards (int, optional): The number of shards. Defaults to 64.
+    """
+    def __init__(self, shards: int = 64):
+        super().__init__(shards)
+        self.shards = [{} for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.index = PatternIndex()
+
+    def _shard(self, username: str):
+        index = hash(username) % len(self.shards)
+        return self.shards[index], self.locks[index]
+
+    def exists(self, username: str) -> bool:
+        shard, _ = self._shard(username)
+        # A single dict lookup is atomic, no lock needed
+        return username in shard
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def create_account(self, username: str) -> bool:
+        shard, lock = self._shard(username)
+        with lock:
+            if username in shard:
+                return False
+            shard[username] = []
+            self.index.add(username)
+            self.registry_changed(True, username)
+            return True
+
+    def delete_account(self, username: str) -> bool:
+        if not self._remove(username):
+            return False
+        self.notify(username)
+        return True
+
+    def _remove(self, username: str) -> bool:
+        """
+        Delete an account without waking its waiters, for subclasses that wake them once their own locks are released.
+        """
+        shard, lock = self._shard(username)
+        with lock:
+            if shard.pop(username, None) is None:
+                return False
+            self.index.remove(username)
+            self.registry_changed(False, username)
+        return True
+
+    def search(self, pattern: str, limit: int = None, after: str = "") -> "list[str]":
+        return self.index.search(pattern, limit, after)
+
+    def enqueue(self, username: str, sender: str, text: str) -> bool:
+        if not self._append(username, sender, text):
+            return False
+        self.notify(username)
+        return True
+
+    def _append(self, username: str, sender: str, text: str) -> bool:
+        """
+        Queue a message without waking the user's waiters, see _remove.
+        """
+        shard, lock = self._shard(username)
+        with lock:
+            mailbox = shard.get(username)
+            if mailbox is None:
+                return False
+            mailbox.append((sender, text))
+        return True
+
+    def drain(self, username: str) -> "list[tuple[str, str]]":
+        shard, lock = self._shard(username)
+        with lock:
+            mailbox = shard.get(username)
+            if not mailbox:
+                return []
+            shard[username] = []
+            return mailbox
+
+    def pending(self, username: str) -> "list[tuple[str, str]]":
+        shard, lock = self._shard(username)
+        with lock:
+            return list(shard.get(username, ()))
+
+    def snapshot(self) -> dict:
+        accounts = {}
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                accounts.update((username, list(mailbox)) for username, mailbox in shard.items())
+        return accounts
+
+    def restore(self, snapshot: dict) -> None:
+        for username, mailbox in snapshot.items():
+            shard, lock = self._shard(username)
+            with lock:
+                shard[username] = [tuple(message) for message in mailbox]
+            self.index.add(username)
@@ -0,0 +1,258 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from .base import ChatStore
+from .index import PatternIndex
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    username TEXT PRIMARY KEY
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_username ON messages (username, id);
+"""
+
+# Statements are compiled once per connection and reused from sqlite3's statement cache
+CREATE_ACCOUNT = "INSERT OR IGNORE INTO accounts (username) VALUES (?)"
+DELETE_ACCOUNT = "DELETE FROM accounts WHERE username = ?"
+DELETE_MAILBOX = "DELETE FROM messages WHERE username = ?"
+ENQUEUE = "INSERT INTO messages (username, sender, text) SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM accounts WHERE username = ?)"
+SELECT_MAILBOX = "SELECT sender, text FROM messages WHERE username = ? ORDER BY id"
+ACCOUNT_EXISTS = "SELECT 1 FROM accounts WHERE username = ?"
+COUNT_ACCOUNTS = "SELECT COUNT(*) FROM accounts"
+ALL_ACCOUNTS = "SELECT username FROM accounts"
+# Read every page of the mailboxes and of their index
+SCAN_MESSAGES = "SELECT SUM(LENGTH(sender) + LENGTH(text)) FROM messages"
+SCAN_MESSAGE_INDEX = "SELECT COUNT(*) FROM messages INDEXED BY messages_by_username WHERE username >= ''"
+
+
+class SQLiteChatStore(ChatStore):
+    """
+    A ChatStore kept in an SQLite database in WAL mode.
+
+    All writes go through one writer thread, which commits everything queued
+    while the previous commit was in progress as a single transaction, so many
+    concurrent writers share the cost of each commit. Each write runs in a
+    savepoint, so one that fails is undone alone and the rest of its batch
+    commits. A write call returns once its transaction has committed; waiters are called after the commit, on a
+    notifier thread, so they may write to the store themselves. Reads use one connection per
+    thread; in WAL mode they never block on, or are blocked by, the writer.
+    Pattern search is answered from an in-memory index of the usernames,
+    loaded at startup and updated on commit.
+
+    Parameters:
+        path (str): The database file. Created if missing.
+        commit_interval (float, optional): Extra seconds to wait for more writes before committing a batch.
+            Only worth setting with synchronous="FULL" on slow disks, where fewer, larger commits pay off.
+            Defaults to 0.
+        max_batch (int, optional): Commit early once this many writes are waiting. Defaults to 10000.
+        synchronous (str, optional): SQLite's synchronous setting. NORMAL survives a crash of the
+            process; FULL also survives a power failure, at the cost of an fsync per commit. Defaults to "NORMAL".
+    """
+    def __init__(self, path: str, commit_interval: float = 0.0, max_batch: int = 10000, synchronous: str = "NORMAL"):
+        super().__init__()
+        self.path = path
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.synchronous = synchronous
+        self.writes = queue.Queue()
+        self.local = threading.local()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+
+        self.writer = self._connect()
+        self.writer.executescript(SCHEMA)
+        self.index = PatternIndex()
+        for (username,) in self.writer.execute(ALL_ACCOUNTS):
+            self.index.add(username)
+        logging.info(f"[SQLITE] Opened {path} with {len(self.index.names)} accounts")
+
+        self.writer_thread = threading.Thread(target=self._write_loop, name="sqlite-writer", daemon=True)
+        self.writer_thread.start()
+        # Waiters run on their own thread: they may write themselves, e.g. drain the mailbox,
+        # which would deadlock the writer waiting on its own queue
+        self.notifications = queue.Queue()
+        self.notifier_thread = threading.Thread(target=self._notify_loop, name="sqlite-notifier", daemon=True)
+        self.notifier_thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        return conn
+
+    def _reader(self):
+        """
+        Returns:
+        sqlite3.Connection: This thread's read connection, opened on first use.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute("PRAGMA query_only=ON")
+            self.local.conn = conn
+            with self.readers_lock:
+                self.readers.append(conn)
+        return conn
+
+    def _write(self, op, *args):
+        """
+        Hand a write to the writer thread and wait for it to commit.
+
+        Returns:
+        The result of the write's method on the writer thread.
+        """
+        future = Future()
+        self.writes.put((op, args, future))
+        return future.result()
+
+    def _write_loop(self):
+        while True:
+            first = self.writes.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self.writes.get(timeout=remaining) if remaining > 0 else self.writes.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Commit what we have, then stop
+                    self.writes.put(None)
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _notify_loop(self):
+        while True:
+            username = self.notifications.get()
+            if username is None:
+                return
+            try:
+                self.notify(username)
+            except Exception as e:
+                logging.exception(e)
+
+    def _commit(self, batch):
+        outcomes, after_commit = [], []
+        try:
+            self.writer.execute("BEGIN")
+            for op, args, future in batch:
+                # Each write has a savepoint of its own, so one that fails is undone without
+                # failing the rest of the batch
+                callbacks = []
+                self.writer.execute("SAVEPOINT write")
+                try:
+                    result = op(*args, callbacks)
+                except Exception as e:
+                    self.writer.execute("ROLLBACK TO write")
+                    self.writer.execute("RELEASE write")
+                    outcomes.append((False, e))
+                    continue
+                self.writer.execute("RELEASE write")
+                after_commit.extend(callbacks)
+                outcomes.append((True, result))
+            self.writer.execute("COMMIT")
+        except Exception as e:
+            # Anything escaping here would end the writer thread and leave every writer waiting forever
+            logging.error(f"[SQLITE] Rolling back a batch of {len(batch)} writes: {e!r}")
+            if self.writer.in_transaction:
+                self.writer.execute("ROLLBACK")
+            for op, args, future in batch:
+                future.set_exception(e)
+            return
+        for callback in after_commit:
+            try:
+                callback()
+            except Exception as e:
+                logging.exception(e)
+        for (op, args, future), (ok, outcome) in zip(batch, outcomes):
+            if ok:
+                future.set_result(outcome)
+            else:
+                future.set_exception(outcome)
+
+    # Run on the writer thread, inside the batch's transaction. `after_commit`
+    # collects the side effects that must wait until the data is durable.
+
+    def _create_account(self, username, after_commit):
+        if self.writer.execute(CREATE_ACCOUNT, (username,)).rowcount == 0:
+            return False
+        after_commit.append(lambda: self.index.add(username))
+        after_commit.append(lambda: self.registry_changed(True, username))
+        return True
+
+    def _delete_account(self, username, after_commit):
+        if self.writer.execute(DELETE_ACCOUNT, (username,)).rowcount == 0:
+            return False
+        self.writer.execute(DELETE_MAILBOX, (username,))
+        after_commit.append(lambda: self.index.remove(username))
+        after_commit.append(lambda: self.registry_changed(False, username))
+        after_commit.append(lambda: self.notifications.put(username))
+        return True
+
+    def _enqueue(self, username, sender, text, after_commit):
+        if self.writer.execute(ENQUEUE, (username, sender, text, username)).rowcount == 0:
+            return False
+        after_commit.append(lambda: self.notifications.put(username))
+        return True
+
+    def _drain(self, username, after_commit):
+        messages = self.writer.execute(SELECT_MAILBOX, (username,)).fetchall()
+        if messages:
+            self.writer.execute(DELETE_MAILBOX, (username,))
+        return messages
+
+    def create_account(self, username: str) -> bool:
+        return self._write(self._create_account, username)
+
+    def delete_account(self, username: str) -> bool:
+        return self._write(self._delete_account, username)
+
+    def enqueue(self, username: str, sender: str, text: str) -> bool:
+        return self._write(self._enqueue, username, sender, text)
+
+    def drain(self, username: str) -> "list[tuple[str, str]]":
+        # A drain deletes, so it is ordered with the enqueues by the writer
+        return self._write(self._drain, username)
+
+    def exists(self, username: str) -> bool:
+        return self._reader().execute(ACCOUNT_EXISTS, (username,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self._reader().execute(COUNT_ACCOUNTS).fetchone()[0]
+
+    def pending(self, username: str) -> "list[tuple[str, str]]":
+        return self._reader().execute(SELECT_MAILBOX, (username,)).fetchall()
+
+    def search(self, pattern: str, limit: int = None, after: str = "") -> "list[str]":
+        return self.index.search(pattern, limit, after)
+
+    def prewarm(self) -> None:
+        # Pulls the database into the OS page cache, so the first drains are not served from disk
+        reader = self._reader()
+        reader.execute(SCAN_MESSAGES).fetchone()
+        reader.execute(SCAN_MESSAGE_INDEX).fetchone()
+
+    def close(self) -> None:
+        self.writes.put(None)
+        self.writer_thread.join()
+        self.notifications.put(None)
+        self.notifier_thread.join()
+        self.writer.close()
+        with self.readers_lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers.clear()
@@ -13,7 +13,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rchatapp.proto\"+\n\x07Request\x12\x0e\n\x06\x61\x63tion\x18\x01 \x01(\t\x12\x10\n\x08username\x18\x02 \x01(\t\"9\n\x07Message\x12\x0e\n\x06sender\x18\x01 \x01(\t\x12\x10\n\x08receiver\x18\x02 \x01(\t\x12\x0c\n\x04text\x18\x03 \x01(\t\"\x14\n\x04User\x12\x0c\n\x04text\x18\x01 \x01(\t\".\n\nPendingRes\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\x0f\n\x07isEmpty\x18\x02 \x01(\x08\x32h\n\x0b\x43hatService\x12\x19\n\x04\x43hat\x12\x08.Message\x1a\x05.User\"\x00\x12\x1b\n\x06Packet\x12\x08.Request\x1a\x05.User\"\x00\x12!\n\x06Listen\x12\x08.Request\x1a\x0b.PendingRes\"\x00\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rchatapp.proto\"+\n\x07Request\x12\x0e\n\x06\x61\x63tion\x18\x01 \x01(\t\x12\x10\n\x08username\x18\x02 \x01(\t\"9\n\x07Message\x12\x0e\n\x06sender\x18\x01 \x01(\t\x12\x10\n\x08receiver\x18\x02 \x01(\t\x12\x0c\n\x04text\x18\x03 \x01(\t\"\x14\n\x04User\x12\x0c\n\x04text\x18\x01 \x01(\t\".\n\nPendingRes\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\x0f\n\x07isEmpty\x18\x02 \x01(\x08\"E\n\rSearchRequest\x12\r\n\x05query\x18\x01 \x01(\t\x12\x11\n\tpage_size\x18\x02 \x01(\x05\x12\x12\n\npage_token\x18\x03 \x01(\t\"n\n\x0eSearchResponse\x12\x11\n\tusernames\x18\x01 \x03(\t\x12\x17\n\x0fnext_page_token\x18\x02 \x01(\t\x12\x16\n\x0eregistry_epoch\x18\x03 \x01(\t\x12\x18\n\x10registry_version\x18\x04 \x01(\x03\"5\n\nSendStatus\x12\r\n\x05index\x18\x01 \x01(\x05\x12\n\n\x02ok\x18\x02 \x01(\x08\x12\x0c\n\x04text\x18\x03 \x01(\t\"?\n\x10SendManyResponse\x12\x1d\n\x08statuses\x18\x01 \x03(\x0b\x32\x0b.SendStatus\x12\x0c\n\x04sent\x18\x02 \x01(\x05\"S\n\rStreamRequest\x12\x1d\n\tsubscribe\x18\x01 \x01(\x0b\x32\x08.RequestH\x00\x12\x1b\n\x07message\x18\x02 \x01(\x0b\x32\x08.MessageH\x00\x42\x06\n\x04kind\"X\n\x0eStreamResponse\x12\x1f\n\x08\x64\x65livery\x18\x01 \x01(\x0b\x32\x0b.PendingResH\x00\x12\x1d\n\x06status\x18\x02 \x01(\x0b\x32\x0b.SendStatusH\x00\x42\x06\n\x04kind\"s\n\x0eHistoryRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x0c\n\x04peer\x18\x02 \x01(\t\x12\r\n\x05start\x18\x03 \x01(\x01\x12\x0b\n\x03\x65nd\x18\x04 \x01(\x01\x12\x11\n\tpage_size\x18\x05 \x01(\x05\x12\x12\n\npage_token\x18\x06 \x01(\t\"?\n\x0cHistoryEntry\x12\x11\n\ttimestamp\x18\x01 \x01(\x01\x12\x0e\n\x06sender\x18\x02 \x01(\t\x12\x0c\n\x04text\x18\x03 \x01(\t\"J\n\x0fHistoryResponse\x12\x1e\n\x07\x65ntries\x18\x01 \x03(\x0b\x32\r.HistoryEntry\x12\x17\n\x0fnext_page_token\x18\x02 \x01(\t\"\x16\n\x14WatchAccountsRequest\"Q\n\x0c\x41\x63\x63ountEvent\x12\r\n\x05\x65poch\x18\x01 \x01(\t\x12\x0f\n\x07version\x18\x02 \x01(\x03\x12\x10\n\x08username\x18\x03 \x01(\t\x12\x0f\n\x07\x63reated\x18\x04 \x01(\x08\x32\x8a\x03\n\x0b\x43hatService\x12\x19\n\x04\x43hat\x12\x08.Message\x1a\x05.User\"\x00\x12\x1b\n\x06Packet\x12\x08.Request\x1a\x05.User\"\x00\x12!\n\x06Listen\x12\x08.Request\x1a\x0b.PendingRes\"\x00\x12&\n\tSubscribe\x12\x08.Request\x1a\x0b.PendingRes\"\x00\x30\x01\x12+\n\x06Search\x12\x0e.SearchRequest\x1a\x0f.SearchResponse\"\x00\x12+\n\x08SendMany\x12\x08.Message\x1a\x11.SendManyResponse\"\x00(\x01\x12\x33\n\nChatStream\x12\x0e.StreamRequest\x1a\x0f.StreamResponse\"\x00(\x01\x30\x01\x12.\n\x07History\x12\x0f.HistoryRequest\x1a\x10.HistoryResponse\"\x00\x12\x39\n\rWatchAccounts\x12\x15.WatchAccountsRequest\x1a\r.AccountEvent\"\x00\x30\x01\x62\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'chatapp_pb2', globals())
@@ -28,6 +28,28 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   _USER._serialized_end=141
   _PENDINGRES._serialized_start=143
   _PENDINGRES._serialized_end=189
-  _CHATSERVICE._serialized_start=191
-  _CHATSERVICE._serialized_end=295
+  _SEARCHREQUEST._serialized_start=191
+  _SEARCHREQUEST._serialized_end=260
+  _SEARCHRESPONSE._serialized_start=262
+  _SEARCHRESPONSE._serialized_end=372
+  _SENDSTATUS._serialized_start=374
+  _SENDSTATUS._serialized_end=427
+  _SENDMANYRESPONSE._serialized_start=429
+  _SENDMANYRESPONSE._serialized_end=492
+  _STREAMREQUEST._serialized_start=494
+  _STREAMREQUEST._serialized_end=577
+  _STREAMRESPONSE._serialized_start=579
+  _STREAMRESPONSE._serialized_end=667
+  _HISTORYREQUEST._serialized_start=669
+  _HISTORYREQUEST._serialized_end=784
+  _HISTORYENTRY._serialized_start=786
+  _HISTORYENTRY._serialized_end=849
+  _HISTORYRESPONSE._serialized_start=851
+  _HISTORYRESPONSE._serialized_end=925
+  _WATCHACCOUNTSREQUEST._serialized_start=927
+  _WATCHACCOUNTSREQUEST._serialized_end=949
+  _ACCOUNTEVENT._serialized_start=951
+  _ACCOUNTEVENT._serialized_end=1032
+  _CHATSERVICE._serialized_start=1035
+  _CHATSERVICE._serialized_end=1429
 # @@protoc_insertion_point(module_scope)
@@ -30,6 +30,36 @@ class ChatServiceStub(object):
                 request_serializer=chatapp__pb2.Request.SerializeToString,
                 response_deserializer=chatapp__pb2.PendingRes.FromString,
                 )
+        self.Subscribe = channel.unary_stream(
+                '/ChatService/Subscribe',
+                request_serializer=chatapp__pb2.Request.SerializeToString,
+                response_deserializer=chatapp__pb2.PendingRes.FromString,
+                )
+        self.Search = channel.unary_unary(
+                '/ChatService/Search',
+                request_serializer=chatapp__pb2.SearchRequest.SerializeToString,
+                response_deserializer=chatapp__pb2.SearchResponse.FromString,
+                )
+        self.SendMany = channel.stream_unary(
+                '/ChatService/SendMany',
+                request_serializer=chatapp__pb2.Message.SerializeToString,
+                response_deserializer=chatapp__pb2.SendManyResponse.FromString,
+                )
+        self.ChatStream = channel.stream_stream(
+                '/ChatService/ChatStream',
+                request_serializer=chatapp__pb2.StreamRequest.SerializeToString,
+                response_deserializer=chatapp__pb2.StreamResponse.FromString,
+                )
+        self.History = channel.unary_unary(
+                '/ChatService/History',
+                request_serializer=chatapp__pb2.HistoryRequest.SerializeToString,
+                response_deserializer=chatapp__pb2.HistoryResponse.FromString,
+                )
+        self.WatchAccounts = channel.unary_stream(
+                '/ChatService/WatchAccounts',
+                request_serializer=chatapp__pb2.WatchAccountsRequest.SerializeToString,
+                response_deserializer=chatapp__pb2.AccountEvent.FromString,
+                )
 
 
 class ChatServiceServicer(object):
@@ -54,6 +84,42 @@ class ChatServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def Subscribe(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Search(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def SendMany(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def ChatStream(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def History(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def WatchAccounts(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ChatServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -72,6 +138,36 @@ def add_ChatServiceServicer_to_server(servicer, server):
                     request_deserializer=chatapp__pb2.Request.FromString,
                     response_serializer=chatapp__pb2.PendingRes.SerializeToString,
             ),
+            'Subscribe': grpc.unary_stream_rpc_method_handler(
+                    servicer.Subscribe,
+                    request_deserializer=chatapp__pb2.Request.FromString,
+                    response_serializer=chatapp__pb2.PendingRes.SerializeToString,
+            ),
+            'Search': grpc.unary_unary_rpc_method_handler(
+                    servicer.Search,
+                    request_deserializer=chatapp__pb2.SearchRequest.FromString,
+                    response_serializer=chatapp__pb2.SearchResponse.SerializeToString,
+            ),
+            'SendMany': grpc.stream_unary_rpc_method_handler(
+                    servicer.SendMany,
+                    request_deserializer=chatapp__pb2.Message.FromString,
+                    response_serializer=chatapp__pb2.SendManyResponse.SerializeToString,
+            ),
+            'ChatStream': grpc.stream_stream_rpc_method_handler(
+                    servicer.ChatStream,
+                    request_deserializer=chatapp__pb2.StreamRequest.FromString,
+                    response_serializer=chatapp__pb2.StreamResponse.SerializeToString,
+            ),
+            'History': grpc.unary_unary_rpc_method_handler(
+                    servicer.History,
+                    request_deserializer=chatapp__pb2.HistoryRequest.FromString,
+                    response_serializer=chatapp__pb2.HistoryResponse.SerializeToString,
+            ),
+            'WatchAccounts': grpc.unary_stream_rpc_method_handler(
+                    servicer.WatchAccounts,
+                    request_deserializer=chatapp__pb2.WatchAccountsRequest.FromString,
+                    response_serializer=chatapp__pb2.AccountEvent.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'ChatService', rpc_method_handlers)
@@ -133,3 +229,105 @@ class ChatService(object):
             chatapp__pb2.PendingRes.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def Subscribe(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/ChatService/Subscribe',
+            chatapp__pb2.Request.SerializeToString,
+            chatapp__pb2.PendingRes.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def Search(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/ChatService/Search',
+            chatapp__pb2.SearchRequest.SerializeToString,
+            chatapp__pb2.SearchResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def SendMany(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(request_iterator, target, '/ChatService/SendMany',
+            chatapp__pb2.Message.SerializeToString,
+            chatapp__pb2.SendManyResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def ChatStream(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(request_iterator, target, '/ChatService/ChatStream',
+            chatapp__pb2.StreamRequest.SerializeToString,
+            chatapp__pb2.StreamResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def History(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/ChatService/History',
+            chatapp__pb2.HistoryRequest.SerializeToString,
+            chatapp__pb2.HistoryResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def WatchAccounts(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/ChatService/WatchAccounts',
+            chatapp__pb2.WatchAccountsRequest.SerializeToString,
+            chatapp__pb2.AccountEvent.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
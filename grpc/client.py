@@ -1,8 +1,20 @@
+import argparse
+import functools
+import glob
+import os
+import socket
+import sys
 import threading
-import grpc
 import time
 
-import chatapp_pb2, chatapp_pb2_grpc
+import grpc
+
+# The account cache lives in the repository root, shared with the wire protocol client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import chatapp_pb2
+import options
+from chatstore import AccountCache
 
 
 def get_username() -> str:
@@ -21,22 +33,65 @@ def join_chat(username: str, stub) -> str:
 
 def listen_to_pending_messages(username: str, stub) -> None:
     try:
-        while True:
-            time.sleep(1)
-            response = stub.Listen(
-                chatapp_pb2.Request(username=username)
-            )
-            if not response.isEmpty:
-                print(response.message)
+        # The server pushes messages down the stream as soon as they are sent
+        for response in stub.Subscribe(chatapp_pb2.Request(username=username)):
+            print(response.message)
     except:
         print("Closing the application.")
 
 
-def list_command(username: str, stub, command: list) -> None:
+def watch_accounts(stub, accounts: AccountCache) -> None:
+    """
+    Keep `accounts` up to date with the account changes the server streams, until the stream ends.
+    """
+    try:
+        for event in stub.WatchAccounts(chatapp_pb2.WatchAccountsRequest()):
+            if not event.username:
+                accounts.watching(event.epoch, event.version)
+            else:
+                accounts.apply(event.epoch, [(event.version, event.created, event.username)])
+    except grpc.RpcError:
+        pass
+    finally:
+        # Changes made from now on would be missed
+        accounts.stop()
+
+
+def list_command(username: str, stub, command: list, accounts: AccountCache = None) -> None:
     if len(command) == 1:
         command.append("")
-    response = stub.Packet(chatapp_pb2.Request(action=command[0], username=command[1]))
-    print(response.text, flush=True)
+    if accounts is not None:
+        list_cached(stub, command[1], accounts)
+        return
+    page_token = ""
+    while True:
+        response = stub.Search(
+            chatapp_pb2.SearchRequest(query=command[1], page_token=page_token)
+        )
+        if response.usernames:
+            print(", ".join(response.usernames), flush=True)
+        page_token = response.next_page_token
+        if not page_token:
+            break
+
+
+def list_cached(stub, query: str, accounts: AccountCache) -> None:
+    # Cached under the pattern search_users looks for, which account changes are matched against
+    pattern = f"*{glob.escape(query)}*"
+    names = accounts.search(pattern)
+    if names is None:
+        names, page_token, stamp = [], "", None
+        while True:
+            response = stub.Search(chatapp_pb2.SearchRequest(query=query, page_token=page_token))
+            names.extend(response.usernames)
+            # The first page is the oldest, so the whole result reflects at least its version
+            stamp = stamp or (response.registry_epoch, response.registry_version)
+            page_token = response.next_page_token
+            if not page_token:
+                break
+        accounts.put_search(pattern, names, *stamp)
+    if names:
+        print(", ".join(names), flush=True)
 
 
 def send_command(username: str, stub, command: list) -> None:
@@ -63,7 +118,48 @@ def send_command(username: str, stub, command: list) -> None:
     )
 
 
-def delete_command(username: str, stub, command: list) -> None:
+def broadcast_command(username: str, stub, command: list) -> None:
+    if len(command) < 2:
+        print("Please specify the users to send the message to.", flush=True)
+        return
+    print(f"What message would you like to send to {', '.join(command[1:])}?")
+
+    while True:
+        message = input(">>> ")
+        if not message:
+            continue
+        break
+
+    # One streaming call for all recipients instead of a Chat call each
+    response = stub.SendMany(
+        chatapp_pb2.Message(sender=username, receiver=receiver, text=message)
+        for receiver in command[1:]
+    )
+    for status in response.statuses:
+        if not status.ok:
+            print(status.text, flush=True)
+    print(f"Sent to {response.sent} of {len(command) - 1} users.", flush=True)
+
+
+def history_command(username: str, stub, command: list) -> None:
+    if len(command) < 2:
+        print("Please specify the user whose conversation to show.", flush=True)
+        return
+    peer = " ".join(command[1:])
+    page_token = ""
+    while True:
+        response = stub.History(
+            chatapp_pb2.HistoryRequest(username=username, peer=peer, page_token=page_token)
+        )
+        for entry in response.entries:
+            sent = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry.timestamp))
+            print(f"[{sent}] {entry.sender}: {entry.text}", flush=True)
+        page_token = response.next_page_token
+        if not page_token or input("Show more? (y/n) ").lower() != "y":
+            break
+
+
+def delete_command(username: str, stub, command: list, accounts: AccountCache = None) -> None:
     if len(command) != 2:
         print(
             "Couldn't find the user - check the spelling and try again.",
@@ -77,6 +173,8 @@ def delete_command(username: str, stub, command: list) -> None:
         chatapp_pb2.Request(action=command[0], username=" ".join(command[1:]))
     )
     print(response.text, flush=True)
+    if accounts is not None and response.text == "User deleted successfully.":
+        accounts.note(False, " ".join(command[1:]))
 
 
 def quit_command(username: str, stub, command: list) -> str:
@@ -84,10 +182,12 @@ def quit_command(username: str, stub, command: list) -> str:
     return response.text
 
 
-def main(host="10.250.103.17", port=3000):
+def main(host=None, port=3000, config=None):
+    # The server listens on this machine's address by default
+    host = host or socket.gethostbyname(socket.gethostname())
     print(f"Connecting to server at {host}:{port}...")
-    with grpc.insecure_channel(f"{host}:{port}") as channel:
-        stub = chatapp_pb2_grpc.ChatServiceStub(channel)
+    with options.ChannelPool(f"{host}:{port}", config) as pool:
+        stub = pool.stub
         print(
             "Type username to login or create acc",
             flush=True,
@@ -99,14 +199,19 @@ def main(host="10.250.103.17", port=3000):
             target=listen_to_pending_messages, args=(username, stub)
         )
         listen_thread.start()
+        # Repeated lists are answered locally while the server streams account changes
+        accounts = AccountCache()
+        threading.Thread(target=watch_accounts, args=(stub, accounts), daemon=True).start()
         commands = {
-            "list": list_command,
+            "list": functools.partial(list_command, accounts=accounts),
             "send": send_command,
-            "delete": delete_command,
+            "broadcast": broadcast_command,
+            "history": history_command,
+            "delete": functools.partial(delete_command, accounts=accounts),
             "logout": quit_command,
         }
         print(
-            "\n\033[1mActions:\033[0m\n\033[32m  list <wildcard, optional>\033[0m\n\033[34m  send <user>\033[0m\n\033[31m  delete <user>\033[0m\n\033[33m  logout\033[0m\n",
+            "\n\033[1mActions:\033[0m\n\033[32m  list <wildcard, optional>\033[0m\n\033[34m  send <user>\033[0m\n\033[34m  broadcast <user> <user> ...\033[0m\n\033[32m  history <user>\033[0m\n\033[31m  delete <user>\033[0m\n\033[33m  logout\033[0m\n",
             flush=True,
         )
         try:
@@ -125,4 +230,10 @@ def main(host="10.250.103.17", port=3000):
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="gRPC chat client")
+    parser.add_argument("--host", default=os.environ.get("CHAT_GRPC_HOST"),
+                        help="the server's address. Defaults to $CHAT_GRPC_HOST, or else this machine's address")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("CHAT_GRPC_PORT", 3000)))
+    options.add_arguments(parser)
+    args = parser.parse_args()
+    main(args.host, args.port, options.config_from_args(args))
@@ -0,0 +1,155 @@
+import itertools
+import json
+import threading
+
+import grpc
+
+import chatapp_pb2_grpc
+
+COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "deflate": grpc.Compression.Deflate,
+    "gzip": grpc.Compression.Gzip,
+}
+
+DEFAULTS = {
+    # Compression of everything this side sends: none, deflate or gzip
+    "compression": "none",
+    # Message size limits in bytes, -1 for unlimited. gRPC's own default is 4 MiB inbound.
+    "max_send_message_length": -1,
+    "max_receive_message_length": 4 * 1024 * 1024,
+    # HTTP/2 pings on idle connections, so dead peers (e.g. a subscriber
+    # behind a NAT that dropped the flow) are noticed
+    "keepalive_time_ms": 30000,
+    "keepalive_timeout_ms": 10000,
+    "keepalive_permit_without_calls": True,
+    # Server only: the shortest ping interval clients are allowed
+    "min_ping_interval_ms": 10000,
+    # Client only: HTTP/2 connections to spread calls over
+    "channels": 1,
+    # Any other channel arguments, passed through as-is, e.g. {"grpc.http2.max_frame_size": 65536}
+    "channel_args": {},
+}
+
+
+def load_config(path: str = None, **overrides) -> dict:
+    """
+    Build the gRPC options from the defaults, an optional JSON config file and overrides.
+
+    Parameters:
+    path (str, optional): A JSON file with any of the keys of DEFAULTS.
+    **overrides: Settings that take precedence over the file, e.g. from the command line. None values are ignored.
+
+    Returns:
+    dict: The complete configuration.
+
+    Raises:
+    ValueError: If the file or an override has an unknown key or compression name.
+    """
+    config = dict(DEFAULTS)
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    unknown = set(config) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown gRPC options: {', '.join(sorted(unknown))}")
+    if config["compression"] not in COMPRESSION:
+        raise ValueError(f"Unknown compression {config['compression']!r}, expected one of {', '.join(COMPRESSION)}")
+    return config
+
+
+def add_arguments(parser) -> None:
+    """
+    Add command line flags for the most common settings to an argparse parser.
+    """
+    parser.add_argument("--grpc-config", help="JSON file with gRPC channel options")
+    parser.add_argument("--compression", choices=list(COMPRESSION))
+    parser.add_argument("--max-send-message-length", type=int)
+    parser.add_argument("--max-receive-message-length", type=int)
+    parser.add_argument("--keepalive-time-ms", type=int)
+    parser.add_argument("--keepalive-timeout-ms", type=int)
+    parser.add_argument("--channels", type=int, help="client connections to round-robin over")
+
+
+def config_from_args(args) -> dict:
+    return load_config(
+        args.grpc_config,
+        compression=args.compression,
+        max_send_message_length=args.max_send_message_length,
+        max_receive_message_length=args.max_receive_message_length,
+        keepalive_time_ms=args.keepalive_time_ms,
+        keepalive_timeout_ms=args.keepalive_timeout_ms,
+        channels=args.channels,
+    )
+
+
+def channel_options(config: dict, server: bool = False) -> list:
+    """
+    Returns:
+    list: (key, value) channel arguments for grpc.server() or grpc.insecure_channel().
+    """
+    options = [
+        ("grpc.max_send_message_length", config["max_send_message_length"]),
+        ("grpc.max_receive_message_length", config["max_receive_message_length"]),
+        ("grpc.keepalive_time_ms", config["keepalive_time_ms"]),
+        ("grpc.keepalive_timeout_ms", config["keepalive_timeout_ms"]),
+        ("grpc.keepalive_permit_without_calls", int(config["keepalive_permit_without_calls"])),
+    ]
+    if server:
+        options += [
+            ("grpc.http2.min_ping_interval_without_data_ms", config["min_ping_interval_ms"]),
+            ("grpc.http2.max_pings_without_data", 0),
+        ]
+    options += list(config["channel_args"].items())
+    return options
+
+
+def compression(config: dict):
+    return COMPRESSION[config["compression"]]
+
+
+class PooledStub:
+    """
+    A ChatServiceStub lookalike that sends each call over the next channel of a pool.
+    """
+    def __init__(self, stubs):
+        self.stubs = itertools.cycle(stubs)
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        with self.lock:
+            stub = next(self.stubs)
+        return getattr(stub, name)
+
+
+class ChannelPool:
+    """
+    Several independent HTTP/2 connections to one server, used round-robin.
+
+    One connection serializes its streams through a single TCP flow, which limits
+    throughput on long, lossy links. Each channel of the pool gets its own
+    subchannel pool, otherwise gRPC would reuse one connection for all of them.
+
+    Parameters:
+        target (str): The server address, as host:port.
+        config (dict, optional): Settings from load_config(). Defaults to DEFAULTS.
+    """
+    def __init__(self, target: str, config: dict = None):
+        config = config or load_config()
+        options = channel_options(config) + [("grpc.use_local_subchannel_pool", 1)]
+        self.channels = [
+            grpc.insecure_channel(target, options=options, compression=compression(config))
+            for _ in range(max(1, config["channels"]))
+        ]
+        self.stub = PooledStub([chatapp_pb2_grpc.ChatServiceStub(c) for c in self.channels])
+
+    def close(self) -> None:
+        for channel in self.channels:
+            channel.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
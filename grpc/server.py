@@ -1,49 +1,110 @@
+import argparse
+import asyncio
+import glob
+import os
+import queue
+import secrets
 import socket
+import sys
+import threading
 from concurrent import futures
-from collections import defaultdict
 import grpc
 
+# The storage engine lives in the repository root, shared with the wire protocol server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
 import chatapp_pb2, chatapp_pb2_grpc
+from chatstore import ChatStore, HistoryStore, MemoryChatStore, open_store
+import options
+
+store = MemoryChatStore()
+# Set by use_history, messages are only recorded when there is one
+history = None
+# Identifies this run of the server, as registry versions start over when it restarts
+registry_epoch = secrets.token_hex(8)
+# Set by join_cluster. Accounts then change on other nodes too, so they cannot be watched
+clustered = False
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MESSAGE_SENT = "Message sent successfully."
+# Messages an asyncio SendMany hands to the executor at a time
+SEND_BATCH_SIZE = 256
+
+
+def use_store(new_store: ChatStore) -> None:
+    """
+    Serve from `new_store` instead of the default in-memory store, e.g. one shared with a wire protocol server.
+    """
+    global store
+    store = new_store
+
 
-users = defaultdict(list)
+def use_history(new_history: HistoryStore) -> None:
+    """
+    Record every message sent in `new_history` and serve History from it.
+    """
+    global history
+    history = new_history
+
+
+def format_message(sender: str, text: str) -> str:
+    return f"{sender} says: {text}"
 
 
 def get_pending_messages(username: str) -> "list[str]":
-    if not (username in users):
-        return []
-    return users[username]
+    return [format_message(sender, text) for sender, text in store.pending(username)]
 
 
 def clear_pending_messages(username: str) -> None:
-    if username in users:
-        users[username] = []
+    store.drain(username)
 
 
 def return_pending_messages(username: str) -> "list[str]":
-    if username in users:
-        messages = get_pending_messages(username)
-        clear_pending_messages(username)
-        return messages
-    return []
+    return [format_message(sender, text) for sender, text in store.drain(username)]
 
 
 def delete_user(username: str) -> None:
-    if username in users:
-        del users[username]
-        return True
-    return False
+    return store.delete_account(username)
+
+
+def add_waiter(username: str, callback) -> None:
+    store.add_waiter(username, callback)
+
+
+def remove_waiter(username: str, callback) -> None:
+    store.remove_waiter(username, callback)
 
 
 def command_join(username):
-    return (
-        "User created successfully. Welcome!"
-        if not users.setdefault(username, [])
-        else "Welcome back!"
-    )
+    if store.create_account(username):
+        return "User created successfully. Welcome!"
+    return "Welcome back!"
+
+
+def search_users(query: str, page_size: int = 0, page_token: str = "") -> "tuple[list[str], str]":
+    """
+    Find one page of usernames containing `query`, in sorted order.
+
+    Parameters:
+    query (str): The substring to look for.
+    page_size (int, optional): Names per page, capped at MAX_PAGE_SIZE. Defaults to DEFAULT_PAGE_SIZE.
+    page_token (str, optional): The next_page_token of the previous page. Defaults to the first page.
+
+    Returns:
+    tuple: The usernames and the token for the next page, empty on the last page.
+    """
+    page_size = min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    # One extra name tells us whether there is another page
+    names = store.search(f"*{glob.escape(query)}*", page_size + 1, page_token)
+    if len(names) > page_size:
+        names = names[:page_size]
+        return names, names[-1]
+    return names, ""
 
 
 def command_list(wildcard: str = "") -> str:
-    return ", ".join([k for k in users.keys() if wildcard in k])
+    return ", ".join(store.search(f"*{glob.escape(wildcard)}*"))
 
 
 def command_delete(username):
@@ -53,11 +114,59 @@ def command_delete(username):
 
 
 def send(sender, receiver, message):
-    message = f"{sender} says: {message}"
-    if receiver not in users:
+    # Waking the receiver's Subscribe streams is done by the store
+    if not store.enqueue(receiver, sender, message):
         return f"The recipient '{receiver}' does not exist."
-    users[receiver].append(message)
-    return "Message sent successfully."
+    if history:
+        history.append(sender, receiver, message)
+    return MESSAGE_SENT
+
+
+def read_history(request) -> "chatapp_pb2.HistoryResponse":
+    """
+    Read one page of the conversation between two users.
+
+    Parameters:
+    request (chatapp_pb2.HistoryRequest): The users, the time range, where end 0 means no limit,
+        and the page to read.
+
+    Returns:
+    chatapp_pb2.HistoryResponse: The messages, oldest first, and the token for the next page.
+
+    Raises:
+    ValueError: If the page token is not one we handed out.
+    """
+    if not history:
+        return chatapp_pb2.HistoryResponse()
+    page_size = min(request.page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    entries, next_page_token = history.range(
+        request.username, request.peer, request.start, request.end or float("inf"), page_size, request.page_token
+    )
+    return chatapp_pb2.HistoryResponse(
+        entries=[chatapp_pb2.HistoryEntry(timestamp=ts, sender=sender, text=text) for ts, sender, text in entries],
+        next_page_token=next_page_token,
+    )
+
+
+def send_status(index: int, message) -> "chatapp_pb2.SendStatus":
+    """
+    Send one message of a stream and report how it went.
+
+    Parameters:
+    index (int): The position of the message in its stream.
+    message (chatapp_pb2.Message): The message to send.
+
+    Returns:
+    chatapp_pb2.SendStatus: Whether the message was queued, and the reason if not.
+    """
+    if not (message.sender and message.receiver and message.text):
+        return chatapp_pb2.SendStatus(index=index, ok=False, text="Sender, receiver and text are required.")
+    text = send(message.sender, message.receiver, message.text)
+    return chatapp_pb2.SendStatus(index=index, ok=text == MESSAGE_SENT, text=text)
+
+
+def send_batch(start: int, messages: list) -> "list[chatapp_pb2.SendStatus]":
+    return [send_status(start + i, message) for i, message in enumerate(messages)]
 
 
 class Chat(chatapp_pb2_grpc.ChatServiceServicer):
@@ -76,6 +185,30 @@ class Chat(chatapp_pb2_grpc.ChatServiceServicer):
             message="\n".join(pending_messages), isEmpty=len(pending_messages) == 0
         )
 
+    def Subscribe(self, request, context):
+        """
+        Stream a user's messages as they arrive, instead of having the client poll Listen.
+        Messages already pending are sent straight away. The stream ends when the
+        client cancels it or the user is deleted.
+        """
+        username = request.username
+        wakeup = threading.Event()
+        add_waiter(username, wakeup.set)
+        # Also wake up when the call is cancelled or the server stops
+        context.add_callback(wakeup.set)
+        try:
+            while context.is_active() and username in store:
+                wakeup.clear()
+                pending_messages = return_pending_messages(username)
+                if pending_messages:
+                    yield chatapp_pb2.PendingRes(
+                        message="\n".join(pending_messages), isEmpty=False
+                    )
+                else:
+                    wakeup.wait()
+        finally:
+            remove_waiter(username, wakeup.set)
+
     def Packet(self, request, context):
         action = request.action
         username = request.username
@@ -83,27 +216,431 @@ class Chat(chatapp_pb2_grpc.ChatServiceServicer):
         func = self.actions.get(action, lambda username: "Invalid action")
         return chatapp_pb2.User(text=func(username))
 
+    def Search(self, request, context):
+        # Read before searching: a change made during the search is streamed to WatchAccounts either way
+        version = store.registry_version
+        names, next_page_token = search_users(request.query, request.page_size, request.page_token)
+        return chatapp_pb2.SearchResponse(usernames=names, next_page_token=next_page_token,
+                                          registry_epoch=registry_epoch, registry_version=version)
+
+    def WatchAccounts(self, request, context):
+        """
+        Stream every account created or deleted, numbered by registry version, so a client can
+        keep a cache of Search results up to date. The first event has no username and gives
+        the version the changes follow. The stream ends when the client cancels it.
+        """
+        if clustered:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION, "Account changes cannot be watched on a cluster.")
+        events = queue.Queue()
+        callback = lambda *event: events.put(event)
+        # Listen before reading the version, so no later change can be missed
+        store.add_registry_listener(callback)
+        context.add_callback(lambda: events.put(None))
+        try:
+            yield chatapp_pb2.AccountEvent(epoch=registry_epoch, version=store.registry_version)
+            while context.is_active():
+                event = events.get()
+                if event is None:
+                    return
+                version, created, username = event
+                yield chatapp_pb2.AccountEvent(
+                    epoch=registry_epoch, version=version, username=username, created=created
+                )
+        finally:
+            store.remove_registry_listener(callback)
+
     def Chat(self, request, context):
         if request.sender and request.receiver and request.text:
             message = send(request.sender, request.receiver, request.text)
             return chatapp_pb2.User(text=message)
 
+    def History(self, request, context):
+        try:
+            return read_history(request)
+        except ValueError:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid page token.")
+
+    def SendMany(self, request_iterator, context):
+        """
+        Send every message of a client stream, in one call instead of one Chat call each.
+        """
+        statuses = [send_status(i, message) for i, message in enumerate(request_iterator)]
+        return chatapp_pb2.SendManyResponse(
+            statuses=statuses, sent=sum(status.ok for status in statuses)
+        )
+
+    def ChatStream(self, request_iterator, context):
+        """
+        Send messages and receive them over one long-lived stream.
+
+        Each `message` request is answered with a `status` in order. After a
+        `subscribe` request, the subscribed user's messages are pushed as
+        `delivery` responses, as with Subscribe; a later `subscribe` replaces it.
+        Without a subscription the stream ends once the client stops sending.
+        """
+        events = queue.Queue()
+
+        def read_requests():
+            index = 0
+            try:
+                for request in request_iterator:
+                    if request.HasField("subscribe"):
+                        events.put(("subscribe", request.subscribe.username))
+                    else:
+                        events.put(("status", send_status(index, request.message)))
+                        index += 1
+            except grpc.RpcError:
+                pass
+            finally:
+                events.put(("done", None))
+
+        context.add_callback(lambda: events.put(("cancelled", None)))
+        threading.Thread(target=read_requests, daemon=True).start()
+        username, callback = None, None
+        try:
+            while True:
+                kind, value = events.get()
+                if kind == "cancelled" or (kind == "done" and username is None):
+                    return
+                if kind == "status":
+                    yield chatapp_pb2.StreamResponse(status=value)
+                elif kind == "subscribe":
+                    if callback:
+                        remove_waiter(username, callback)
+                    username = value
+                    callback = lambda u=username: events.put(("wake", u))
+                    add_waiter(username, callback)
+                    # Deliver whatever was already waiting
+                    callback()
+                elif kind == "wake" and value == username:
+                    pending_messages = return_pending_messages(username)
+                    if pending_messages:
+                        yield chatapp_pb2.StreamResponse(
+                            delivery=chatapp_pb2.PendingRes(
+                                message="\n".join(pending_messages), isEmpty=False
+                            )
+                        )
+        finally:
+            if callback:
+                remove_waiter(username, callback)
+
+
+class AsyncChat(chatapp_pb2_grpc.ChatServiceServicer):
+    """
+    The Chat service for a grpc.aio server.
+
+    Handlers run on the event loop, so an idle Subscribe stream costs a
+    coroutine rather than a worker thread. Calls into the user store go through
+    `executor`, so a slow store cannot stall the event loop.
+    """
+    def __init__(self, executor):
+        self.executor = executor
+        self.actions = {
+            "list": command_list,
+            "delete": command_delete,
+            "join": command_join,
+            "logout": lambda username: "",
+        }
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def Listen(self, request, context):
+        pending_messages = await self.run(return_pending_messages, request.username)
+        return chatapp_pb2.PendingRes(
+            message="\n".join(pending_messages), isEmpty=len(pending_messages) == 0
+        )
+
+    async def Subscribe(self, request, context):
+        """
+        Stream a user's messages as they arrive. See Chat.Subscribe.
+        The stream is cancelled by grpc.aio when the client goes away.
+        """
+        username = request.username
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        # send() may run on any thread
+        callback = lambda: loop.call_soon_threadsafe(wakeup.set)
+        add_waiter(username, callback)
+        try:
+            # Membership is a query or a peer call with some stores, so it is not asked on the event loop
+            while await self.run(store.exists, username):
+                wakeup.clear()
+                pending_messages = await self.run(return_pending_messages, username)
+                if pending_messages:
+                    yield chatapp_pb2.PendingRes(
+                        message="\n".join(pending_messages), isEmpty=False
+                    )
+                else:
+                    await wakeup.wait()
+        finally:
+            remove_waiter(username, callback)
+
+    async def Packet(self, request, context):
+        action = request.action
+        username = request.username
+        print("Handling action:", action, "for user:", username)
+        func = self.actions.get(action, lambda username: "Invalid action")
+        return chatapp_pb2.User(text=await self.run(func, username))
+
+    async def Search(self, request, context):
+        version = store.registry_version
+        names, next_page_token = await self.run(
+            search_users, request.query, request.page_size, request.page_token
+        )
+        return chatapp_pb2.SearchResponse(usernames=names, next_page_token=next_page_token,
+                                          registry_epoch=registry_epoch, registry_version=version)
+
+    async def WatchAccounts(self, request, context):
+        """
+        Stream every account created or deleted. See Chat.WatchAccounts.
+        """
+        if clustered:
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION, "Account changes cannot be watched on a cluster.")
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        # Called on whichever thread changed the registry
+        callback = lambda *event: loop.call_soon_threadsafe(events.put_nowait, event)
+        store.add_registry_listener(callback)
+        try:
+            yield chatapp_pb2.AccountEvent(epoch=registry_epoch, version=store.registry_version)
+            while True:
+                version, created, username = await events.get()
+                yield chatapp_pb2.AccountEvent(
+                    epoch=registry_epoch, version=version, username=username, created=created
+                )
+        finally:
+            store.remove_registry_listener(callback)
+
+    async def Chat(self, request, context):
+        if request.sender and request.receiver and request.text:
+            message = await self.run(send, request.sender, request.receiver, request.text)
+            return chatapp_pb2.User(text=message)
+
+    async def History(self, request, context):
+        try:
+            return await self.run(read_history, request)
+        except ValueError:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid page token.")
+
+    async def SendMany(self, request_iterator, context):
+        """
+        See Chat.SendMany. Messages go to the executor in batches of SEND_BATCH_SIZE.
+        """
+        statuses, batch = [], []
+        async for message in request_iterator:
+            batch.append(message)
+            if len(batch) == SEND_BATCH_SIZE:
+                statuses.extend(await self.run(send_batch, len(statuses), batch))
+                batch = []
+        if batch:
+            statuses.extend(await self.run(send_batch, len(statuses), batch))
+        return chatapp_pb2.SendManyResponse(
+            statuses=statuses, sent=sum(status.ok for status in statuses)
+        )
+
+    async def ChatStream(self, request_iterator, context):
+        """
+        See Chat.ChatStream.
+        """
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        async def read_requests():
+            index = 0
+            try:
+                async for request in request_iterator:
+                    if request.HasField("subscribe"):
+                        events.put_nowait(("subscribe", request.subscribe.username))
+                    else:
+                        status = await self.run(send_status, index, request.message)
+                        events.put_nowait(("status", status))
+                        index += 1
+            finally:
+                events.put_nowait(("done", None))
+
+        reader = asyncio.ensure_future(read_requests())
+        # Retrieves the reader's exception even if the stream ends first, so it is not reported as never retrieved
+        reader.add_done_callback(lambda task: task.cancelled() or task.exception())
+        username, callback = None, None
+        try:
+            while True:
+                kind, value = await events.get()
+                if kind == "done":
+                    # Fails the call if reading the requests failed, rather than only closing their side
+                    await reader
+                    if username is None:
+                        return
+                if kind == "status":
+                    yield chatapp_pb2.StreamResponse(status=value)
+                elif kind == "subscribe":
+                    if callback:
+                        remove_waiter(username, callback)
+                    username = value
+                    callback = lambda u=username: loop.call_soon_threadsafe(
+                        events.put_nowait, ("wake", u)
+                    )
+                    add_waiter(username, callback)
+                    callback()
+                elif kind == "wake" and value == username:
+                    pending_messages = await self.run(return_pending_messages, username)
+                    if pending_messages:
+                        yield chatapp_pb2.StreamResponse(
+                            delivery=chatapp_pb2.PendingRes(
+                                message="\n".join(pending_messages), isEmpty=False
+                            )
+                        )
+        finally:
+            reader.cancel()
+            if callback:
+                remove_waiter(username, callback)
+
+
+async def serve_async(
+    host: str,
+    port: int,
+    max_workers: int = 10,
+    max_concurrent_rpcs: int = None,
+    config: dict = None,
+) -> None:
+    """
+    Run the chat service on a grpc.aio server until it is cancelled.
+
+    Parameters:
+    host (str): The address to listen on.
+    port (int): The port to listen on.
+    max_workers (int, optional): Threads for user store calls. Defaults to 10.
+    max_concurrent_rpcs (int, optional): RPCs allowed in flight before new ones are
+        rejected with RESOURCE_EXHAUSTED. Defaults to no limit.
+    config (dict, optional): Channel options from options.load_config(). Defaults to options.DEFAULTS.
+    """
+    config = config or options.load_config()
+    executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+    server = grpc.aio.server(
+        options=options.channel_options(config, server=True),
+        maximum_concurrent_rpcs=max_concurrent_rpcs,
+        compression=options.compression(config),
+    )
+    chatapp_pb2_grpc.add_ChatServiceServicer_to_server(AsyncChat(executor), server)
+    server.add_insecure_port(f"{host}:{port}")
+    await server.start()
+    print(f"Now listening on {host}:{port} (asyncio)")
+    try:
+        await server.wait_for_termination()
+    finally:
+        await server.stop(None)
+        executor.shutdown(wait=False)
+
+
+def join_cluster(local: ChatStore, node: str, peers: list, secret: str = "") -> None:
+    """
+    Serve from a cluster of nodes, this one owning part of the users in `local`.
+    Peers reach this node over the wire protocol at `node`, so a PeerEndpoint is started there.
+
+    Parameters:
+    local (ChatStore): The store for the users this node owns.
+    node (str): This node's address, "host:port", for peer traffic.
+    peers (list): The other nodes' addresses.
+    secret (str, optional): Shared secret peers must present. Defaults to none.
+    """
+    global clustered
+    # The cluster code speaks the wire protocol and lives with it
+    sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "wire"))
+    from cluster import ClusterChatStore, PeerEndpoint, parse_node
+
+    cluster_store = ClusterChatStore(local, node, [p for p in peers if p and p != node], secret)
+    endpoint = PeerEndpoint(cluster_store, *parse_node(node))
+    endpoint.open_listeners()
+    threading.Thread(target=endpoint.start, daemon=True).start()
+    clustered = True
+    use_store(cluster_store)
+    cluster_store.join()
+
 
 def main(
-    host: str = socket.gethostbyname(socket.gethostname()), port: int = 3000
+    host: str = None,
+    port: int = 3000,
+    use_asyncio: bool = False,
+    max_workers: int = 10,
+    max_concurrent_rpcs: int = None,
+    config: dict = None,
 ) -> None:
+    """
+    Start the chat server.
+
+    Parameters:
+    host (str, optional): The address to listen on. Defaults to the local machine's IP address,
+        looked up here rather than when the module is imported.
+    port (int, optional): The port to listen on. Defaults to 3000.
+    use_asyncio (bool, optional): Serve with grpc.aio instead of a thread per RPC. Defaults to False.
+    max_workers (int, optional): Worker threads; every open Subscribe stream holds one unless
+        use_asyncio is set, in which case they only run user store calls. Defaults to 10.
+    max_concurrent_rpcs (int, optional): RPCs allowed in flight before new ones are
+        rejected with RESOURCE_EXHAUSTED. Defaults to no limit.
+    config (dict, optional): Channel options from options.load_config(). Defaults to options.DEFAULTS.
+    """
+    config = config or options.load_config()
+    host = host or socket.gethostbyname(socket.gethostname())
+    if use_asyncio:
+        try:
+            asyncio.run(serve_async(host, port, max_workers, max_concurrent_rpcs, config))
+        except KeyboardInterrupt:
+            print("Server stopped.")
+        return
 
     try:
-        server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+        server = grpc.server(
+            futures.ThreadPoolExecutor(max_workers=max_workers),
+            options=options.channel_options(config, server=True),
+            maximum_concurrent_rpcs=max_concurrent_rpcs,
+            compression=options.compression(config),
+        )
         chatapp_pb2_grpc.add_ChatServiceServicer_to_server(Chat(), server)
         server.add_insecure_port(f"{host}:{port}")
         server.start()
         print(f"Now listening on {host}:{port}")
         server.wait_for_termination()
     except KeyboardInterrupt:
-        server.stop
+        server.stop(None)
         print("Server stopped.")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="gRPC chat server")
+    parser.add_argument("--host", default=os.environ.get("CHAT_GRPC_HOST"),
+                        help="address to listen on. Defaults to $CHAT_GRPC_HOST, or else this machine's address")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("CHAT_GRPC_PORT", 3000)))
+    parser.add_argument("--asyncio", dest="use_asyncio", action="store_true",
+                        help="serve with grpc.aio so streams do not hold threads")
+    parser.add_argument("--max-workers", type=int, default=10)
+    parser.add_argument("--max-concurrent-rpcs", type=int, default=None)
+    parser.add_argument("--store", default="memory", help="memory, or journal:<path> / sqlite:<path> to persist")
+    parser.add_argument("--peers", default="", help="comma-separated host:port of the other cluster nodes")
+    parser.add_argument("--node", help="host:port to answer cluster peers on, required with --peers")
+    parser.add_argument("--cluster-secret", default="", help="secret cluster peers must present, required with --peers")
+    parser.add_argument("--history", help="directory to keep message history in, not with --peers. Defaults to no history")
+    parser.add_argument("--history-ttl", type=float, help="seconds to keep history for. Defaults to forever")
+    options.add_arguments(parser)
+    args = parser.parse_args()
+    if args.history and args.peers:
+        # Each node would only keep the messages sent through it, so no node has a whole conversation
+        parser.error("--history cannot be used with --peers")
+    if args.history:
+        use_history(HistoryStore(args.history, ttl=args.history_ttl))
+    if args.peers:
+        if not args.node:
+            parser.error("--peers needs --node")
+        if not args.cluster_secret:
+            # Peers may read and delete any mailbox, so they must not be open to every client
+            parser.error("--peers needs --cluster-secret")
+        join_cluster(open_store(args.store), args.node, args.peers.split(","), args.cluster_secret)
+    else:
+        use_store(open_store(args.store))
+    main(
+        args.host,
+        args.port,
+        args.use_asyncio,
+        args.max_workers,
+        args.max_concurrent_rpcs,
+        options.config_from_args(args),
+    )
@@ -0,0 +1,61 @@
+import argparse
+import json
+import os
+import socket
+import sys
+from codes import Requests, Responses
+from protocol import WireProtocol, VERSION, HEADER_SIZE, ENCODING
+from transport import recv_exact
+
+
+def admin_request(conn, secret, command, **options):
+    """
+    Send an ADMIN request and wait for its answer.
+
+    Parameters:
+    conn (socket.socket): A connection to the server.
+    secret (str): The server's admin secret.
+    command (str): The command, see Server.handle_admin.
+    options: The command's options.
+
+    Returns:
+    tuple: The response code and body.
+    """
+    header, body = WireProtocol.encode(VERSION, Requests.ADMIN, json.dumps({"secret": secret, "command": command, **options}))
+    conn.sendall(header + body)
+    while True:
+        header = recv_exact(conn, HEADER_SIZE)
+        if not header:
+            raise ConnectionError("The server closed the connection")
+        _, size, code = WireProtocol.decode_header(header)
+        body = recv_exact(conn, size).decode(ENCODING)
+        if code != Responses.MESSAGE:
+            return code, body
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send operator commands, such as profiling, to a wire protocol server")
+    parser.add_argument("command", help="status, cprofile_start, cprofile_stop, sample_start, sample_stop, "
+                        "tracemalloc_start, tracemalloc_snapshot, tracemalloc_stop or report")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--secret", default=os.environ.get("CHAT_ADMIN_SECRET", ""),
+                        help="the server's --admin-secret. Defaults to $CHAT_ADMIN_SECRET")
+    parser.add_argument("--option", action="append", default=[], metavar="NAME=VALUE",
+                        help="a command option, e.g. interval=0.01, limit=20 or file=profile.pstats")
+    parser.add_argument("--all", action="store_true", help="fetch every page of the report")
+    args = parser.parse_args()
+
+    options = dict(option.split("=", 1) for option in args.option)
+    conn = socket.create_connection((args.host, args.port))
+    try:
+        code, body = admin_request(conn, args.secret, args.command, **options)
+        print(body)
+        page, _, pages = body.partition("\n")[0].removeprefix("page ").partition("/")
+        if args.all and code == Responses.SUCCESS and pages.isdigit():
+            for page in range(int(page) + 1, int(pages) + 1):
+                code, body = admin_request(conn, args.secret, "report", **{**options, "page": page})
+                print(body.partition("\n")[2])
+    finally:
+        conn.close()
+    sys.exit(0 if code == Responses.SUCCESS else 1)
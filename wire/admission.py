@@ -0,0 +1,211 @@
+import threading
+import time
+from codes import Requests
+
+# Operations that may be dropped while the server is under pressure. Logins,
+# sends and disconnects are never shed so established sessions keep working.
+DEFAULT_SHED_OPERATIONS = frozenset({
+    Requests.LIST_ACCOUNTS,
+    Requests.VIEW_MESSAGES,
+})
+
+def parse_operations(text):
+    """
+    Parse a comma-separated list of operation names, e.g. "LIST_ACCOUNTS,VIEW_MESSAGES".
+
+    Returns:
+    frozenset: The operation codes.
+
+    Raises:
+    ValueError: If a name is not an operation.
+    """
+    operations = set()
+    for name in filter(None, (name.strip().upper() for name in text.split(","))):
+        code = getattr(Requests, name, None)
+        if not isinstance(code, int):
+            raise ValueError(f"Unknown operation {name!r}")
+        operations.add(code)
+    return frozenset(operations)
+
+
+# Prefix of the first line of an OVERLOADED response body.
+RETRY_AFTER_PREFIX = "retry-after="
+
+
+def format_retry_after(retry_after, reason):
+    """
+    Build the body of an OVERLOADED response.
+
+    Parameters:
+    retry_after (float): Seconds the client should wait before retrying.
+    reason (str): Human readable reason for the rejection.
+
+    Returns:
+    str: The response body, e.g. "retry-after=1.50\\nServer is at capacity".
+    """
+    return f"{RETRY_AFTER_PREFIX}{retry_after:.2f}\n{reason}"
+
+
+def parse_retry_after(message):
+    """
+    Extract the retry-after hint from an OVERLOADED response body.
+
+    Parameters:
+    message (str): The response body.
+
+    Returns:
+    float: The hint in seconds, or None if the body carries no hint.
+    """
+    first_line = message.split("\n", 1)[0]
+    if not first_line.startswith(RETRY_AFTER_PREFIX):
+        return None
+    try:
+        return float(first_line[len(RETRY_AFTER_PREFIX):])
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket used to rate limit accepted connections.
+
+    Parameters:
+        rate (float): Tokens added per second.
+        burst (int): Maximum number of tokens the bucket can hold.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        Take a token if one is available.
+
+        Returns:
+        float: 0.0 if a token was taken, otherwise the seconds until one is available.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return 0.0
+            return (1.0 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """
+    Decides which connections and requests the server takes on while overloaded.
+
+    New connections are rejected once the connection cap or the accept rate is
+    exceeded. Requests for low-priority operations are shed while the number of
+    in-flight requests or the smoothed handler latency is above its threshold.
+
+    Parameters:
+        max_connections (int, optional): Maximum number of concurrent client connections. Defaults to 1024.
+        accept_rate (float, optional): Sustained connections accepted per second. Defaults to 200.
+        accept_burst (int, optional): Connections that may be accepted in a burst. Defaults to 100.
+        backlog (int, optional): The listen() backlog for the server socket. Defaults to 128.
+        max_inflight (int, optional): In-flight requests above which low-priority operations are shed. Defaults to 64.
+        latency_threshold (float, optional): Smoothed handler latency in seconds above which low-priority operations are shed. Defaults to 0.25.
+        shed_operations (frozenset, optional): Operation codes that may be shed. Defaults to DEFAULT_SHED_OPERATIONS.
+        retry_after (float, optional): Minimum retry-after hint sent to rejected clients. Defaults to 1.0.
+    """
+    # Weight of the newest sample in the handler latency moving average.
+    LATENCY_ALPHA = 0.2
+
+    def __init__(self,
+        max_connections: int = 1024,
+        accept_rate: float = 200.0,
+        accept_burst: int = 100,
+        backlog: int = 128,
+        max_inflight: int = 64,
+        latency_threshold: float = 0.25,
+        shed_operations: frozenset = DEFAULT_SHED_OPERATIONS,
+        retry_after: float = 1.0,
+    ):
+        self.max_connections = max_connections
+        self.backlog = backlog
+        self.max_inflight = max_inflight
+        self.latency_threshold = latency_threshold
+        self.shed_operations = shed_operations
+        self.retry_after = retry_after
+        self.accept_bucket = TokenBucket(accept_rate, accept_burst)
+
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.inflight = 0
+        self.latency = 0.0
+
+    def admit_connection(self):
+        """
+        Decide whether a newly accepted connection may be served.
+
+        Returns:
+        tuple: (admitted, retry_after, reason). retry_after and reason are only meaningful when admitted is False.
+        """
+        with self.lock:
+            if self.connections >= self.max_connections:
+                return False, self.retry_after, "Server is at connection capacity"
+        wait = self.accept_bucket.try_acquire()
+        if wait:
+            return False, max(wait, self.retry_after), "Server is accepting connections too fast"
+        with self.lock:
+            self.connections += 1
+        return True, 0.0, ""
+
+    def adopt_connection(self):
+        """
+        Count a connection handed over by the server process this one replaced. It was admitted
+        there, so it is served whatever the limits.
+        """
+        with self.lock:
+            self.connections += 1
+
+    def release_connection(self):
+        """
+        Release the slot held by an admitted connection once it is closed.
+        """
+        with self.lock:
+            self.connections = max(0, self.connections - 1)
+
+    def overloaded(self):
+        """
+        Returns:
+        bool: True if the queue depth or handler latency is above its threshold.
+        """
+        return self.inflight >= self.max_inflight or self.latency >= self.latency_threshold
+
+    def begin_request(self, operation):
+        """
+        Register the start of a request, unless it should be shed.
+
+        Parameters:
+        operation (int): The operation code of the request.
+
+        Returns:
+        float: None if the request was admitted, otherwise the retry-after hint in seconds.
+        """
+        with self.lock:
+            if operation in self.shed_operations and self.overloaded():
+                # Decay the latency estimate so shedding stops once the slow
+                # requests that caused it are no longer being admitted.
+                self.latency *= 1 - self.LATENCY_ALPHA
+                return self.retry_after
+            self.inflight += 1
+        return None
+
+    def end_request(self, duration):
+        """
+        Register the completion of an admitted request.
+
+        Parameters:
+        duration (float): How long the handler took, in seconds.
+        """
+        with self.lock:
+            self.inflight -= 1
+            self.latency += self.LATENCY_ALPHA * (duration - self.latency)
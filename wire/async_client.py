@@ -0,0 +1,740 @@
+import asyncio
+import collections
+import glob
+import logging
+import os
+import socket
+import sys
+import zlib
+
+# The account cache lives in the repository root, shared with the gRPC client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from chatstore import AccountCache
+from codes import Requests, Responses
+from protocol import WireProtocol, VERSION, HEADER_SIZE, ENCODING, CHUNKED_VERSION, CHUNK_HEADER_SIZE
+from admission import parse_retry_after
+
+
+class RequestFailed(Exception):
+    """
+    Raised when the server answers a request with anything other than SUCCESS.
+
+    Attributes:
+        status (int): The response code.
+        message (str): The response body.
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Overloaded(RequestFailed):
+    """
+    Raised when the server sheds a request or rejects the connection.
+
+    Attributes:
+        retry_after (float): Seconds the server asked us to wait, or None.
+    """
+    def __init__(self, message):
+        super().__init__(Responses.OVERLOADED, message)
+        self.retry_after = parse_retry_after(message)
+
+
+class AsyncClient:
+    """
+    An asyncio client for the wire protocol server, meant to be embedded in other services.
+
+    Requests are pipelined: any number of coroutines may have a request in
+    flight on the same connection, and responses are matched to them in order.
+    Several users may be logged in over one connection. Chat messages pushed
+    by the server are collected in a queue and exposed through `messages()`,
+    and acknowledged in batches. If the connection drops, in-flight requests
+    fail with ConnectionError and the client reconnects in the background,
+    resuming each user's session so only unacknowledged pushes are resent.
+    Users whose session has expired are logged in again.
+
+    Parameters:
+        host (str, optional): The server host, for TCP connections.
+        port (int, optional): The server port, for TCP connections. Defaults to 5050.
+        path (str, optional): The server's Unix socket path. Takes precedence over host and port.
+        reconnect (bool, optional): Reconnect automatically when the connection drops. Defaults to True.
+        reconnect_delay (float, optional): Initial reconnect backoff in seconds. Defaults to 0.5.
+        max_reconnect_delay (float, optional): Upper bound on the reconnect backoff. Defaults to 30.
+        push_queue (asyncio.Queue, optional): Queue that receives (receiver, message) pushes. Defaults to a new queue.
+        deliver_backlog (bool, optional): Have the server push the messages queued for a user while
+            offline when it logs in, instead of leaving them for view_messages. Defaults to False.
+        presence_queue (asyncio.Queue, optional): Queue that receives (subscriber, {username: online}) status
+            changes of the users watched with subscribe_presence. Defaults to a new queue.
+        account_cache (AccountCache, optional): Answer list_accounts and account_exists from this cache
+            where possible, keeping it up to date by watching account changes on the connection.
+            Defaults to None, which asks the server every time.
+    """
+    def __init__(self,
+        host: str = None,
+        port: int = 5050,
+        path: str = None,
+        reconnect: bool = True,
+        reconnect_delay: float = 0.5,
+        max_reconnect_delay: float = 30.0,
+        push_queue: asyncio.Queue = None,
+        deliver_backlog: bool = False,
+        presence_queue: asyncio.Queue = None,
+        account_cache: AccountCache = None,
+    ):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.pushes = push_queue if push_queue is not None else asyncio.Queue()
+        self.deliver_backlog = deliver_backlog
+        self.presence_updates = presence_queue if presence_queue is not None else asyncio.Queue()
+        # The users each of our users watches, and their last known status
+        self.presence = {}
+        self.accounts = account_cache
+
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.reconnect_task = None
+        self.pending = collections.deque()
+        # Where the chunks of a chunked response go, by the future of its request
+        self.chunk_sinks = {}
+        # Chunks of two uploads must not interleave on the connection
+        self.upload_lock = asyncio.Lock()
+        self.tokens = {}
+        self.last_seq = {}
+        self.acked_seq = {}
+        self.ack_scheduled = False
+        self.connected = asyncio.Event()
+        self.closing = False
+        self.retry_after = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        """
+        Open the connection to the server.
+        """
+        if self.path:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            sock = self.writer.get_extra_info("socket")
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.retry_after = None
+        self.reader_task = asyncio.create_task(self._read_loop(self.reader))
+        self.connected.set()
+        if self.accounts is not None:
+            await self._watch_accounts()
+
+    async def _watch_accounts(self):
+        """
+        Have the server push account changes, and start answering from the account cache.
+        """
+        try:
+            message = await self.request(Requests.WATCH_ACCOUNTS)
+        except RequestFailed as e:
+            # e.g. a cluster node, whose accounts change on other nodes too
+            logging.warning(f"[ACCOUNT CACHE] Not caching accounts: {e}")
+            return
+        epoch, _, version = message.partition(":")
+        self.accounts.watching(epoch, int(version))
+
+    async def close(self):
+        """
+        Disconnect from the server and stop reconnecting.
+        """
+        self.closing = True
+        if self.reconnect_task:
+            self.reconnect_task.cancel()
+        if self.connected.is_set():
+            header, encoded = WireProtocol.encode(version=VERSION, operation=Requests.DISCONNECT, msg="")
+            try:
+                self.writer.write(header + encoded)
+                await self.writer.drain()
+            except OSError:
+                pass
+        if self.writer:
+            self.writer.close()
+        if self.reader_task:
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+        # Wake up anyone iterating over messages()
+        self.pushes.put_nowait(None)
+
+    async def _read_loop(self, reader):
+        """
+        Read frames from the server, routing pushes to the queue and responses to their requests.
+        """
+        try:
+            while True:
+                header = await reader.readexactly(HEADER_SIZE)
+                version, size, operation = WireProtocol.decode_header(header)
+                if version == CHUNKED_VERSION:
+                    index, more = WireProtocol.decode_chunk_header(await reader.readexactly(CHUNK_HEADER_SIZE))
+                    self._handle_chunk(operation, index, more, await reader.readexactly(size - CHUNK_HEADER_SIZE))
+                    continue
+                body = (await reader.readexactly(size)).decode(ENCODING)
+                if operation == Responses.MESSAGE:
+                    self._handle_push(body)
+                elif operation == Responses.PRESENCE:
+                    self._handle_presence(body)
+                elif operation == Responses.ACCOUNTS_CHANGED:
+                    if self.accounts is not None:
+                        self.accounts.apply(*WireProtocol.decode_account_changes(body))
+                elif self.pending:
+                    future = self.pending.popleft()
+                    if not future.done():
+                        future.set_result((operation, body))
+                elif operation == Responses.OVERLOADED:
+                    # The server turned the connection away right after accepting it
+                    self.retry_after = parse_retry_after(body)
+                    logging.warning(f"[OVERLOADED] Connection rejected, retry after {self.retry_after}s")
+                    break
+                elif operation == Responses.DISCONNECT:
+                    logging.info("[DISCONNECTED] Server closed the connection")
+                    break
+                else:
+                    logging.warning(f"[UNEXPECTED FRAME] operation {operation}: {body}")
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self._connection_lost()
+
+    def _handle_chunk(self, operation, index, more, payload):
+        """
+        Hand a chunk of a chunked response to the sink of the request it answers.
+        """
+        future = self.pending[0] if self.pending else None
+        sink = self.chunk_sinks.get(future)
+        if sink is None:
+            logging.warning(f"[UNEXPECTED FRAME] chunk {index} of operation {operation}")
+            return
+        try:
+            sink(index, payload)
+        except Exception as e:
+            self.chunk_sinks[future] = lambda index, payload: None
+            if not future.done():
+                future.set_exception(e)
+        if not more:
+            self.pending.popleft()
+            del self.chunk_sinks[future]
+            if not future.done():
+                future.set_result((operation, ""))
+
+    def _handle_push(self, body):
+        receiver, seq, text = WireProtocol.decode_push(body)
+        if seq <= self.last_seq.get(receiver, 0):
+            # Already seen, resent because our acknowledgement did not make it
+            return
+        self.last_seq[receiver] = seq
+        self.pushes.put_nowait((receiver, text))
+        if not self.ack_scheduled:
+            # Acknowledge everything that arrived in this burst with one frame per user
+            self.ack_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush_acks)
+
+    def _handle_presence(self, body):
+        subscriber, statuses = WireProtocol.decode_presence(body)
+        if subscriber in self.presence:
+            self.presence[subscriber].update(statuses)
+            self.presence_updates.put_nowait((subscriber, statuses))
+
+    def _flush_acks(self):
+        self.ack_scheduled = False
+        if not self.connected.is_set():
+            return
+        frames = []
+        for username, seq in self.last_seq.items():
+            if self.acked_seq.get(username) != seq:
+                self.acked_seq[username] = seq
+                header, encoded = WireProtocol.encode(version=VERSION, operation=Requests.ACK, msg=f"{username}\n{seq}")
+                frames.append(header + encoded)
+        if frames:
+            self.writer.write(b"".join(frames))
+
+    def _connection_lost(self):
+        self.connected.clear()
+        if self.accounts is not None:
+            # Changes made while we are away would be missed
+            self.accounts.stop()
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError("Connection to server lost"))
+        self.chunk_sinks.clear()
+        if self.writer:
+            self.writer.close()
+        if self.reconnect and not self.closing:
+            self.reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        """
+        Reconnect with exponential backoff and resume our users' sessions.
+        """
+        delay = max(self.reconnect_delay, self.retry_after or 0.0)
+        while not self.closing:
+            await asyncio.sleep(delay)
+            try:
+                await self.connect()
+            except OSError as e:
+                logging.warning(f"[RECONNECT] Failed to reconnect: {e}")
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+            logging.info("[RECONNECT] Reconnected to server")
+            users = list(self.tokens)
+            results = await asyncio.gather(*(self._restore(u) for u in users), return_exceptions=True)
+            for username, result in zip(users, results):
+                if isinstance(result, Exception):
+                    logging.warning(f"[RECONNECT] Could not log {username} back in: {result}")
+                    self._forget(username)
+            return
+
+    async def _restore(self, username):
+        """
+        Reattach a user's session after a reconnect, logging in again if it has expired.
+        """
+        try:
+            self.acked_seq.pop(username, None)
+            await self.request(Requests.RESUME, f"{self.tokens[username]}\n{self.last_seq.get(username, 0)}")
+        except RequestFailed:
+            # A new session starts without the expired one's subscription
+            watched = list(self.presence.get(username, ()))
+            await self.login(username)
+            if watched:
+                await self.subscribe_presence(username, watched)
+
+    def _forget(self, username):
+        self.tokens.pop(username, None)
+        self.last_seq.pop(username, None)
+        self.acked_seq.pop(username, None)
+
+    async def request(self, op, msg="", chunk_sink=None):
+        """
+        Send a request and wait for its response.
+
+        Parameters:
+        op (int): The request operation code.
+        msg (str, optional): The request body. Defaults to an empty string.
+        chunk_sink (callable, optional): Called as chunk_sink(index, payload) with each chunk if the
+            response is chunked. Defaults to None.
+
+        Returns:
+        str: The response body.
+
+        Raises:
+        Overloaded: If the server shed the request.
+        RequestFailed: If the server answered with any other non-SUCCESS code.
+        ConnectionError: If the connection was lost before the response arrived.
+        """
+        if not self.connected.is_set():
+            if self.closing or not self.reconnect:
+                raise ConnectionError("Not connected to server")
+            await self.connected.wait()
+        future = asyncio.get_running_loop().create_future()
+        header, encoded = WireProtocol.encode(version=VERSION, operation=op, msg=msg)
+        # Nothing may run between queueing the future and writing the frame,
+        # otherwise responses could be matched to the wrong request.
+        self.pending.append(future)
+        if chunk_sink:
+            self.chunk_sinks[future] = chunk_sink
+        self.writer.write(header + encoded)
+        await self.writer.drain()
+        try:
+            return self._result(await future)
+        finally:
+            # Left behind if the answer was not chunked after all, e.g. a FAILURE
+            self.chunk_sinks.pop(future, None)
+
+    @staticmethod
+    def _result(response):
+        status, message = response
+        if status == Responses.SUCCESS:
+            return message
+        if status == Responses.OVERLOADED:
+            raise Overloaded(message)
+        raise RequestFailed(status, message)
+
+    async def login(self, username: str):
+        """
+        Log a user in over this connection.
+
+        Parameters:
+        username (str): The user to log in.
+        """
+        previous = [(state, state.get(username)) for state in (self.tokens, self.last_seq, self.acked_seq)]
+        # A new session numbers its pushes from the start again, and may push
+        # the user's backlog before the response arrives
+        self._forget(username)
+        try:
+            message = await self.request(Requests.LOGIN, f"{username}\ndeliver" if self.deliver_backlog else username)
+        except Exception:
+            for state, value in previous:
+                if value is not None:
+                    state[username] = value
+            raise
+        self.tokens[username] = message.partition("\n")[2]
+        self.presence.pop(username, None)
+
+    async def create_account(self, username: str):
+        """
+        Create an account.
+
+        Parameters:
+        username (str): The username of the new account.
+        """
+        await self.request(Requests.CREATE_ACCOUNT, username)
+        if self.accounts is not None:
+            self.accounts.note(True, username)
+
+    async def delete_account(self, username: str):
+        """
+        Delete an account.
+
+        Parameters:
+        username (str): The username of the account to delete.
+        """
+        await self.request(Requests.DELETE_ACCOUNT, username)
+        if self.accounts is not None:
+            self.accounts.note(False, username)
+
+    async def list_accounts(self, pattern: str = "*"):
+        """
+        List the accounts matching a shell-style pattern.
+
+        Parameters:
+        pattern (str, optional): The pattern to match. Defaults to "*".
+
+        Returns:
+        list: The matching usernames.
+        """
+        if self.accounts is not None:
+            names = self.accounts.search(pattern)
+            if names is not None:
+                return names
+            message = await self.request(Requests.LIST_ACCOUNTS, f"{pattern}\nversioned")
+            stamp, *names = message.split("\n")
+            epoch, _, version = stamp.partition(":")
+            names = [name for name in names if name]
+            self.accounts.put_search(pattern, names, epoch, int(version))
+            return names
+        try:
+            message = await self.request(Requests.LIST_ACCOUNTS, pattern)
+        except RequestFailed as e:
+            if e.status == Responses.FAILURE:
+                return []
+            raise
+        return [name for name in message.split("\n") if name]
+
+    async def account_exists(self, username: str):
+        """
+        Check whether an account exists, without asking the server if the account cache knows.
+
+        Parameters:
+        username (str): The username to look for.
+
+        Returns:
+        bool: Whether the account exists.
+        """
+        if self.accounts is not None:
+            exists = self.accounts.exists(username)
+            if exists is not None:
+                return exists
+        return username in await self.list_accounts(glob.escape(username))
+
+    async def send_chat(self, sender: str, receiver: str, message: str):
+        """
+        Send a chat message.
+
+        Parameters:
+        sender (str): The username sending the message.
+        receiver (str): The username receiving the message.
+        message (str): The message to send.
+
+        Returns:
+        bool: True if the message was delivered immediately, False if it was queued.
+        """
+        result = await self.request(Requests.SEND_MESSAGE, f"{sender}\n{receiver}\n{message}")
+        return result == "Message sent."
+
+    async def view_messages(self, username: str):
+        """
+        Fetch the messages queued for a user while they were offline.
+
+        Parameters:
+        username (str): A user logged in over this connection.
+
+        Returns:
+        list: The queued messages, oldest first.
+        """
+        message = await self.request(Requests.VIEW_MESSAGES, username)
+        return [line for line in message.split("\n") if line]
+
+    async def history(self, username: str, peer: str, start: float = None, end: float = None,
+                      page_size: int = None, page_token: str = ""):
+        """
+        Fetch a page of the conversation between two users, oldest first. Unlike view_messages this
+        does not consume anything.
+
+        Parameters:
+        username (str): A user logged in over this connection.
+        peer (str): The other user.
+        start (float, optional): The earliest Unix timestamp, inclusive. Defaults to the beginning.
+        end (float, optional): The latest Unix timestamp, exclusive. Defaults to now.
+        page_size (int, optional): The most messages to return. Defaults to the server's maximum.
+        page_token (str, optional): The token returned with the previous page. Defaults to the first page.
+
+        Returns:
+        tuple: A list of (timestamp, sender, text) and the token for the next page, empty on the last page.
+        """
+        fields = [username, peer, "" if start is None else repr(start), "" if end is None else repr(end),
+                  "" if page_size is None else str(page_size), page_token]
+        message = await self.request(Requests.HISTORY, "\n".join(fields))
+        token, _, lines = message.partition("\n")
+        entries = []
+        for line in lines.split("\n") if lines else []:
+            ts, sender, text = line.split("\t", 2)
+            entries.append((float(ts), sender, text))
+        return entries, token
+
+    async def search_messages(self, username: str, query: str, limit: int = None, page_token: str = ""):
+        """
+        Search the messages a user has sent and received for every word of `query`.
+
+        Parameters:
+        username (str): A user logged in over this connection.
+        query (str): The words to look for, in any order and case.
+        limit (int, optional): The most messages to return. Defaults to the server's default.
+        page_token (str, optional): The token returned with the previous page. Defaults to the first page.
+
+        Returns:
+        tuple: A list of (timestamp, sender, receiver, text), newest first, and the token for the
+            next page, empty on the last page.
+        """
+        fields = [username, query.replace("\n", " "), "" if limit is None else str(limit), page_token]
+        message = await self.request(Requests.SEARCH_MESSAGES, "\n".join(fields))
+        token, _, lines = message.partition("\n")
+        results = []
+        for line in lines.split("\n") if lines else []:
+            ts, sender, receiver, text = line.split("\t", 3)
+            results.append((float(ts), sender, receiver, text))
+        return results, token
+
+    async def send_attachment(self, sender: str, receiver: str, path: str):
+        """
+        Send a file to a user, reading and sending it one chunk at a time.
+
+        Other requests on the connection carry on while the file is sent.
+
+        Parameters:
+        sender (str): A user logged in over this connection.
+        receiver (str): The user to send the file to.
+        path (str): The file to send.
+
+        Returns:
+        str: The attachment's id.
+        """
+        async with self.upload_lock:
+            if not self.connected.is_set():
+                raise ConnectionError("Not connected to server")
+            with open(path, "rb") as f:
+                first = f"{sender}\n{receiver}\n{os.path.basename(path)}\n{os.fstat(f.fileno()).st_size}"
+                frames = WireProtocol.encode_chunks(Requests.UPLOAD_ATTACHMENT, first, f)
+                frame = next(frames)
+                for following in frames:
+                    self.writer.write(frame)
+                    await self.writer.drain()
+                    frame = following
+                # The server answers after the last chunk, so the request is only queued now
+                future = asyncio.get_running_loop().create_future()
+                self.pending.append(future)
+                self.writer.write(frame)
+            await self.writer.drain()
+        return self._result(await future)
+
+    async def download_attachment(self, username: str, attachment_id: str, directory: str = "."):
+        """
+        Download an attachment to a file, writing it one chunk at a time.
+
+        Parameters:
+        username (str): A user logged in over this connection, its sender or receiver.
+        attachment_id (str): The attachment's id.
+        directory (str, optional): Where to save it, under the name it was sent with. Defaults to ".".
+
+        Returns:
+        str: The path of the saved file.
+        """
+        download = {}
+
+        def write_chunk(index, payload):
+            if index == 0:
+                filename, _ = payload.decode(ENCODING).split("\n")
+                download["path"] = os.path.join(directory, os.path.basename(filename))
+                download["file"] = open(download["path"], "wb")
+            else:
+                download["file"].write(payload)
+
+        try:
+            await self.request(Requests.DOWNLOAD_ATTACHMENT, f"{username}\n{attachment_id}", chunk_sink=write_chunk)
+        finally:
+            if "file" in download:
+                download["file"].close()
+        return download["path"]
+
+    async def subscribe_presence(self, username: str, usernames):
+        """
+        Watch users come online and go offline. Changes arrive on presence_updates, coalesced
+        by the server into at most one update per interval, and are kept in `presence`.
+
+        Parameters:
+        username (str): A user logged in over this connection.
+        usernames (iterable): The users to watch, replacing any watched before. Empty to stop watching.
+
+        Returns:
+        dict: Whether each watched user is online now.
+        """
+        usernames = list(usernames)
+        message = await self.request(Requests.SUBSCRIBE_PRESENCE, "\n".join([username, *usernames]))
+        _, statuses = WireProtocol.decode_presence(message)
+        if usernames:
+            self.presence[username] = dict(statuses)
+        else:
+            self.presence.pop(username, None)
+        return statuses
+
+    async def messages(self):
+        """
+        Iterate over chat messages pushed by the server until the client is closed.
+
+        Yields:
+        tuple: The receiving username and the message.
+        """
+        while True:
+            push = await self.pushes.get()
+            if push is None:
+                return
+            yield push
+
+
+class AsyncClientPool:
+    """
+    Spreads many logical users over a bounded set of AsyncClient connections.
+
+    A user is always routed to the same connection, picked by hashing the
+    username, because the server ties a login to the connection it arrived on.
+    Requests that are not tied to a user are spread round-robin.
+
+    Parameters:
+        size (int, optional): The number of connections. Defaults to 8.
+        host, port, path: Where to connect, see AsyncClient.
+        cache_accounts (bool, optional): Keep an account cache, see AsyncClient. Account requests then
+            all go over the first connection, which is the only one watching account changes. Defaults to False.
+        client_options: Extra keyword arguments passed to every AsyncClient.
+    """
+    def __init__(self, size=8, host=None, port=5050, path=None, cache_accounts=False, **client_options):
+        self.pushes = asyncio.Queue()
+        self.presence_updates = asyncio.Queue()
+        self.clients = [
+            AsyncClient(host, port, path, push_queue=self.pushes, presence_queue=self.presence_updates, **client_options)
+            for _ in range(size)
+        ]
+        self.next_client = 0
+        self.accounts_client = None
+        if cache_accounts:
+            self.accounts_client = self.clients[0]
+            self.accounts_client.accounts = AccountCache()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        await asyncio.gather(*(client.connect() for client in self.clients))
+
+    async def close(self):
+        await asyncio.gather(*(client.close() for client in self.clients))
+        self.pushes.put_nowait(None)
+
+    def client_for(self, username):
+        """
+        Returns:
+        AsyncClient: The connection that carries this user's session.
+        """
+        return self.clients[zlib.crc32(username.encode(ENCODING)) % len(self.clients)]
+
+    def any_client(self):
+        """
+        Returns:
+        AsyncClient: The next connection in round-robin order.
+        """
+        client = self.clients[self.next_client]
+        self.next_client = (self.next_client + 1) % len(self.clients)
+        return client
+
+    async def login(self, username):
+        await self.client_for(username).login(username)
+
+    def account_client(self):
+        """
+        Returns:
+        AsyncClient: The connection for account requests, the one with the account cache if there is one.
+        """
+        return self.accounts_client or self.any_client()
+
+    async def create_account(self, username):
+        await self.account_client().create_account(username)
+
+    async def delete_account(self, username):
+        await self.account_client().delete_account(username)
+
+    async def list_accounts(self, pattern="*"):
+        return await self.account_client().list_accounts(pattern)
+
+    async def account_exists(self, username):
+        return await self.account_client().account_exists(username)
+
+    async def send_chat(self, sender, receiver, message):
+        return await self.client_for(sender).send_chat(sender, receiver, message)
+
+    async def view_messages(self, username):
+        return await self.client_for(username).view_messages(username)
+
+    async def history(self, username, peer, **options):
+        return await self.client_for(username).history(username, peer, **options)
+
+    async def search_messages(self, username, query, **options):
+        return await self.client_for(username).search_messages(username, query, **options)
+
+    async def send_attachment(self, sender, receiver, path):
+        return await self.client_for(sender).send_attachment(sender, receiver, path)
+
+    async def download_attachment(self, username, attachment_id, directory="."):
+        return await self.client_for(username).download_attachment(username, attachment_id, directory)
+
+    async def subscribe_presence(self, username, usernames):
+        return await self.client_for(username).subscribe_presence(username, usernames)
+
+    async def messages(self):
+        """
+        Iterate over chat messages pushed to any user in the pool until it is closed.
+
+        Yields:
+        tuple: The receiving username and the message.
+        """
+        while True:
+            push = await self.pushes.get()
+            if push is None:
+                return
+            yield push
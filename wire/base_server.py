@@ -1,9 +1,32 @@
+import mmap
+import os
+import select
 import socket
 import threading
-from codes import Requests, Responses
-from protocol import WireProtocol, VERSION, HEADER_SIZE, ENCODING
+import time
+import weakref
+from codes import Responses
+from protocol import (WireProtocol, ProtocolError, VERSION, HEADER_SIZE, ENCODING, MAX_FRAME_SIZE,
+                      CHUNKED_VERSION, CHUNK_HEADER_SIZE, CHUNK_SIZE)
+from admission import AdmissionController, format_retry_after
+from transport import TCPListener, peer_address, recv_exact
+from profiler import Profiler
+from recorder import UNRECORDED
 import logging
 
+def configure_logging():
+    """
+    Log to debug.log and the console. Does nothing if logging is already set up, e.g. by
+    an entry point that logs while opening the stores, before the server starts.
+    """
+    logging.basicConfig(level=logging.INFO,
+    handlers=[
+            logging.FileHandler("debug.log"),
+            logging.StreamHandler()
+        ]
+    )
+
+
 class BaseServer:
     """
     A class representing a server that can handle multiple clients using threads.
@@ -14,53 +37,122 @@ class BaseServer:
         encoding (str): The encoding format to use for the messages.
         header_length (int): The header size of the message in bytes.
         disconnect_message (str): The message used to disconnect a client.
-        server (socket.socket): The server socket instance.
+        listeners (list): The listeners the server accepts connections on.
+        admission (AdmissionController): Decides which connections and requests are served under overload.
 
     Parameters:
-        host (str, optional): The IP address of the server host. Defaults to the local machine's IP address.
+        host (str, optional): The IP address of the server host. Defaults to the local machine's IP address,
+            looked up when the server starts listening.
         port (int, optional): The port number to use for the server. Defaults to 5050.
         encoding (str, optional): The encoding format to use for the messages. Defaults to 'utf-8'.
         header_length (int, optional): The header size of the message in bytes. Defaults to 64.
         disconnect_message (str, optional): The message used to disconnect a client. Defaults to '!DISCONNECT'.
+        admission (AdmissionController, optional): Overload protection settings. Defaults to AdmissionController().
+        listeners (list, optional): Listeners to accept connections on, e.g. a TCPListener and a UnixListener.
+            Defaults to a single TCPListener on (host, port).
+        max_frame_size (int, optional): The largest frame body accepted; a client sending a bigger one
+            is disconnected with PROTOCOL_ERR. Defaults to MAX_FRAME_SIZE.
+        recorder (TrafficRecorder, optional): Captures every frame clients send, for replay. Defaults to None.
     """
     def __init__(self,
-        host: str = socket.gethostbyname(socket.gethostname()),
+        host: str = None,
         port: int = 5050,
         encoding: str = ENCODING,
         header_length: int = HEADER_SIZE,
+        admission: AdmissionController = None,
+        listeners: list = None,
+        max_frame_size: int = MAX_FRAME_SIZE,
+        recorder=None,
     ):
         self.host = host
         self.port = port
         self.encoding = encoding
         self.header_length = header_length
         self.addr = (self.host, self.port)
+        self.admission = admission or AdmissionController()
         
         self.clients_lock = threading.Lock()
         self.clients = []
 
+        # Responses and pushes from other handler threads share a connection,
+        # each frame is written under that connection's lock
+        self.send_locks = weakref.WeakKeyDictionary()
+        self.send_locks_lock = threading.Lock()
+
         self.requests = {}
+        # Operations whose requests arrive as chunked frames, see handle_chunk
+        self.chunked_requests = {}
+        # The answer to a transfer that failed before its last chunk arrived
+        self.failed_transfers = weakref.WeakKeyDictionary()
+        self.max_frame_size = max_frame_size
+        self.recorder = recorder
+        # Handlers run through the profiler, which operators switch on with ADMIN requests
+        self.profiler = Profiler()
+
+        # Listeners are only bound in open_listeners(), once the server starts
+        self.listeners = listeners or [TCPListener(self.host, self.port)]
 
-        # Create a new server socket instance and bind it to the specified host and port
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server.bind((self.host, self.port))
+        # A pipe that becomes readable when a handoff starts, see await_frame. None unless
+        # handoffs are enabled, so handler threads block in recv() as usual
+        self.handoff_wakeup = None
+        self.handing_off = threading.Event()
+        # The connections whose handler threads stopped at a frame boundary for a handoff
+        self.parked = set()
+
+    def open_listeners(self):
+        """
+        Bind and start listening on every configured listener not open yet, so each is bound once
+        however often this is called.
+        """
+        for listener in self.listeners:
+            if listener.sock:
+                continue
+            listener.open(self.admission.backlog)
+            logging.info(f"[LISTENING] Server is listening on {listener.describe()}")
+
+    def close_listeners(self):
+        """
+        Close every configured listener.
+        """
+        for listener in self.listeners:
+            listener.close()
 
     def start_logger(self):
         """
         Start the logger for the server.
         """
-        logging.basicConfig(level=logging.INFO,
-        handlers=[
-                logging.FileHandler("debug.log"),
-                logging.StreamHandler()
-            ]
-        )
+        configure_logging()
 
     def broadcast(self, message):
         with self.clients_lock:
             for client in self.clients:
                 client.send(message)
 
+    def serve_client(self, listener, conn, addr):
+        """
+        Finish setting up a newly accepted connection, see Listener.establish, then serve it.
+        A client that fails its handshake is dropped without affecting anyone else.
+
+        Parameters:
+            listener (Listener): The listener the connection was accepted on.
+            conn (socket.socket): The accepted connection, already in `clients`.
+            addr (tuple): The address of the client.
+        """
+        try:
+            established = listener.establish(conn)
+        except (OSError, ValueError) as e:
+            logging.warning(f"[HANDSHAKE] {addr}: {e!r}")
+            conn.close()
+            with self.clients_lock:
+                if conn in self.clients:
+                    self.clients.remove(conn)
+            self.admission.release_connection()
+            return
+        if established is not conn:
+            with self.clients_lock:
+                self.clients[self.clients.index(conn)] = established
+        self.handle_client(established, addr)
+
     def handle_client(self, conn: socket.socket, addr: tuple):
         """
         A function to handle a single client connection.
@@ -71,29 +163,173 @@ class BaseServer:
             addr (tuple): The address of the client in the form (host, port).
         """
         logging.info(f"[NEW CONNECTION] {addr} connected.")
+        connection_id = self.recorder.connection_id() if self.recorder else None
         connected = True
         while connected:
             try:
+                if self.handoff_wakeup and not self.await_frame(conn):
+                    # Left between two frames for the process taking the server over, which
+                    # reads the next one; the connection stays open and keeps its admission slot
+                    with self.clients_lock:
+                        self.parked.add(conn)
+                    return
                 header = self.receive_message(conn, self.header_length)
-                if header:
-                    version, msg_length, operation = WireProtocol.decode_header(header)
-                    msg = self.receive_message(conn, msg_length).decode(self.encoding)
-                    metadata = self.handle_request(conn, operation, msg)
-
-                    logging.info(f"[{addr}] {metadata}")
-                    connected = metadata["server_running"]
-                    if not connected:
-                        break
+                if not header:
+                    # The client closed its end of the connection
+                    logging.info(f"[DISCONNECT] {addr} closed the connection")
+                    self.disconnect(conn)
+                    break
+                version, msg_length, operation = WireProtocol.decode_header(header)
+                if msg_length > self.max_frame_size:
+                    raise ProtocolError(f"Frame of {msg_length} bytes is larger than {self.max_frame_size}")
+                if version == CHUNKED_VERSION:
+                    if msg_length < CHUNK_HEADER_SIZE:
+                        raise ProtocolError("Chunked frame without a chunk header")
+                    chunk_header = self.receive_message(conn, CHUNK_HEADER_SIZE)
+                    index, more = WireProtocol.decode_chunk_header(chunk_header)
+                    # Chunks are binary and handed over undecoded
+                    payload = self.receive_message(conn, msg_length - CHUNK_HEADER_SIZE)
+                    if self.recorder and operation not in UNRECORDED:
+                        self.recorder.record(connection_id, version, operation, chunk_header + payload)
+                    metadata = self.handle_chunk(conn, operation, index, more, payload)
+                    if metadata is None:
+                        # Only the last chunk of a transfer is answered
+                        continue
+                else:
+                    body = self.receive_message(conn, msg_length)
+                    if self.recorder and operation not in UNRECORDED:
+                        self.recorder.record(connection_id, version, operation, body)
+                    metadata = self.handle_request(conn, operation, body.decode(self.encoding))
+
+                logging.info(f"[{addr}] {metadata}")
+                connected = metadata["server_running"]
+                if not connected:
+                    break
+                # Handlers for fire-and-forget requests return no message
+                if metadata["message"] is not None:
                     self.send_message(conn, metadata['status'],  metadata["message"])
             except (OSError, BrokenPipeError, ConnectionResetError):
                 # This means the client has disconnected
                 logging.error(f"[DISCONNECT] {addr} disconnected unexpectedly")
                 break
+            except ProtocolError as e:
+                # We cannot find the next frame boundary, so the connection is unusable
+                logging.warning(f"[PROTOCOL ERROR] {addr}: {e}")
+                try:
+                    self.send_message(conn, Responses.PROTOCOL_ERR, str(e))
+                except OSError:
+                    pass
+                self.disconnect(conn)
+                break
             except Exception as e:
                 logging.exception(e)
                 self.disconnect(conn)
                 break
+        self.admission.release_connection()
 
+    def await_frame(self, conn):
+        """
+        Wait for the next frame from a client, without reading any of it, unless a handoff starts first.
+
+        Only called when handoffs are enabled. A frame already waiting costs one
+        non-blocking peek; otherwise the thread sleeps in poll() on the connection
+        and the handoff wakeup pipe.
+
+        Parameters:
+            conn (socket.socket): The client socket connection.
+
+        Returns:
+            bool: True if a frame (or the end of the connection) is waiting, False if the handler
+                should stop here for a handoff.
+        """
+        while True:
+            handing_off = self.handing_off.is_set()
+            if handing_off and self.can_hand_off(conn):
+                return False
+            if not isinstance(conn, socket.socket):
+                # Shared memory connections cannot be passed to another process
+                return True
+            try:
+                conn.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+                return True
+            except BlockingIOError:
+                pass
+            poller = select.poll()
+            poller.register(conn, select.POLLIN)
+            if not handing_off:
+                poller.register(self.handoff_wakeup[0], select.POLLIN)
+            poller.poll()
+
+    def can_hand_off(self, conn):
+        """
+        Whether a connection is at a point where another process can carry on serving it,
+        e.g. not in the middle of a chunked transfer.
+        """
+        return conn not in self.failed_transfers
+
+    def quiesce(self, timeout):
+        """
+        Stop every handler thread at its next frame boundary, for a handoff.
+        Must be called from the thread that accepts connections, so no new ones arrive meanwhile.
+
+        Parameters:
+            timeout (float): Seconds to wait for busy connections, e.g. ones part way through a transfer.
+
+        Returns:
+            list: The connections that did not stop in time, or cannot be handed off at all.
+        """
+        self.handing_off.set()
+        os.write(self.handoff_wakeup[1], b"\0")
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.clients_lock:
+                busy = [conn for conn in self.clients if conn not in self.parked]
+            if not any(isinstance(conn, socket.socket) for conn in busy) or time.monotonic() >= deadline:
+                return busy
+            time.sleep(0.01)
+
+    def unquiesce(self):
+        """
+        Serve the parked connections again, after a handoff that did not go through.
+        """
+        self.handing_off.clear()
+        os.read(self.handoff_wakeup[0], 1)
+        with self.clients_lock:
+            parked, self.parked = self.parked, set()
+        for conn in parked:
+            threading.Thread(target=self.handle_client, args=(conn, peer_address(conn))).start()
+
+    def reject_connection(self, conn, addr, retry_after, reason):
+        """
+        Turn away a connection the server has no capacity for.
+        The client receives an OVERLOADED response carrying a retry-after hint.
+
+        Parameters:
+            conn (socket.socket): The client socket connection.
+            addr (tuple): The address of the client in the form (host, port).
+            retry_after (float): Seconds the client should wait before reconnecting.
+            reason (str): Why the connection was rejected.
+        """
+        logging.warning(f"[REJECTED] {addr}: {reason}")
+        try:
+            self.send_message(conn, Responses.OVERLOADED, format_retry_after(retry_after, reason))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def reject_client(self, listener, conn, addr, retry_after, reason):
+        """
+        Finish the handshake of a connection accepted on a handshaking listener, then reject it,
+        see reject_connection.
+        """
+        try:
+            conn = listener.establish(conn)
+        except (OSError, ValueError) as e:
+            logging.warning(f"[HANDSHAKE] {addr}: {e!r}")
+            conn.close()
+            return
+        self.reject_connection(conn, addr, retry_after, reason)
 
     def receive_message(self, conn, length):
         """
@@ -104,9 +340,9 @@ class BaseServer:
             length (int): The length of the message to receive.
 
         Returns:
-            str: The received message.
+            bytes: The received message. Shorter than `length` only if the client disconnected.
         """
-        return conn.recv(length)
+        return recv_exact(conn, length)
 
     def send_message(self, conn, response_code, message):
         """
@@ -114,11 +350,85 @@ class BaseServer:
 
         Parameters:
             conn (socket.socket): The client socket connection.
+            response_code (int): The response code of the frame.
             message (str): The message to send.
         """
         header, encoded = WireProtocol.encode(version=1, operation=response_code, msg=message)
-        conn.send(header)
-        conn.send(encoded)
+        with self.send_lock(conn):
+            conn.sendall(header + encoded)
+
+    def send_messages(self, conn, response_code, messages):
+        """
+        Send several messages to a client connection in one write.
+
+        Parameters:
+            conn (socket.socket): The client socket connection.
+            response_code (int): The response code of every frame.
+            messages (list): The messages to send, one frame each.
+        """
+        frames = []
+        for message in messages:
+            header, encoded = WireProtocol.encode(version=1, operation=response_code, msg=message)
+            frames += (header, encoded)
+        with self.send_lock(conn):
+            conn.sendall(b"".join(frames))
+
+    def send_file(self, conn, response_code, first, path, size):
+        """
+        Send a file to a client as chunked frames, without reading it into memory.
+
+        The connection's send lock is held for one chunk at a time, so pushes to
+        the same client are interleaved with a large file instead of waiting for it.
+        TCP and Unix sockets get the file with sendfile(); other connections, such
+        as shared memory ones, from an mmap of it.
+
+        Parameters:
+            conn (socket.socket): The client socket connection.
+            response_code (int): The response code of every frame.
+            first (str): The body of chunk 0, describing the file.
+            path (str): The file to send.
+            size (int): The number of bytes to send.
+        """
+        encoded = first.encode(self.encoding)
+        with self.send_lock(conn):
+            conn.sendall(WireProtocol.chunk_header(response_code, 0, len(encoded), size > 0) + encoded)
+        if not size:
+            return
+        with open(path, "rb") as f:
+            view = None
+            if not isinstance(conn, socket.socket):
+                mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                view = memoryview(mapped)
+            try:
+                for index, offset in enumerate(range(0, size, CHUNK_SIZE), start=1):
+                    length = min(CHUNK_SIZE, size - offset)
+                    header = WireProtocol.chunk_header(response_code, index, length, offset + length < size)
+                    with self.send_lock(conn):
+                        conn.sendall(header)
+                        if view is None:
+                            conn.sendfile(f, offset, length)
+                        else:
+                            conn.sendall(view[offset:offset + length])
+            finally:
+                if view is not None:
+                    view.release()
+                    mapped.close()
+
+    def send_lock(self, conn):
+        """
+        Get the lock that serializes frames written to a connection.
+
+        Parameters:
+            conn (socket.socket): The client socket connection.
+
+        Returns:
+            threading.Lock: The connection's send lock.
+        """
+        lock = self.send_locks.get(conn)
+        if lock is None:
+            with self.send_locks_lock:
+                lock = self.send_locks.setdefault(conn, threading.Lock())
+        return lock
 
     def handle_request(self, conn, op, msg):
         """
@@ -131,15 +441,77 @@ class BaseServer:
         Returns:
             dict: The response metadata in the form of a dictionary.
         """
+        retry_after = self.admission.begin_request(op)
+        if retry_after is not None:
+            return self.generate_payload(Responses.OVERLOADED, True,
+                format_retry_after(retry_after, "Server is overloaded, request shed"))
+        started = time.monotonic()
         try:
             handler = self.requests.get(op)
             if handler:
-                return handler(conn, msg)
+                return self.profiler.call(handler, conn, msg)
             else:
                 return self.generate_payload(Responses.FAILURE, True, "Unrecognized Response")
         except Exception as e:
             logging.exception(e)
+        finally:
+            self.admission.end_request(time.monotonic() - started)
     
+    def handle_chunk(self, conn, op, index, more, payload):
+        """
+        Handle one chunk of a chunked request from a client.
+
+        Chunk handlers are called as handler(conn, index, more, payload) and
+        return None until they have an answer. A transfer gets exactly one
+        response, after its last chunk, however many chunks it has: if it fails
+        earlier, the answer is held back and the remaining chunks are dropped,
+        so a pipelining client can still match responses to requests in order.
+        Admission control applies to the first chunk.
+
+        Parameters:
+            conn (socket.socket): The client socket connection.
+            op (int): The operation code.
+            index (int): The chunk's position within the transfer.
+            more (bool): Whether more chunks follow.
+            payload (bytes): The chunk's payload.
+
+        Returns:
+            dict: The response metadata in the form of a dictionary, or None if there is nothing to send yet.
+        """
+        if index == 0:
+            self.failed_transfers.pop(conn, None)
+            metadata = self._start_transfer(conn, op, more, payload)
+        elif conn in self.failed_transfers:
+            metadata = None
+        else:
+            try:
+                metadata = self.profiler.call(self.chunked_requests[op], conn, index, more, payload)
+            except Exception as e:
+                logging.exception(e)
+                metadata = self.generate_payload(Responses.FAILURE, True, "Transfer failed.")
+        if more:
+            if metadata is not None:
+                self.failed_transfers[conn] = metadata
+            return None
+        return self.failed_transfers.pop(conn, metadata)
+
+    def _start_transfer(self, conn, op, more, payload):
+        handler = self.chunked_requests.get(op)
+        if handler is None:
+            return self.generate_payload(Responses.FAILURE, True, "Unrecognized Response")
+        retry_after = self.admission.begin_request(op)
+        if retry_after is not None:
+            return self.generate_payload(Responses.OVERLOADED, True,
+                format_retry_after(retry_after, "Server is overloaded, request shed"))
+        started = time.monotonic()
+        try:
+            return self.profiler.call(handler, conn, 0, more, payload)
+        except Exception as e:
+            logging.exception(e)
+            return self.generate_payload(Responses.FAILURE, True, "Transfer failed.")
+        finally:
+            self.admission.end_request(time.monotonic() - started)
+
     def disconnect(self, conn, msg=""):
         """
         Handle a disconnect request from a client.
@@ -0,0 +1,373 @@
+import argparse
+import gc
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import signal
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The storage engine lives in the repository root, shared with the gRPC server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from chatstore import MemoryChatStore
+from codes import Requests
+from protocol import WireProtocol, VERSION, HEADER_SIZE
+from server import Server
+from shm_transport import ShmListener, shm_connect
+from transport import UnixListener, connect, recv_exact
+
+# Registry sizes the account benchmarks run at
+SIZES = (10_000, 100_000, 1_000_000)
+
+# Messages in the mailbox each drain empties
+MAILBOX_SIZE = 1000
+
+# Requests sent before reading any response in the pipelined transport benchmarks
+PIPELINE_DEPTH = 64
+
+
+class Benchmark:
+    """
+    One operation to time.
+
+    Parameters:
+        name (str): Identifies the results in a baseline.
+        run (callable): The operation, called with no arguments.
+        setup (callable, optional): Called before every run, untimed, e.g. to refill what run consumes.
+    """
+    def __init__(self, name, run, setup=None):
+        self.name = name
+        self.run = run
+        self.setup = setup
+
+    def ops_per_sec(self, min_time, repeat):
+        """
+        Time the operation in batches lasting at least min_time, and keep the fastest batch,
+        which is the one least disturbed by the rest of the machine.
+
+        Returns:
+        float: Operations per second.
+        """
+        best = None
+        number = self._calibrate(min_time)
+        for _ in range(repeat):
+            elapsed = self._time(number)
+            best = elapsed if best is None else min(best, elapsed)
+        return number / best
+
+    def _calibrate(self, min_time):
+        number = 1
+        while True:
+            elapsed = self._time(number)
+            if elapsed >= min_time:
+                return number
+            # Aim a little past min_time, without growing more than tenfold at once
+            number = max(number + 1, int(number * min(10, 1.2 * min_time / max(elapsed, 1e-9))))
+
+    def _time(self, number):
+        run, setup = self.run, self.setup
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            if setup is None:
+                started = time.perf_counter()
+                for _ in range(number):
+                    run()
+                return time.perf_counter() - started
+            elapsed = 0.0
+            for _ in range(number):
+                setup()
+                started = time.perf_counter()
+                run()
+                elapsed += time.perf_counter() - started
+            return elapsed
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def allocations(self, samples):
+        """
+        Trace the memory the operation allocates.
+
+        Returns:
+        tuple: The most bytes allocated at once during a single run, above what was in use before
+            it, and the memory blocks a run leaves allocated, averaged over the samples.
+        """
+        peaks = []
+        tracemalloc.start()
+        try:
+            blocks_before = None
+            for _ in range(samples):
+                if self.setup:
+                    self.setup()
+                if blocks_before is None:
+                    blocks_before = traced_blocks()
+                current, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                self.run()
+                _, peak = tracemalloc.get_traced_memory()
+                peaks.append(peak - current)
+            retained = traced_blocks() - blocks_before
+        finally:
+            tracemalloc.stop()
+        peaks.sort()
+        return peaks[len(peaks) // 2], max(0.0, retained / samples)
+
+
+def traced_blocks():
+    return sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+
+
+def make_server(accounts=0):
+    """
+    Returns:
+    Server: A server that is never started, with `accounts` users named user0, user1, ...
+    """
+    server = Server("127.0.0.1", 0, store=MemoryChatStore())
+    for i in range(accounts):
+        server.store.create_account(f"user{i}")
+    return server
+
+
+def framing_benchmarks():
+    header = WireProtocol.get_header(VERSION, 42, Requests.SEND_MESSAGE)
+    body = "alice\nbob\n" + "hello " * 20
+    push = WireProtocol.encode_push("bob", 12345, "<alice>: hello")
+    return [
+        Benchmark("framing.get_header", lambda: WireProtocol.get_header(VERSION, 42, Requests.SEND_MESSAGE)),
+        Benchmark("framing.encode", lambda: WireProtocol.encode(VERSION, Requests.SEND_MESSAGE, body)),
+        Benchmark("framing.decode_header", lambda: WireProtocol.decode_header(header)),
+        Benchmark("framing.encode_push", lambda: WireProtocol.encode_push("bob", 12345, "<alice>: hello")),
+        Benchmark("framing.decode_push", lambda: WireProtocol.decode_push(push)),
+    ]
+
+
+def parsing_benchmarks():
+    frame = b"".join(WireProtocol.encode(VERSION, Requests.SEND_MESSAGE, "alice\nbob\n" + "hello " * 20))
+
+    def parse_frame():
+        version, size, operation = WireProtocol.decode_header(frame[:HEADER_SIZE])
+        sender, receiver, text = frame[HEADER_SIZE:HEADER_SIZE + size].decode("utf-8").split("\n")
+        return sender.strip(), receiver.strip(), text.strip()
+
+    return [Benchmark("parsing.send_message_frame", parse_frame)]
+
+
+def dispatch_benchmarks():
+    server = make_server(2)
+    send = "user0\nuser1\nhello"
+    return [
+        # An unknown operation only goes through admission control and the handler table
+        Benchmark("dispatch.unknown_op", lambda: server.handle_request(None, 99, "")),
+        # ACK for a user with no session does no work in the handler
+        Benchmark("dispatch.ack", lambda: server.handle_request(None, Requests.ACK, "user0\n1")),
+        Benchmark("dispatch.send_message", lambda: server.handle_request(None, Requests.SEND_MESSAGE, send),
+            setup=lambda: server.store.drain("user1")),
+    ]
+
+
+def registry_benchmarks(sizes, wanted):
+    """
+    Yields the account benchmarks one registry size at a time, so only one registry is in memory at once.
+    A registry is only built if `wanted` accepts one of its benchmark names.
+    """
+    names = ("registry.exists_hit", "registry.exists_miss", "list_accounts.exact",
+             "list_accounts.prefix", "list_accounts.infix", "list_accounts.all")
+    for size in sizes:
+        if not any(wanted(f"{name}.{size}") for name in names):
+            continue
+        server = make_server(size)
+        store = server.store
+        present, absent = f"user{size // 2}", f"nobody{size // 2}"
+        prefix = f"user{size // 1000}*"
+        infix = f"*ser{size // 1000}*"
+        yield from [
+            Benchmark(f"registry.exists_hit.{size}", lambda store=store, u=present: store.exists(u)),
+            Benchmark(f"registry.exists_miss.{size}", lambda store=store, u=absent: store.exists(u)),
+            Benchmark(f"list_accounts.exact.{size}",
+                lambda server=server, q=present: server.handle_list_accounts(None, q)),
+            Benchmark(f"list_accounts.prefix.{size}",
+                lambda server=server, q=prefix: server.handle_list_accounts(None, q)),
+            Benchmark(f"list_accounts.infix.{size}",
+                lambda server=server, q=infix: server.handle_list_accounts(None, q)),
+            Benchmark(f"list_accounts.all.{size}",
+                lambda server=server: server.handle_list_accounts(None, "*")),
+        ]
+
+
+def mailbox_benchmarks():
+    server = make_server(2)
+    conn = object()
+    server.active_connections["user1"] = conn
+    store = server.store
+
+    def fill():
+        for i in range(MAILBOX_SIZE):
+            store.enqueue("user1", "user0", f"message {i}")
+
+    return [
+        Benchmark(f"mailbox.drain.{MAILBOX_SIZE}", lambda: store.drain("user1"), setup=fill),
+        Benchmark(f"mailbox.view_messages.{MAILBOX_SIZE}",
+            lambda: server.handle_view_messages(conn, "user1"), setup=fill),
+    ]
+
+
+def serve_listeners(listeners, ready):
+    """
+    Run a server on `listeners` in a process of its own, until it gets SIGINT.
+    """
+    server = Server("127.0.0.1", 0, listeners=listeners, store=MemoryChatStore())
+    server.start_logger = lambda: None
+    server.open_listeners()
+    ready.set()
+    server.start()
+
+
+def transport_benchmarks(wanted):
+    """
+    Yields request/response benchmarks over a Unix socket and over shared memory, against a server
+    in another process, as clients on the same machine would use them. A round trip sends one
+    request and waits for its response; a pipelined batch sends PIPELINE_DEPTH before reading any.
+    The server is only started if `wanted` accepts one of the benchmark names.
+    """
+    names = [f"transport.{kind}.{name}" for kind in ("roundtrip", "pipelined") for name in ("uds", "shm")]
+    if not any(map(wanted, names)):
+        return
+    directory = tempfile.mkdtemp(prefix="bench-")
+    uds_path, shm_path = os.path.join(directory, "chat.sock"), os.path.join(directory, "chat.shm")
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=serve_listeners,
+                                      args=([UnixListener(uds_path), ShmListener(shm_path)], ready), daemon=True)
+    process.start()
+    ready.wait()
+    conns = {"uds": connect(path=uds_path), "shm": shm_connect(shm_path)}
+    # Looking up an account that does not exist, so the server's time goes to the transport
+    request = b"".join(WireProtocol.encode(VERSION, Requests.LIST_ACCOUNTS, "nobody"))
+    batch = request * PIPELINE_DEPTH
+
+    def receive(conn, count):
+        for _ in range(count):
+            _, size, _ = WireProtocol.decode_header(recv_exact(conn, HEADER_SIZE))
+            recv_exact(conn, size)
+
+    def roundtrip(conn):
+        conn.sendall(request)
+        receive(conn, 1)
+
+    def pipelined(conn):
+        conn.sendall(batch)
+        receive(conn, PIPELINE_DEPTH)
+
+    try:
+        for name, conn in conns.items():
+            yield Benchmark(f"transport.roundtrip.{name}", lambda conn=conn: roundtrip(conn))
+        for name, conn in conns.items():
+            yield Benchmark(f"transport.pipelined.{name}", lambda conn=conn: pipelined(conn))
+    finally:
+        for conn in conns.values():
+            conn.close()
+        os.kill(process.pid, signal.SIGINT)
+        process.join()
+        for path in (uds_path, shm_path):
+            if os.path.exists(path):
+                os.unlink(path)
+        os.rmdir(directory)
+
+
+def collect(sizes, wanted):
+    """
+    Yields the benchmarks whose name `wanted` accepts.
+    """
+    for benchmark in itertools.chain(framing_benchmarks(), parsing_benchmarks(), dispatch_benchmarks(),
+                                     registry_benchmarks(sizes, wanted), mailbox_benchmarks(),
+                                     transport_benchmarks(wanted)):
+        if wanted(benchmark.name):
+            yield benchmark
+
+
+def run(benchmarks, min_time, repeat, samples):
+    """
+    Parameters:
+    benchmarks (iterable): The benchmarks to run, in order.
+    min_time (float): Seconds each timed batch lasts at least.
+    repeat (int): Timed batches per benchmark.
+    samples (int): Runs traced for allocations.
+
+    Returns:
+    dict: Each benchmark's name mapped to its ops_per_sec, peak_bytes and retained_blocks.
+    """
+    results = {}
+    for benchmark in benchmarks:
+        ops = benchmark.ops_per_sec(min_time, repeat)
+        peak, retained = benchmark.allocations(samples)
+        results[benchmark.name] = {"ops_per_sec": ops, "peak_bytes": peak, "retained_blocks": retained}
+        print(f"{benchmark.name:<36} {ops:>14,.0f} ops/s {peak:>12,} B peak {retained:>8.2f} blocks kept", flush=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Find the benchmarks that got slower, or allocate more, than their baseline allows.
+
+    Parameters:
+    results (dict): This run's results, from run().
+    baseline (dict): The saved results to compare against.
+    threshold (float): The relative change tolerated, e.g. 0.1 for 10%.
+
+    Returns:
+    list: A description of each regression.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["ops_per_sec"] < before["ops_per_sec"] * (1 - threshold):
+            regressions.append(f"{name}: {result['ops_per_sec']:,.0f} ops/s, "
+                               f"was {before['ops_per_sec']:,.0f} ({result['ops_per_sec'] / before['ops_per_sec'] - 1:+.0%})")
+        # A few bytes either way is noise from the interpreter's own bookkeeping
+        if result["peak_bytes"] > before["peak_bytes"] * (1 + threshold) + 64:
+            regressions.append(f"{name}: {result['peak_bytes']:,} B peak, was {before['peak_bytes']:,}")
+        if result["retained_blocks"] > before["retained_blocks"] * (1 + threshold) + 1:
+            regressions.append(f"{name}: {result['retained_blocks']:.2f} blocks kept per op, "
+                               f"was {before['retained_blocks']:.2f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the wire protocol and server hot paths")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="comma-separated registry sizes")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds each timed batch lasts at least")
+    parser.add_argument("--repeat", type=int, default=5, help="timed batches per benchmark, the fastest counts")
+    parser.add_argument("--samples", type=int, default=20, help="runs traced for allocations")
+    parser.add_argument("--save", help="write the results to this JSON baseline")
+    parser.add_argument("--compare", help="compare against this JSON baseline and exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    benchmarks = collect(sizes, lambda name: args.filter in name)
+    results = run(benchmarks, args.min_time, args.repeat, args.samples)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.compare}")
@@ -1,10 +1,19 @@
+import os
 import socket
 import logging
 import threading
 import time
 import sys
+
+# The account cache lives in the repository root, shared with the gRPC client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from chatstore import AccountCache
 from codes import Requests, Responses
-from protocol import WireProtocol, VERSION, HEADER_SIZE, ENCODING
+from protocol import WireProtocol, VERSION, HEADER_SIZE, ENCODING, CHUNKED_VERSION, CHUNK_HEADER_SIZE
+from admission import parse_retry_after
+from transport import connect, recv_exact
+from shm_transport import shm_connect
 
 
 def get_lock_decorator(func):
@@ -24,33 +33,61 @@ def get_lock_decorator(func):
 
 
 class Client:
-    def __init__(self, host, port=5050, header_length=HEADER_SIZE, encoding=ENCODING):
+    def __init__(self, host=None, port=5050, header_length=HEADER_SIZE, encoding=ENCODING, path=None, shm=False,
+                 deliver_backlog=False, cache_accounts=False):
         """
         Initializes a Client object and connects it to the server.
 
         Parameters:
-        host (str): The IP address of the server to connect to.
+        host (str, optional): The IP address of the server to connect to. Defaults to this machine's address.
         port (int): The port number to use for the connection.
         header_length (int): The length of the message header.
         encoding (str): The character encoding to use for message encoding/decoding.
+        path (str, optional): Path of the server's Unix domain socket. If given, it is used instead of host and port.
+        shm (bool, optional): Treat `path` as a ShmListener and exchange frames through shared memory. Defaults to False.
+        deliver_backlog (bool, optional): Have messages queued while offline pushed at login instead of
+            fetched with view_messages. Defaults to False.
+        cache_accounts (bool, optional): Answer list_accounts from a cache the server keeps up to date
+            where possible. Defaults to False.
         """
         self.host = host
         self.port = port
+        self.path = path
         self.header_length = header_length
         self.encoding = encoding
-        self.addr = (host, port)
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.deliver_backlog = deliver_backlog
+        self.addr = path or (host, port)
         self.lock = threading.Lock()
+        self.send_lock = threading.Lock()  # Requests and push acknowledgements may be sent from different threads
         self.receive_flag = True  # Indicates if background thread should be listening
         try:
-            self.client.connect(self.addr)
-        except ConnectionRefusedError:
+            if shm:
+                self.client = shm_connect(path)
+            else:
+                self.client = connect(host, port, path=path)
+        except (ConnectionRefusedError, FileNotFoundError):
             print("Server is off.")
             sys.exit(0)
         self._start_logger()
         self.isLoggedIn = False
         self.username = None
+        self.session_token = None
+        self.accounts = None
         self.listen_for_messages()
+        if cache_accounts:
+            self._watch_accounts()
+
+    def _watch_accounts(self):
+        """
+        Have the server push account changes, and start answering list_accounts from the account cache.
+        """
+        status, message = self.send_message(Requests.WATCH_ACCOUNTS, "")
+        if status != Responses.SUCCESS:
+            logging.warning(f"[ACCOUNT CACHE] Not caching accounts: {message}")
+            return
+        epoch, _, version = message.partition(":")
+        self.accounts = AccountCache()
+        self.accounts.watching(epoch, int(version))
 
     def _start_logger(self):
         """
@@ -62,20 +99,30 @@ class Client:
     def _receive_ack(self):
         """
         Receives an acknowledgment message from the server.
+        Chat messages pushed to us while waiting for the acknowledgment are displayed as they arrive.
 
         Returns:
         operation (int): The operation type of the message.
         message (str): The message content.
         """
         try:
-            message_header = self.client.recv(self.header_length)
-            if not len(message_header):
-                print("[DISCONNECTED] You have been disconnected from the server.")
-                self.client.close()
-                sys.exit(0)
-            else:
+            while True:
+                message_header = recv_exact(self.client, self.header_length)
+                if not len(message_header):
+                    print("[DISCONNECTED] You have been disconnected from the server.")
+                    self.client.close()
+                    sys.exit(0)
                 version, size, operation = WireProtocol.decode_header(message_header)
-                message = self.client.recv(size).decode(self.encoding)
+                message = recv_exact(self.client, size).decode(self.encoding)
+                if operation == Responses.MESSAGE:
+                    self._display_push(message)
+                    continue
+                if operation == Responses.PRESENCE:
+                    self._display_presence(message)
+                    continue
+                if operation == Responses.ACCOUNTS_CHANGED:
+                    self._apply_account_changes(message)
+                    continue
                 return operation, message
         except Exception as e:
             logging.exception(e)
@@ -98,9 +145,8 @@ class Client:
         """
         try:
             header, encoded = WireProtocol.encode(version=VERSION, operation=op, msg=msg)
-            self.client.send(header)
-            time.sleep(0.1)
-            self.client.send(encoded)
+            with self.send_lock:
+                self.client.sendall(header + encoded)
             return self._receive_ack()
         except (BrokenPipeError, OSError) as e:
             logging.error(f"Failed to send message: {e}")
@@ -128,11 +174,12 @@ class Client:
         """
         try:
             # Send the login request to the server.
-            status, message = self.send_message(op=Requests.LOGIN, msg=username)
+            status, message = self.send_message(op=Requests.LOGIN, msg=f"{username}\ndeliver" if self.deliver_backlog else username)
             if status == Responses.SUCCESS:
                 # If the login was successful, set the instance variables and log the success.
                 self.isLoggedIn = True
                 self.username = username
+                self.session_token = message.partition("\n")[2]
                 logging.info(f"[LOGIN] User {username} has successfully logged in")
                 print(f"[LOGIN] User {username} has successfully logged in")
                 return True
@@ -161,6 +208,8 @@ class Client:
             # Send the create account request to the server.
             status, message = self.send_message(Requests.CREATE_ACCOUNT, username)
             if status == Responses.SUCCESS:
+                if self.accounts is not None:
+                    self.accounts.note(True, username)
                 # If the account was created successfully, log the success and return True.
                 logging.info(f"[ACCOUNT CREATION] Account created successfully for username: {username}")
                 print(f"[ACCOUNT CREATION] Account created successfully for username: {username}")
@@ -187,6 +236,8 @@ class Client:
         try:
             status, message = self.send_message(Requests.DELETE_ACCOUNT, username)
             if status == Responses.SUCCESS:
+                if self.accounts is not None:
+                    self.accounts.note(False, username)
                 logging.info(f"[DELETE ACCOUNT] Account {username} deleted")
                 print(f"[DELETE ACCOUNT] Account {username} deleted")
                 return True
@@ -208,7 +259,10 @@ class Client:
         bool: True if the list of accounts is successfully retrieved, False otherwise.
         """
         try:
-            status, message = self.send_message(Requests.LIST_ACCOUNTS, pattern)
+            if self.accounts is not None:
+                status, message = self._list_accounts_cached(pattern)
+            else:
+                status, message = self.send_message(Requests.LIST_ACCOUNTS, pattern)
             if status == Responses.SUCCESS:
                 logging.info(f"[LIST ACCOUNTS] Received list of accounts matching pattern {pattern}: {message}")
                 print(f"[LIST ACCOUNTS] Received list of accounts matching pattern {pattern}: {message}")
@@ -222,6 +276,26 @@ class Client:
             print(f"[LIST ACCOUNTS] Exception occurred while retrieving list of accounts matching pattern {pattern}: {e}")
             return False
 
+    def _list_accounts_cached(self, pattern):
+        """
+        List accounts from the account cache, asking the server for a versioned result on a miss.
+
+        Returns:
+        tuple: The status and message, as the server answers an unversioned LIST_ACCOUNTS.
+        """
+        names = self.accounts.search(pattern)
+        if names is None:
+            status, message = self.send_message(Requests.LIST_ACCOUNTS, f"{pattern}\nversioned")
+            if status != Responses.SUCCESS:
+                return status, message
+            stamp, *names = message.split("\n")
+            epoch, _, version = stamp.partition(":")
+            names = [name for name in names if name]
+            self.accounts.put_search(pattern, names, epoch, int(version))
+        if not names:
+            return Responses.FAILURE, "No matching accounts found."
+        return Responses.SUCCESS, "\n" + "\n".join(names)
+
     def send_chat(self, receiver: str, message: str):
         """Sends a message to another user on the server.
 
@@ -268,6 +342,244 @@ class Client:
             print(f"[VIEW MESSAGES] Exception occurred while viewing messages: {e}")
             return False
 
+    def view_history(self, peer: str, page_token: str = ""):
+        """
+        Print a page of the conversation with another user, oldest first.
+
+        Parameters:
+        peer (str): The other user.
+        page_token (str, optional): The token returned with the previous page. Defaults to the first page.
+
+        Returns:
+        str: The token for the next page, empty on the last page, or None if the request failed.
+        """
+        try:
+            if not self.isLoggedIn or not self.username:
+                logging.warning(f"[VIEW HISTORY] You must be logged in first.")
+                return None
+            status, message = self.send_message(Requests.HISTORY, f"{self.username}\n{peer}\n\n\n\n{page_token}")
+            if status == Responses.SUCCESS:
+                token, _, lines = message.partition("\n")
+                for line in lines.split("\n") if lines else []:
+                    ts, sender, text = line.split("\t", 2)
+                    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(float(ts)))}] <{sender}>: {text}")
+                return token
+            else:
+                logging.warning(f"[VIEW HISTORY] View history failed due to {message}")
+                print(f"[VIEW HISTORY] View history failed due to {message}")
+        except Exception as e:
+            logging.exception(f"[VIEW HISTORY] Exception occurred while viewing history: {e}")
+            print(f"[VIEW HISTORY] Exception occurred while viewing history: {e}")
+        return None
+
+    def search_messages(self, query: str):
+        """
+        Print the newest messages sent or received by the logged in user that contain every word of `query`.
+
+        Returns:
+        bool: Whether the search succeeded.
+        """
+        try:
+            if not self.isLoggedIn or not self.username:
+                logging.warning(f"[SEARCH MESSAGES] You must be logged in first.")
+                return False
+            status, message = self.send_message(Requests.SEARCH_MESSAGES, f"{self.username}\n{query}")
+            if status == Responses.SUCCESS:
+                _, _, lines = message.partition("\n")
+                if not lines:
+                    print("No matching messages found.")
+                for line in lines.split("\n") if lines else []:
+                    ts, sender, receiver, text = line.split("\t", 3)
+                    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(float(ts)))}] <{sender}> to <{receiver}>: {text}")
+                return True
+            else:
+                logging.warning(f"[SEARCH MESSAGES] Search failed due to {message}")
+                print(f"[SEARCH MESSAGES] Search failed due to {message}")
+        except Exception as e:
+            logging.exception(f"[SEARCH MESSAGES] Exception occurred while searching messages: {e}")
+            print(f"[SEARCH MESSAGES] Exception occurred while searching messages: {e}")
+        return False
+
+    def subscribe_presence(self, usernames):
+        """
+        Watch users come online and go offline. Their current status is printed, and changes as they happen.
+
+        Parameters:
+        usernames (list): The users to watch, replacing any watched before. An empty list stops watching.
+
+        Returns:
+        bool: Whether the subscription succeeded.
+        """
+        try:
+            if not self.isLoggedIn or not self.username:
+                logging.warning(f"[SUBSCRIBE PRESENCE] You must be logged in first.")
+                return False
+            status, message = self.send_message(Requests.SUBSCRIBE_PRESENCE, "\n".join([self.username, *usernames]))
+            if status == Responses.SUCCESS:
+                _, statuses = WireProtocol.decode_presence(message)
+                for name, online in statuses.items():
+                    print(f"{name} is {'online' if online else 'offline'}")
+                return True
+            else:
+                logging.warning(f"[SUBSCRIBE PRESENCE] Subscription failed due to {message}")
+                print(f"[SUBSCRIBE PRESENCE] Subscription failed due to {message}")
+        except Exception as e:
+            logging.exception(f"[SUBSCRIBE PRESENCE] Exception occurred while subscribing: {e}")
+            print(f"[SUBSCRIBE PRESENCE] Exception occurred while subscribing: {e}")
+        return False
+
+    @get_lock_decorator
+    def _send_chunks(self, frames):
+        """
+        Sends the frames of a chunked request and receives its response.
+        """
+        try:
+            for frame in frames:
+                with self.send_lock:
+                    self.client.sendall(frame)
+            return self._receive_ack()
+        except (BrokenPipeError, OSError) as e:
+            logging.error(f"Failed to send message: {e}")
+            self.stop_listening_for_messages()
+            self.client.close()
+            sys.exit(0)
+
+    @get_lock_decorator
+    def _receive_download(self, msg, directory):
+        """
+        Requests an attachment and writes its chunks to a file as they arrive.
+
+        Returns:
+        operation (int): The operation type of the response.
+        message (str): The path of the saved file on success, the response content otherwise.
+        """
+        header, encoded = WireProtocol.encode(version=VERSION, operation=Requests.DOWNLOAD_ATTACHMENT, msg=msg)
+        with self.send_lock:
+            self.client.sendall(header + encoded)
+        out = None
+        try:
+            while True:
+                message_header = recv_exact(self.client, self.header_length)
+                if not len(message_header):
+                    raise ConnectionError("Disconnected while downloading")
+                version, size, operation = WireProtocol.decode_header(message_header)
+                if version != CHUNKED_VERSION:
+                    message = recv_exact(self.client, size).decode(self.encoding)
+                    if operation == Responses.MESSAGE:
+                        self._display_push(message)
+                        continue
+                    if operation == Responses.PRESENCE:
+                        self._display_presence(message)
+                        continue
+                    if operation == Responses.ACCOUNTS_CHANGED:
+                        self._apply_account_changes(message)
+                        continue
+                    return operation, message
+                index, more = WireProtocol.decode_chunk_header(recv_exact(self.client, CHUNK_HEADER_SIZE))
+                payload = recv_exact(self.client, size - CHUNK_HEADER_SIZE)
+                if index == 0:
+                    filename, _ = payload.decode(self.encoding).split("\n")
+                    path = os.path.join(directory, os.path.basename(filename))
+                    out = open(path, "wb")
+                else:
+                    out.write(payload)
+                if not more:
+                    return operation, path
+        finally:
+            if out:
+                out.close()
+
+    def send_attachment(self, receiver: str, path: str):
+        """
+        Send a file to a user, in chunks so it is never held in memory at once.
+
+        Parameters:
+        receiver (str): The user to send the file to.
+        path (str): The file to send.
+
+        Returns:
+        str: The attachment's id, or None if sending failed.
+        """
+        try:
+            if not self.isLoggedIn or not self.username:
+                logging.warning(f"[SEND ATTACHMENT] You must be logged in first.")
+                return None
+            with open(path, "rb") as f:
+                first = f"{self.username}\n{receiver}\n{os.path.basename(path)}\n{os.fstat(f.fileno()).st_size}"
+                status, message = self._send_chunks(WireProtocol.encode_chunks(Requests.UPLOAD_ATTACHMENT, first, f))
+            if status == Responses.SUCCESS:
+                print(f"[SEND ATTACHMENT] Sent {path} to {receiver}, attachment {message}")
+                return message
+            else:
+                logging.warning(f"[SEND ATTACHMENT] Sending {path} failed due to {message}")
+                print(f"[SEND ATTACHMENT] Sending {path} failed due to {message}")
+        except Exception as e:
+            logging.exception(f"[SEND ATTACHMENT] Exception occurred while sending {path}: {e}")
+            print(f"[SEND ATTACHMENT] Exception occurred while sending {path}: {e}")
+        return None
+
+    def download_attachment(self, attachment_id: str, directory: str = "."):
+        """
+        Download an attachment sent to or by the logged in user.
+
+        Parameters:
+        attachment_id (str): The attachment's id.
+        directory (str, optional): Where to save it, under the name it was sent with. Defaults to ".".
+
+        Returns:
+        str: The path of the saved file, or None if the download failed.
+        """
+        try:
+            if not self.isLoggedIn or not self.username:
+                logging.warning(f"[DOWNLOAD ATTACHMENT] You must be logged in first.")
+                return None
+            status, message = self._receive_download(f"{self.username}\n{attachment_id}", directory)
+            if status == Responses.SUCCESS:
+                print(f"[DOWNLOAD ATTACHMENT] Saved {message}")
+                return message
+            else:
+                logging.warning(f"[DOWNLOAD ATTACHMENT] Download failed due to {message}")
+                print(f"[DOWNLOAD ATTACHMENT] Download failed due to {message}")
+        except Exception as e:
+            logging.exception(f"[DOWNLOAD ATTACHMENT] Exception occurred while downloading {attachment_id}: {e}")
+            print(f"[DOWNLOAD ATTACHMENT] Exception occurred while downloading {attachment_id}: {e}")
+        return None
+
+    def _display_push(self, body):
+        """
+        Display a chat message pushed by the server and acknowledge it.
+
+        Parameters:
+        body (str): The body of the MESSAGE push.
+        """
+        receiver, seq, text = WireProtocol.decode_push(body)
+        print(f"\r\n\n[RECEIVED MESSAGE]\n{text}\n\nEnter command: ", end="")
+        # The server sends no response to an acknowledgement
+        header, encoded = WireProtocol.encode(version=VERSION, operation=Requests.ACK, msg=f"{receiver}\n{seq}")
+        with self.send_lock:
+            self.client.sendall(header + encoded)
+
+    def _display_presence(self, body):
+        """
+        Display status changes pushed to us for the users we watch.
+
+        Parameters:
+        body (str): The body of the PRESENCE push.
+        """
+        _, statuses = WireProtocol.decode_presence(body)
+        lines = "\n".join(f"{name} is {'online' if online else 'offline'}" for name, online in statuses.items())
+        print(f"\r\n\n[PRESENCE]\n{lines}\n\nEnter command: ", end="")
+
+    def _apply_account_changes(self, body):
+        """
+        Bring the account cache up to date with account changes pushed by the server.
+
+        Parameters:
+        body (str): The body of the ACCOUNTS_CHANGED push.
+        """
+        if self.accounts is not None:
+            self.accounts.apply(*WireProtocol.decode_account_changes(body))
+
     def _receive_message(self):
         try:
             message_header = self.client.recv(self.header_length, socket.MSG_DONTWAIT)
@@ -277,8 +589,10 @@ class Client:
                 self.client.close()
                 sys.exit(0)
             else:
+                if len(message_header) < self.header_length:
+                    message_header += recv_exact(self.client, self.header_length - len(message_header))
                 version, size, operation = WireProtocol.decode_header(message_header)
-                message = self.client.recv(size).decode(self.encoding)
+                message = recv_exact(self.client, size).decode(self.encoding)
                 return operation, message
         except BlockingIOError as e:
             pass
@@ -326,8 +640,19 @@ class Client:
                                 self.stop_listening_for_messages()
                                 self.client.close()
                                 sys.exit(0)
-                            elif status == Responses.SUCCESS:
-                                print(f"\r\n\n[RECEIVED MESSAGE]{msg}\n\nEnter command: ", end="")
+                            elif status == Responses.MESSAGE:
+                                self._display_push(msg)
+                            elif status == Responses.PRESENCE:
+                                self._display_presence(msg)
+                            elif status == Responses.ACCOUNTS_CHANGED:
+                                self._apply_account_changes(msg)
+                            elif status == Responses.OVERLOADED:
+                                retry_after = parse_retry_after(msg)
+                                logging.warning(f"[OVERLOADED] Server rejected the connection, retry after {retry_after}s")
+                                print(f"Server is overloaded. Try again in {retry_after} seconds.")
+                                self.stop_listening_for_messages()
+                                self.client.close()
+                                sys.exit(0)
                             else:
                                 logging.warning("[RECEIVED UNKNOWN SIGNAL] Disconnecting")
                                 self.stop_listening_for_messages()
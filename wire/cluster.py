@@ -0,0 +1,570 @@
+import bisect
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import logging
+import queue
+import select
+import os
+import sys
+import threading
+
+# The stores live in the repository root, shared with the gRPC server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from chatstore import ChatStore
+from codes import Requests, Responses
+from protocol import WireProtocol, VERSION, HEADER_SIZE, ENCODING
+from base_server import BaseServer
+from transport import connect, recv_exact
+
+# Points each node gets on the ring; more points spread users more evenly
+VIRTUAL_NODES = 128
+
+
+def parse_node(node):
+    """
+    Split a node address of the form "host:port".
+
+    Returns:
+    tuple: The host and the port as an int.
+    """
+    host, _, port = node.rpartition(":")
+    return host, int(port)
+
+
+class HashRing:
+    """
+    Consistent hashing of usernames onto cluster nodes.
+
+    Adding or removing a node only moves the users in the ranges next to its
+    points, about 1/N of all users, instead of reshuffling everyone.
+
+    Parameters:
+        nodes (iterable, optional): The initial node addresses.
+        replicas (int, optional): Points per node. Defaults to VIRTUAL_NODES.
+    """
+    def __init__(self, nodes=(), replicas=VIRTUAL_NODES):
+        self.replicas = replicas
+        self.lock = threading.Lock()
+        self.points = []
+        self.owners = {}
+        self.nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode(ENCODING)).digest()[:8], "big")
+
+    def add(self, node):
+        """
+        Returns:
+        bool: False if the node was already on the ring.
+        """
+        with self.lock:
+            if node in self.nodes:
+                return False
+            self.nodes.add(node)
+            for i in range(self.replicas):
+                point = self._hash(f"{node}#{i}")
+                bisect.insort(self.points, point)
+                self.owners[point] = node
+            return True
+
+    def remove(self, node):
+        with self.lock:
+            if node not in self.nodes:
+                return
+            self.nodes.discard(node)
+            for i in range(self.replicas):
+                point = self._hash(f"{node}#{i}")
+                del self.points[bisect.bisect_left(self.points, point)]
+                del self.owners[point]
+
+    def owner(self, username):
+        """
+        Returns:
+        str: The address of the node that owns `username`.
+        """
+        with self.lock:
+            i = bisect.bisect(self.points, self._hash(username)) % len(self.points)
+            return self.owners[self.points[i]]
+
+
+class PeerError(Exception):
+    """
+    Raised when a peer rejects an internal request or cannot be reached.
+    """
+
+
+class PeerLink:
+    """
+    A small pool of wire protocol connections to one peer node.
+
+    Each connection carries one request at a time; concurrent callers use
+    different connections, so a slow call does not hold up the others.
+
+    Parameters:
+        node (str): The peer's address, "host:port".
+        secret (str, optional): The cluster secret sent with every request. Defaults to none.
+        size (int, optional): Idle connections kept open. Defaults to 4.
+        timeout (float, optional): Connect and request timeout in seconds. Defaults to 5.
+    """
+    def __init__(self, node, secret="", size=4, timeout=5.0):
+        self.node = node
+        self.host, self.port = parse_node(node)
+        self.secret = secret
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def _connection(self):
+        """
+        Returns:
+        tuple: A connection, and whether it was reused from the pool.
+        """
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            sock = connect(self.host, self.port, timeout=self.timeout)
+            sock.settimeout(self.timeout)
+            return sock, False
+
+    def _release(self, sock):
+        try:
+            self.idle.put_nowait(sock)
+        except queue.Full:
+            sock.close()
+
+    def _exchange(self, sock, operation, body, expect_response):
+        header, encoded = WireProtocol.encode(version=VERSION, operation=operation, msg=body)
+        sock.sendall(header + encoded)
+        if not expect_response:
+            return None, None
+        header = recv_exact(sock, HEADER_SIZE)
+        if not header:
+            raise ConnectionError(f"{self.node} closed the connection")
+        version, size, status = WireProtocol.decode_header(header)
+        return status, recv_exact(sock, size).decode(ENCODING)
+
+    def _send(self, operation, body, expect_response=True):
+        while True:
+            try:
+                sock, reused = self._connection()
+            except OSError as e:
+                raise PeerError(f"{self.node} unreachable: {e}") from e
+            try:
+                result = self._exchange(sock, operation, body, expect_response)
+            except OSError as e:
+                sock.close()
+                # A pooled connection may have been closed by the peer while idle;
+                # anything else may have reached the peer and is not retried
+                if reused:
+                    continue
+                raise PeerError(f"{self.node} unreachable: {e}") from e
+            self._release(sock)
+            return result
+
+    def call(self, op, *args):
+        """
+        Run a store operation on the peer.
+
+        Parameters:
+        op (str): The operation, one of the keys of ClusterChatStore.peer_operations().
+        *args: Its JSON-serializable arguments.
+
+        Returns:
+        The operation's result.
+
+        Raises:
+        PeerError: If the peer could not be reached or refused the request.
+        """
+        body = json.dumps({"op": op, "args": args, "secret": self.secret})
+        status, message = self._send(Requests.PEER, body)
+        if status != Responses.SUCCESS:
+            raise PeerError(f"{self.node} refused {op}: {message}")
+        return json.loads(message)
+
+    def notify(self, username):
+        """
+        Tell the peer a message arrived for a user it is watching. No response is expected.
+        """
+        try:
+            self._send(Requests.PEER_NOTIFY, json.dumps({"username": username, "secret": self.secret}), False)
+        except PeerError as e:
+            logging.warning(f"[CLUSTER] Could not notify {self.node} about {username}: {e}")
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class ClusterChatStore(ChatStore):
+    """
+    A ChatStore spread over several nodes, each owning a consistent-hash range of usernames.
+
+    Operations on a user run on the node that owns them: locally, or forwarded
+    over a PeerLink to the owner's wire protocol port. Username search asks
+    every node and merges the sorted results. Waiters registered for users
+    owned elsewhere are woken through the owner, which sends PEER_NOTIFY to
+    every node watching the user. Those notifications are queued and sent from
+    a thread of their own, so a slow peer never holds up a local write.
+
+    Membership starts from a static peer list. A node announces itself to its
+    peers when it joins; every node then moves the accounts it no longer owns,
+    with their undelivered messages, to their new owner.
+
+    Parameters:
+        local (ChatStore): The store for the users this node owns.
+        node (str): This node's address, "host:port", as its peers reach it.
+        peers (iterable, optional): The other nodes' addresses.
+        secret (str, optional): Shared secret peers must present. Defaults to none.
+    """
+    def __init__(self, local, node, peers=(), secret=""):
+        super().__init__()
+        self.local = local
+        self.node = node
+        self.secret = secret
+        self.ring = HashRing([node, *peers])
+        self.links = {}
+        self.links_lock = threading.Lock()
+        # Callbacks registered on the local store for peers watching our users
+        self.watchers = {}
+        self.watchers_lock = threading.Lock()
+        self.rebalance_lock = threading.Lock()
+        # (node, username) pairs to send PEER_NOTIFY for
+        self.notifications = queue.Queue()
+        self.notifier_thread = threading.Thread(target=self._notify_loop, name="cluster-notifier", daemon=True)
+        self.notifier_thread.start()
+
+    def _link(self, node):
+        with self.links_lock:
+            link = self.links.get(node)
+            if link is None:
+                link = self.links[node] = PeerLink(node, self.secret)
+            return link
+
+    def _owner_link(self, username):
+        """
+        Returns:
+        PeerLink: The link to the user's owner, or None if this node owns them.
+        """
+        owner = self.ring.owner(username)
+        return None if owner == self.node else self._link(owner)
+
+    def _peers(self):
+        return [node for node in self.ring.nodes if node != self.node]
+
+    def create_account(self, username: str) -> bool:
+        link = self._owner_link(username)
+        return self.local.create_account(username) if link is None else link.call("create", username)
+
+    def delete_account(self, username: str) -> bool:
+        link = self._owner_link(username)
+        if link is not None:
+            return link.call("delete", username)
+        deleted = self.local.delete_account(username)
+        if deleted:
+            self.notify(username)
+        return deleted
+
+    def exists(self, username: str) -> bool:
+        link = self._owner_link(username)
+        return self.local.exists(username) if link is None else link.call("exists", username)
+
+    def __len__(self) -> int:
+        return len(self.local) + sum(self._link(node).call("count") for node in self._peers())
+
+    def enqueue(self, username: str, sender: str, text: str) -> bool:
+        link = self._owner_link(username)
+        if link is not None:
+            return link.call("enqueue", username, sender, text)
+        queued = self.local.enqueue(username, sender, text)
+        if queued:
+            self.notify(username)
+        return queued
+
+    def drain(self, username: str) -> "list[tuple[str, str]]":
+        link = self._owner_link(username)
+        if link is None:
+            return self.local.drain(username)
+        return [tuple(message) for message in link.call("drain", username)]
+
+    def pending(self, username: str) -> "list[tuple[str, str]]":
+        link = self._owner_link(username)
+        if link is None:
+            return self.local.pending(username)
+        return [tuple(message) for message in link.call("pending", username)]
+
+    def search(self, pattern: str, limit: int = None, after: str = "") -> "list[str]":
+        results = [self.local.search(pattern, limit, after)]
+        for node in self._peers():
+            try:
+                results.append(self._link(node).call("search", pattern, limit, after))
+            except PeerError as e:
+                # Better a partial listing than none while a node is down
+                logging.warning(f"[CLUSTER] Leaving {node} out of a search: {e}")
+        # An account being moved between nodes can briefly show up on both
+        merged = (name for name, _ in itertools.groupby(heapq.merge(*results)))
+        return list(itertools.islice(merged, limit))
+
+    def add_waiter(self, username: str, callback) -> None:
+        super().add_waiter(username, callback)
+        link = self._owner_link(username)
+        if link is not None:
+            try:
+                link.call("watch", username, self.node)
+            except PeerError as e:
+                logging.warning(f"[CLUSTER] Could not watch {username}: {e}")
+
+    def remove_waiter(self, username: str, callback) -> None:
+        super().remove_waiter(username, callback)
+        waiters, lock = self._waiter_shard(username)
+        with lock:
+            watching = username in waiters
+        link = self._owner_link(username)
+        if link is not None and not watching:
+            try:
+                link.call("unwatch", username, self.node)
+            except PeerError as e:
+                logging.warning(f"[CLUSTER] Could not stop watching {username}: {e}")
+
+    def _watch(self, username, node):
+        with self.watchers_lock:
+            if (username, node) in self.watchers:
+                return
+            callback = self.watchers[(username, node)] = lambda: self.notifications.put((node, username))
+        self.local.add_waiter(username, callback)
+
+    def _unwatch(self, username, node):
+        with self.watchers_lock:
+            callback = self.watchers.pop((username, node), None)
+        if callback:
+            self.local.remove_waiter(username, callback)
+
+    def _notify_loop(self):
+        while True:
+            item = self.notifications.get()
+            if item is None:
+                return
+            node, username = item
+            # PeerLink.notify logs its own failures
+            self._link(node).notify(username)
+
+    def _import(self, username, messages):
+        """
+        Take over an account, and its undelivered messages, from a node that no longer owns it.
+        """
+        self.local.create_account(username)
+        for sender, text in messages:
+            self.local.enqueue(username, sender, text)
+        if messages:
+            self.notify(username)
+        return True
+
+    def _hello(self, node):
+        """
+        Add a joining node to the ring and hand it the accounts it now owns.
+
+        Returns:
+        list: Every node this node knows of, so the newcomer learns the whole cluster.
+        """
+        if self.ring.add(node):
+            logging.info(f"[CLUSTER] {node} joined")
+            threading.Thread(target=self.rebalance, daemon=True).start()
+        return sorted(self.ring.nodes)
+
+    def peer_operations(self):
+        """
+        Returns:
+        dict: The operations peers may run on this node, by name.
+            They act on the local store directly, even if this node's view of the
+            ring disagrees with the caller's, so a request is never bounced around.
+        """
+        def enqueue(username, sender, text):
+            queued = self.local.enqueue(username, sender, text)
+            if queued:
+                self.notify(username)
+            return queued
+
+        def delete(username):
+            deleted = self.local.delete_account(username)
+            if deleted:
+                self.notify(username)
+            return deleted
+
+        return {
+            "create": self.local.create_account,
+            "delete": delete,
+            "exists": self.local.exists,
+            "count": lambda: len(self.local),
+            "enqueue": enqueue,
+            "drain": self.local.drain,
+            "pending": self.local.pending,
+            "search": self.local.search,
+            "watch": self._watch,
+            "unwatch": self._unwatch,
+            "import": self._import,
+            "hello": self._hello,
+        }
+
+    def handle_peer_request(self, msg):
+        """
+        Run a PEER request from another node.
+
+        Parameters:
+        msg (str): The JSON request, with "op", "args" and "secret".
+
+        Returns:
+        str: The JSON encoded result.
+
+        Raises:
+        PermissionError: If the secret does not match.
+        ValueError: If the request is malformed or names an unknown operation.
+        """
+        request = json.loads(msg)
+        self._check_secret(request)
+        operation = self.peer_operations().get(request.get("op"))
+        if operation is None:
+            raise ValueError(f"Unknown peer operation {request.get('op')!r}")
+        return json.dumps(operation(*request.get("args", ())))
+
+    def handle_peer_notify(self, msg):
+        """
+        Wake the local waiters of a user whose owner received a message for them.
+        """
+        request = json.loads(msg)
+        self._check_secret(request)
+        self.notify(request["username"])
+
+    def _check_secret(self, request):
+        # Without a secret every client could reach every mailbox, so nothing is accepted
+        if not self.secret or not hmac.compare_digest(str(request.get("secret", "")), self.secret):
+            raise PermissionError("Bad cluster secret")
+
+    def join(self):
+        """
+        Announce this node to its peers, learn about any nodes they know, and take over our accounts.
+        Peers that are not up yet are skipped; they pick this node up from their own peer list.
+        """
+        for node in self._peers():
+            try:
+                for member in self._link(node).call("hello", self.node):
+                    self.ring.add(member)
+            except PeerError as e:
+                logging.warning(f"[CLUSTER] {e}")
+        self.rebalance()
+
+    def rebalance(self):
+        """
+        Move every local account this node no longer owns to its owner.
+
+        An account is copied to its new owner before it is deleted here, so a
+        crash in between leaves a duplicate rather than a loss. Messages sent to
+        an account while it moves may land on either node; those left here are
+        moved by the next rebalance.
+        """
+        with self.rebalance_lock:
+            moved = 0
+            for username in self.local.search("*"):
+                owner = self.ring.owner(username)
+                if owner == self.node:
+                    continue
+                messages = self.local.drain(username)
+                try:
+                    self._link(owner).call("import", username, messages)
+                except PeerError as e:
+                    # Put the messages back and try again on the next rebalance
+                    logging.warning(f"[CLUSTER] Could not move {username} to {owner}: {e}")
+                    for sender, text in messages:
+                        self.local.enqueue(username, sender, text)
+                    continue
+                self.local.delete_account(username)
+                moved += 1
+            if moved:
+                logging.info(f"[CLUSTER] Moved {moved} accounts to their new owners")
+
+    def prewarm(self):
+        self.local.prewarm()
+
+    def close(self):
+        self.notifications.put(None)
+        self.notifier_thread.join()
+        with self.links_lock:
+            for link in self.links.values():
+                link.close()
+        self.local.close()
+
+
+def handle_peer_frame(store, operation, msg):
+    """
+    Answer an internal PEER or PEER_NOTIFY frame on behalf of a server.
+
+    Parameters:
+    store (ChatStore): The server's store.
+    operation (int): Requests.PEER or Requests.PEER_NOTIFY.
+    msg (str): The frame body.
+
+    Returns:
+    tuple: The response status and message. The message is None for PEER_NOTIFY, which gets no response.
+    """
+    if not isinstance(store, ClusterChatStore):
+        return Responses.FAILURE, "Not a cluster node"
+    try:
+        if operation == Requests.PEER_NOTIFY:
+            store.handle_peer_notify(msg)
+            return Responses.SUCCESS, None
+        return Responses.SUCCESS, store.handle_peer_request(msg)
+    except (PermissionError, ValueError, KeyError, TypeError) as e:
+        logging.warning(f"[CLUSTER] Rejected a peer request: {e}")
+        return Responses.FAILURE, str(e)
+
+
+class PeerEndpoint(BaseServer):
+    """
+    A wire protocol server that only answers other cluster nodes.
+
+    Frontends without a wire protocol port of their own, such as the gRPC
+    server, run one so that they can take part in a cluster.
+
+    Parameters:
+        store (ClusterChatStore): The node's store.
+        host (str): The address to listen on.
+        port (int): The port to listen on.
+    """
+    def __init__(self, store, host, port):
+        super().__init__(host, port, ENCODING, HEADER_SIZE)
+        self.store = store
+        self.clients_lock = threading.Lock()
+        self.clients = []
+        self.requests = {
+            Requests.PEER: self.handle_peer,
+            Requests.PEER_NOTIFY: self.handle_peer_notify,
+            Requests.DISCONNECT: self.disconnect,
+        }
+
+    def handle_peer(self, conn, msg):
+        status, message = handle_peer_frame(self.store, Requests.PEER, msg)
+        return self.generate_payload(status, True, message)
+
+    def handle_peer_notify(self, conn, msg):
+        status, message = handle_peer_frame(self.store, Requests.PEER_NOTIFY, msg)
+        return self.generate_payload(status, True, message)
+
+    def start(self):
+        """
+        Accept peer connections until the process exits. Meant to run on a daemon thread.
+        """
+        self.open_listeners()
+        while True:
+            ready, _, _ = select.select(self.listeners, [], [])
+            for listener in ready:
+                conn, addr = listener.accept()
+                with self.clients_lock:
+                    self.clients.append(conn)
+                threading.Thread(target=self.handle_client, args=(conn, addr), daemon=True).start()
@@ -8,6 +8,24 @@ class Requests:
     SEND_MESSAGE = 4
     VIEW_MESSAGES = 5
     DISCONNECT = 6
+    # Codes 7-12 are taken by responses
+    RESUME = 13
+    ACK = 14
+    # Internal requests between cluster nodes
+    PEER = 15
+    PEER_NOTIFY = 16
+    # Reading a conversation's history does not consume it, unlike VIEW_MESSAGES
+    HISTORY = 17
+    SEARCH_MESSAGES = 18
+    # Sent as chunked frames, see protocol.CHUNKED_VERSION
+    UPLOAD_ATTACHMENT = 19
+    DOWNLOAD_ATTACHMENT = 20
+    # Operator commands, such as profiling, authenticated by the server's admin secret
+    ADMIN = 21
+    # Watch other users come online and go offline, pushed as Responses.PRESENCE
+    SUBSCRIBE_PRESENCE = 22
+    # Be told of every account created or deleted, pushed as Responses.ACCOUNTS_CHANGED
+    WATCH_ACCOUNTS = 24
 
 # A class defining response codes for client-server communication.
 class Responses:
@@ -16,3 +34,10 @@ class Responses:
     FAILURE = 8
     DISCONNECT = 9
     PROTOCOL_ERR = 10
+    OVERLOADED = 11
+    # Server-initiated delivery of a chat message, never a reply to a request.
+    MESSAGE = 12
+    # Server-initiated delivery of status changes to a SUBSCRIBE_PRESENCE subscriber.
+    PRESENCE = 23
+    # Server-initiated delivery of account changes to a WATCH_ACCOUNTS watcher.
+    ACCOUNTS_CHANGED = 25
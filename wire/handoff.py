@@ -0,0 +1,118 @@
+import json
+import socket
+import struct
+
+from transport import recv_exact
+
+# What a new server process sends once connected to the running server's handoff socket
+TAKEOVER = b"TAKEOVER\n"
+# What the new process answers once it has restored everything, after which the old one lets go
+CONFIRM = b"OK"
+# Descriptors passed per message, well under the kernel's limit of 253
+MAX_FDS_PER_MESSAGE = 200
+# The number of descriptors and the length of the state that follow
+HEADER = struct.Struct(">II")
+
+
+def send_handoff(channel, state, sockets):
+    """
+    Pass sockets and the state that goes with them to another process over a Unix socket.
+
+    The descriptors go first, in batches of MAX_FDS_PER_MESSAGE as SCM_RIGHTS
+    ancillary data on a one-byte message each, then the JSON encoded state.
+
+    Parameters:
+    channel (socket.socket): A connected Unix socket.
+    state (dict): JSON serializable state, which refers to the sockets by position.
+    sockets (list): The sockets to pass. This process's copies stay open.
+    """
+    body = json.dumps(state).encode()
+    fds = [sock.fileno() for sock in sockets]
+    channel.sendall(HEADER.pack(len(fds), len(body)))
+    for start in range(0, len(fds), MAX_FDS_PER_MESSAGE):
+        socket.send_fds(channel, [b"F"], fds[start:start + MAX_FDS_PER_MESSAGE])
+    channel.sendall(body)
+
+
+def receive_handoff(channel):
+    """
+    Receive what send_handoff sent.
+
+    Parameters:
+    channel (socket.socket): A connected Unix socket.
+
+    Returns:
+    tuple: The state and the sockets, in the order they were sent.
+
+    Raises:
+    ConnectionError: If the other process closed the channel part way through.
+    """
+    header = recv_exact(channel, HEADER.size)
+    if len(header) < HEADER.size:
+        raise ConnectionError("The server closed the handoff socket without handing over")
+    count, length = HEADER.unpack(header)
+    sockets = []
+    try:
+        while len(sockets) < count:
+            data, fds, flags, _ = socket.recv_fds(channel, 1, MAX_FDS_PER_MESSAGE)
+            # socket.socket() finds out the family and type of each descriptor itself
+            sockets.extend(socket.socket(fileno=fd) for fd in fds)
+            if not data or flags & socket.MSG_CTRUNC:
+                raise ConnectionError("The handoff was cut short")
+        body = recv_exact(channel, length)
+        if len(body) < length:
+            raise ConnectionError("The handoff was cut short")
+    except BaseException:
+        for sock in sockets:
+            sock.close()
+        raise
+    return json.loads(body), sockets
+
+
+def request_handoff(path):
+    """
+    Ask the server listening on a handoff socket to hand its listeners, connections and sessions
+    over to this process. The server stops serving until confirm_handoff() is called or the channel
+    is closed, in which case it carries on.
+
+    Parameters:
+    path (str): The server's handoff socket.
+
+    Returns:
+    tuple: The channel to confirm on, the state and the sockets, see receive_handoff.
+    """
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        channel.connect(path)
+        channel.sendall(TAKEOVER)
+        state, sockets = receive_handoff(channel)
+    except BaseException:
+        channel.close()
+        raise
+    return channel, state, sockets
+
+
+def confirm_handoff(channel):
+    """
+    Tell the old server everything was taken over, so it can let go and exit.
+    """
+    with channel:
+        channel.sendall(CONFIRM)
+
+
+def await_confirmation(channel, timeout):
+    """
+    Wait for the new process to confirm a handoff.
+
+    Parameters:
+    channel (socket.socket): The channel the handoff was sent on.
+    timeout (float): Seconds to wait.
+
+    Returns:
+    bool: True if the new process confirmed, False if it failed or gave no answer in time.
+    """
+    channel.settimeout(timeout)
+    try:
+        return recv_exact(channel, len(CONFIRM)) == CONFIRM
+    except OSError:
+        return False
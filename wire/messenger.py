@@ -1,4 +1,6 @@
 from client import Client
+import argparse
+import os
 import sys
 # Function to display menu to the user
 def display_menu():
@@ -14,6 +16,11 @@ def display_login_menu():
      print("1. Send Message")
      print("2. View Messages")
      print("3. List accounts")
+     print("4. View History")
+     print("5. Search Messages")
+     print("6. Send Attachment")
+     print("7. Download Attachment")
+     print("8. Watch Users")
 
 # Function to login to an account
 def login(client):
@@ -43,10 +50,33 @@ def send_message(client):
 def view_messages(client):
     return client.view_messages()
 
+def view_history(client):
+    peer = input("Enter username of the other user: ")
+    token = client.view_history(peer)
+    while token and input("Show more? (y/n): ").lower() == "y":
+        token = client.view_history(peer, token)
+
+def search_messages(client):
+    query = input("Enter words to search for: ")
+    return client.search_messages(query)
+
+def send_attachment(client):
+    receiver = input("Enter username of recipient: ")
+    path = input("Enter path of the file: ")
+    return client.send_attachment(receiver, path)
+
+def download_attachment(client):
+    attachment_id = input("Enter attachment id: ")
+    return client.download_attachment(attachment_id)
+
+def watch_users(client):
+    usernames = input("Enter usernames to watch, separated by spaces (none to stop): ")
+    return client.subscribe_presence(usernames.split())
+
 # Main function to run the program
-def main():
+def main(host=None, port=5050, path=None, shm=False):
     try:
-        client = Client('10.250.37.222')
+        client = Client(host, port, path=path, shm=shm)
         while client.receive_event.is_set():
             try:
                 display_menu()
@@ -69,6 +99,16 @@ def main():
                                 view_messages(client)
                             elif choice == 3:
                                 list_accounts(client)
+                            elif choice == 4:
+                                view_history(client)
+                            elif choice == 5:
+                                search_messages(client)
+                            elif choice == 6:
+                                send_attachment(client)
+                            elif choice == 7:
+                                download_attachment(client)
+                            elif choice == 8:
+                                watch_users(client)
                             else:
                                 print("Invalid choice")
 
@@ -95,4 +135,15 @@ def main():
 
 # Call the main function
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Wire protocol chat client")
+    parser.add_argument("--host", default=os.environ.get("CHAT_HOST"),
+                        help="the server's address. Defaults to $CHAT_HOST, or else this machine's address")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("CHAT_PORT", 5050)),
+                        help="the server's port. Defaults to $CHAT_PORT, or else 5050")
+    parser.add_argument("--path", default=os.environ.get("CHAT_PATH"),
+                        help="the server's Unix socket, for a server on this machine, used instead of --host and --port. "
+                             "Defaults to $CHAT_PATH")
+    parser.add_argument("--shm", action="store_true",
+                        help="--path is a shared memory listener, exchange frames through shared memory")
+    args = parser.parse_args()
+    main(args.host, args.port, args.path, args.shm)
\ No newline at end of file
@@ -0,0 +1,232 @@
+import collections
+import heapq
+import logging
+import threading
+import time
+
+
+class Subscriber:
+    """
+    A user watching other users' online status.
+
+    Attributes:
+        username (str): The subscribing user.
+        watched (set): The usernames watched.
+        known (dict): The status of each watched user as last told to the subscriber.
+        pending (dict): Status changes not pushed yet; a user who changes twice only keeps the latest.
+        due (float): When the pending changes will be pushed, as a time.monotonic() value, or None if not scheduled.
+        last_sent (float): When the subscriber was last pushed to.
+    """
+    __slots__ = ("username", "watched", "known", "pending", "due", "last_sent")
+
+    def __init__(self, username, watched, known, last_sent):
+        self.username = username
+        self.watched = watched
+        self.known = known
+        self.pending = {}
+        self.due = None
+        self.last_sent = last_sent
+
+
+class PresenceService:
+    """
+    Tracks which users are online and pushes status changes to the users subscribed to them.
+
+    Changes are not pushed one by one. A subscriber gets at most one push per
+    `interval`, holding every change since the previous one. A user who goes
+    offline and comes back within that window is not reported at all. Pushes
+    are sent by a background thread, never by the thread whose login or
+    disconnect caused the change.
+
+    Parameters:
+        send (callable): Called as send(username, statuses) with a {username: online} dict to push
+            to a subscriber. Returns False if the subscriber cannot be reached, e.g. while its session is
+            detached; the changes are then kept for `resync`.
+        interval (float, optional): The least seconds between two pushes to a subscriber. Defaults to 1.
+        max_watched (int, optional): The most users one subscriber may watch. Defaults to 1000.
+    """
+    def __init__(self, send, interval=1.0, max_watched=1000):
+        self.send = send
+        self.interval = interval
+        self.max_watched = max_watched
+        self.lock = threading.Condition()
+        self.online = set()
+        # The subscribers to each watched user's status
+        self.watchers = collections.defaultdict(set)
+        self.subscribers = {}
+        # (due, username) of scheduled pushes, earliest first; entries whose
+        # subscriber was rescheduled or has gone are skipped
+        self.schedule = []
+        self.closed = False
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def is_online(self, username):
+        return username in self.online
+
+    def set_online(self, username, online):
+        """
+        Record a user coming online or going offline, and schedule pushes to its subscribers.
+
+        Parameters:
+        username (str): The user.
+        online (bool): Whether the user is now online.
+        """
+        with self.lock:
+            if online == (username in self.online):
+                return
+            if online:
+                self.online.add(username)
+            else:
+                self.online.discard(username)
+            for name in self.watchers.get(username, ()):
+                subscriber = self.subscribers[name]
+                subscriber.pending[username] = online
+                self._schedule(subscriber)
+
+    def _schedule(self, subscriber):
+        if subscriber.due is None:
+            subscriber.due = max(time.monotonic(), subscriber.last_sent + self.interval)
+            heapq.heappush(self.schedule, (subscriber.due, subscriber.username))
+            self.lock.notify()
+
+    def subscribe(self, username, usernames):
+        """
+        Set the users a subscriber watches, replacing any earlier subscription.
+
+        Parameters:
+        username (str): The subscribing user.
+        usernames (iterable): The users to watch. None unsubscribes.
+
+        Returns:
+        dict: The current status of each watched user.
+
+        Raises:
+        ValueError: If more than max_watched users are watched.
+        """
+        watched = set(usernames)
+        if len(watched) > self.max_watched:
+            raise ValueError(f"At most {self.max_watched} users can be watched")
+        with self.lock:
+            previous = self._unsubscribe(username)
+            if not watched:
+                return {}
+            known = {name: name in self.online for name in watched}
+            # The first push waits out the interval, so it cannot overtake the answer
+            # carrying this snapshot
+            last_sent = time.monotonic() if previous is None else max(previous.last_sent, time.monotonic())
+            self.subscribers[username] = Subscriber(username, watched, known, last_sent)
+            for name in watched:
+                self.watchers[name].add(username)
+            return dict(known)
+
+    def unsubscribe(self, username):
+        """
+        Stop pushing status changes to a user, e.g. when its session ends.
+        """
+        with self.lock:
+            self._unsubscribe(username)
+
+    def _unsubscribe(self, username):
+        subscriber = self.subscribers.pop(username, None)
+        if subscriber is not None:
+            for name in subscriber.watched:
+                watchers = self.watchers[name]
+                watchers.discard(username)
+                if not watchers:
+                    del self.watchers[name]
+        return subscriber
+
+    def resync(self, username):
+        """
+        Push the changes a subscriber missed while it could not be reached, e.g. once its session is resumed.
+        """
+        with self.lock:
+            subscriber = self.subscribers.get(username)
+            if subscriber is not None and subscriber.pending:
+                self._schedule(subscriber)
+
+    def export(self):
+        """
+        Returns:
+        dict: Each subscriber's watched users and what it was last told of them, by subscriber,
+            for a server process taking over.
+        """
+        with self.lock:
+            return {username: {"watched": sorted(subscriber.watched), "known": dict(subscriber.known)}
+                    for username, subscriber in self.subscribers.items()}
+
+    def restore(self, subscriptions):
+        """
+        Recreate subscriptions exported by another process. Call once the users online have been set;
+        whatever differs from what a subscriber was last told is pushed as a change.
+
+        Parameters:
+        subscriptions (dict): What export() returned.
+        """
+        with self.lock:
+            now = time.monotonic()
+            for username, subscription in subscriptions.items():
+                watched = set(subscription["watched"])
+                subscriber = Subscriber(username, watched, subscription["known"], now)
+                self._unsubscribe(username)
+                self.subscribers[username] = subscriber
+                for name in watched:
+                    self.watchers[name].add(username)
+                    if subscriber.known.get(name) != (name in self.online):
+                        subscriber.pending[name] = name in self.online
+                if subscriber.pending:
+                    self._schedule(subscriber)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        self.flusher.join()
+
+    def _flush_loop(self):
+        while True:
+            with self.lock:
+                while not self.closed:
+                    now = time.monotonic()
+                    if self.schedule and self.schedule[0][0] <= now:
+                        break
+                    self.lock.wait(self.schedule[0][0] - now if self.schedule else None)
+                if self.closed:
+                    return
+                batches = self._take_due(now)
+            for subscriber, changes in batches:
+                try:
+                    sent = self.send(subscriber.username, changes)
+                except Exception as e:
+                    logging.exception(e)
+                    sent = False
+                with self.lock:
+                    if sent:
+                        subscriber.known.update(changes)
+                        subscriber.last_sent = now
+                    else:
+                        # Changes that happened since stay, they are newer
+                        for name, online in changes.items():
+                            subscriber.pending.setdefault(name, online)
+
+    def _take_due(self, now):
+        """
+        Collect the changes of every subscriber whose push is due. Must be called with the lock held.
+
+        Returns:
+        list: (subscriber, {username: online}) pairs, leaving out changes that cancelled out.
+        """
+        batches = []
+        while self.schedule and self.schedule[0][0] <= now:
+            due, username = heapq.heappop(self.schedule)
+            subscriber = self.subscribers.get(username)
+            if subscriber is None or subscriber.due != due:
+                continue
+            subscriber.due = None
+            changes = {name: online for name, online in subscriber.pending.items()
+                       if subscriber.known.get(name) != online}
+            subscriber.pending = {}
+            if changes:
+                batches.append((subscriber, changes))
+        return batches
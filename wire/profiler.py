@@ -0,0 +1,305 @@
+import cProfile
+import collections
+import io
+import os
+import sys
+import threading
+import tracemalloc
+
+# From Python 3.12 a cProfile session sees every thread; before that only the
+# thread that enabled it, so each handler thread gets its own
+PER_THREAD_CPROFILE = sys.version_info < (3, 12)
+
+# Allocations not made under any request handler, e.g. by session expiry or the store
+OUTSIDE_HANDLERS = "(outside handlers)"
+
+
+class Profiler:
+    """
+    Profiling a live server's request handlers, switched on and off at runtime.
+
+    Handlers are run through `call`, which costs a single attribute check while
+    nothing is being profiled. Three tools can run, independently:
+
+    - cProfile, deterministic and complete but slowing handlers down noticeably;
+    - a sampler, which every `interval` seconds records the stack of each
+      thread that is inside a handler, for flame graphs at a low overhead;
+    - tracemalloc, whose snapshots are reported as the top allocation sites of
+      each handler, and as growth since the previous snapshot.
+
+    Each tool can only be started once at a time; starting one that is running raises ValueError.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Whether `call` has to do anything
+        self.active = False
+        self.cprofile = None
+        self.thread_profiles = []
+        # Bumped by every start_cprofile, so threads drop profiles from an earlier session
+        self.generation = 0
+        self.local = threading.local()
+        self.sampler = None
+        self.sampling = threading.Event()
+        self.samples = collections.Counter()
+        # The handler each thread is running, by thread ident
+        self.current = {}
+        # Kept apart from `lock`, which handler threads take, as a snapshot takes a while
+        self.tracing_lock = threading.Lock()
+        self.tracing = False
+        self.previous_allocations = None
+
+    def call(self, handler, *args):
+        """
+        Run a request handler, profiling it if profiling is on.
+
+        Parameters:
+        handler (callable): The handler.
+        args: The handler's arguments.
+
+        Returns:
+        The handler's return value.
+        """
+        if not self.active:
+            return handler(*args)
+        ident = threading.get_ident()
+        self.current[ident] = handler.__name__
+        profile = self._thread_profile() if self.cprofile is not None and PER_THREAD_CPROFILE else None
+        if profile:
+            profile.enable()
+        try:
+            return handler(*args)
+        finally:
+            if profile:
+                profile.disable()
+            self.current.pop(ident, None)
+
+    def _thread_profile(self):
+        generation, profile = getattr(self.local, "profile", (None, None))
+        if generation != self.generation:
+            profile = cProfile.Profile()
+            self.local.profile = (self.generation, profile)
+            with self.lock:
+                self.thread_profiles.append(profile)
+        return profile
+
+    def _update_active(self):
+        self.active = self.cprofile is not None or self.sampler is not None
+
+    def start_cprofile(self):
+        with self.lock:
+            if self.cprofile is not None:
+                raise ValueError("cProfile is already running")
+            self.thread_profiles = []
+            self.generation += 1
+            self.cprofile = cProfile.Profile()
+            if not PER_THREAD_CPROFILE:
+                self.cprofile.enable()
+            self._update_active()
+
+    def stop_cprofile(self):
+        """
+        Returns:
+        pstats.Stats: What every handler thread spent its time on since start_cprofile.
+        """
+        with self.lock:
+            if self.cprofile is None:
+                raise ValueError("cProfile is not running")
+            profile, self.cprofile = self.cprofile, None
+            profiles, self.thread_profiles = self.thread_profiles, []
+            self._update_active()
+        # Imported here, as it takes longer to import than the rest of the server
+        import pstats
+        if PER_THREAD_CPROFILE:
+            # A handler still running when profiling stopped adds what it has so far
+            profiles = [p for p in profiles if p.getstats()]
+            if not profiles:
+                return None
+            stats = pstats.Stats(profiles[0])
+            for other in profiles[1:]:
+                stats.add(other)
+            return stats
+        profile.disable()
+        return pstats.Stats(profile)
+
+    def start_sampling(self, interval=0.005):
+        """
+        Parameters:
+        interval (float, optional): Seconds between samples. Defaults to 5 ms.
+        """
+        with self.lock:
+            if self.sampler is not None:
+                raise ValueError("The sampler is already running")
+            self.samples = collections.Counter()
+            self.sampling.clear()
+            self.sampler = threading.Thread(target=self._sample_loop, args=(interval,), daemon=True)
+            self.sampler.start()
+            self._update_active()
+
+    def stop_sampling(self):
+        """
+        Returns:
+        collections.Counter: How many samples found each stack, as "frame;frame;..." from the handler inwards.
+        """
+        with self.lock:
+            if self.sampler is None:
+                raise ValueError("The sampler is not running")
+            sampler, self.sampler = self.sampler, None
+            self.sampling.set()
+            self._update_active()
+        sampler.join()
+        return self.samples
+
+    def _sample_loop(self, interval):
+        while not self.sampling.wait(interval):
+            frames = sys._current_frames()
+            for ident in list(self.current):
+                frame = frames.get(ident)
+                stack = []
+                # Walk out to the frame `call` runs the handler from
+                while frame is not None and frame.f_code is not CALL_CODE:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    self.samples[";".join(reversed(stack))] += 1
+
+    def start_tracemalloc(self, frames=25):
+        """
+        Parameters:
+        frames (int, optional): Stack frames kept per allocation. Handlers are only found
+            within this many frames of an allocation. Defaults to 25.
+        """
+        with self.tracing_lock:
+            if self.tracing:
+                raise ValueError("tracemalloc is already running")
+            tracemalloc.start(frames)
+            self.tracing = True
+            self.previous_allocations = None
+
+    def stop_tracemalloc(self):
+        with self.tracing_lock:
+            if not self.tracing:
+                raise ValueError("tracemalloc is not running")
+            tracemalloc.stop()
+            self.tracing = False
+            self.previous_allocations = None
+
+    def snapshot_allocations(self, handlers):
+        """
+        Take a tracemalloc snapshot and total the memory in use by handler and allocation site.
+
+        Parameters:
+        handlers (iterable): The server's request handlers, to find in each allocation's stack.
+
+        Returns:
+        tuple: {(handler, site): [bytes, blocks]} now, and the same from the previous snapshot, or None if this is the first.
+        """
+        with self.tracing_lock:
+            if not self.tracing:
+                raise ValueError("tracemalloc is not running")
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ))
+            ranges = handler_ranges(handlers)
+            allocations = collections.defaultdict(lambda: [0, 0])
+            for trace in snapshot.traces:
+                # Frames run from the outermost call to where the allocation happened
+                frames = trace.traceback
+                site = f"{frames[-1].filename}:{frames[-1].lineno}"
+                totals = allocations[(find_handler(frames, ranges), site)]
+                totals[0] += trace.size
+                totals[1] += 1
+            previous, self.previous_allocations = self.previous_allocations, dict(allocations)
+            return dict(allocations), previous
+
+
+CALL_CODE = Profiler.call.__code__
+
+
+def handler_ranges(handlers):
+    """
+    Returns:
+    dict: Each source file mapped to the (first line, last line, name) of the handlers defined in it.
+    """
+    ranges = collections.defaultdict(list)
+    for handler in handlers:
+        code = getattr(handler, "__func__", handler).__code__
+        lines = [line for _, _, line in code.co_lines() if line is not None]
+        ranges[code.co_filename].append((min(lines), max(lines), handler.__name__))
+    return ranges
+
+
+def find_handler(frames, ranges):
+    """
+    Returns:
+    str: The name of the innermost handler in an allocation's stack, or OUTSIDE_HANDLERS.
+    """
+    for frame in reversed(frames):
+        for first, last, name in ranges.get(frame.filename, ()):
+            if first <= frame.lineno <= last:
+                return name
+    return OUTSIDE_HANDLERS
+
+
+def check_sort_key(sort):
+    """
+    Raises:
+    ValueError: If `sort` is not a key pstats can sort a report by, e.g. "cumulative" or "tottime".
+    """
+    import pstats
+    if sort not in pstats.Stats.sort_arg_dict_default:
+        keys = ", ".join(sorted(key.value for key in pstats.SortKey))
+        raise ValueError(f"Cannot sort by {sort!r}, expected one of {keys}")
+
+
+def format_cprofile(stats, limit=50, sort="cumulative"):
+    """
+    Returns:
+    list: The lines of a pstats report of the `limit` most expensive functions.
+    """
+    if stats is None:
+        return ["No handler ran while cProfile was on."]
+    out = io.StringIO()
+    stats.stream = out
+    stats.sort_stats(sort).print_stats(limit)
+    return out.getvalue().splitlines()
+
+
+def format_samples(samples):
+    """
+    Returns:
+    list: The samples as folded stacks, "frame;frame;... count", the input flamegraph.pl and speedscope take.
+    """
+    return [f"{stack} {count}" for stack, count in samples.most_common()]
+
+
+def format_allocations(allocations, previous=None, limit=10):
+    """
+    Report the top allocation sites of each handler, handlers using the most memory first.
+    Given a previous snapshot, sites are ranked by how much they grew since.
+
+    Returns:
+    list: The report's lines.
+    """
+    if previous is not None:
+        changes = {}
+        for key in allocations.keys() | previous.keys():
+            size, count = allocations.get(key, (0, 0))
+            before_size, before_count = previous.get(key, (0, 0))
+            if size != before_size or count != before_count:
+                changes[key] = (size - before_size, count - before_count)
+        allocations = changes
+    by_handler = collections.defaultdict(list)
+    for (handler, site), (size, count) in allocations.items():
+        by_handler[handler].append((size, count, site))
+    lines = []
+    for handler, sites in sorted(by_handler.items(), key=lambda item: -sum(size for size, _, _ in item[1])):
+        total = sum(size for size, _, _ in sites)
+        lines.append(f"{handler}: {total:+,} B" if previous is not None else f"{handler}: {total:,} B")
+        for size, count, site in sorted(sites, key=lambda site: -site[0])[:limit]:
+            if previous is not None:
+                lines.append(f"  {size:+,} B {count:+,} blocks {site}")
+            else:
+                lines.append(f"  {size:,} B {count:,} blocks {site}")
+    return lines or ["No allocations."]
@@ -1,3 +1,4 @@
+import io
 import struct
 from codes import Requests, Responses
 
@@ -14,15 +15,38 @@ HEADER_FORMAT = ">blb"
 # 1 byte operation
 HEADER_SIZE = 1 + 4 + 1
 
-# Define the maximum message size
-MAX_SIZE = 2<<32 - 1
+# Define the maximum message size, the largest signed 4 byte long
+MAX_SIZE = 2**31 - 1
+
+# Define the largest frame a peer has to accept. Bigger payloads, such as
+# attachments, are split into chunked frames
+MAX_FRAME_SIZE = 16 * 1024 * 1024
 
 # Define the current protocol version
 VERSION = 1
 
+# Frames with this version start their body with a chunk header:
+# 1 byte flags
+# 4 bytes chunk index, counting from 0 within the transfer
+CHUNKED_VERSION = 2
+CHUNK_HEADER_FORMAT = ">BI"
+CHUNK_HEADER_SIZE = 1 + 4
+
+# Chunk flag set on every chunk of a transfer but the last
+MORE_CHUNKS = 0x01
+
+# Define the payload size attachments are sent in
+CHUNK_SIZE = 64 * 1024
+
 # Define the message encoding to be used
 ENCODING = 'utf-8'
 
+class ProtocolError(Exception):
+    """
+    Raised when a peer sends a frame that breaks the protocol, e.g. one that is too large.
+    """
+
+
 class WireProtocol:
     @staticmethod
     def get_header(version, size, operation):
@@ -47,13 +71,18 @@ class WireProtocol:
         Parameters:
         version (int): The version number to use.
         operation (int): The operation code.
-        msg (str): The message to encode.
+        msg (str): The message to encode, or bytes to send as they are.
 
         Returns:
         tuple: A tuple containing the message header and the encoded message body as bytes.
+
+        Raises:
+        ProtocolError: If the body is larger than MAX_SIZE.
         """
-        encoded = msg.encode(ENCODING)
+        encoded = msg if isinstance(msg, bytes) else msg.encode(ENCODING)
         msg_size = len(encoded)
+        if msg_size > MAX_SIZE:
+            raise ProtocolError(f"Message of {msg_size} bytes is larger than {MAX_SIZE}")
         header = WireProtocol.get_header(version, msg_size, operation)
         return header, encoded
 
@@ -67,6 +96,167 @@ class WireProtocol:
 
         Returns:
         tuple: A tuple containing the version number, size of the message body, and operation code.
+
+        Raises:
+        ProtocolError: If the size is negative, which no valid frame has.
         """
         version, size, operation = struct.unpack(HEADER_FORMAT, header)
+        if size < 0:
+            raise ProtocolError(f"Invalid message size {size}")
         return version, size, operation
+
+    @staticmethod
+    def chunk_header(operation, index, length, more):
+        """
+        Builds the headers of a chunked frame, for the caller to send the payload after.
+
+        Parameters:
+        operation (int): The operation code.
+        index (int): The chunk's position within the transfer, counting from 0.
+        length (int): The size of the chunk's payload.
+        more (bool): Whether more chunks of the transfer follow.
+
+        Returns:
+        bytes: The message header followed by the chunk header.
+        """
+        flags = MORE_CHUNKS if more else 0
+        return (WireProtocol.get_header(CHUNKED_VERSION, CHUNK_HEADER_SIZE + length, operation)
+                + struct.pack(CHUNK_HEADER_FORMAT, flags, index))
+
+    @staticmethod
+    def decode_chunk_header(chunk_header):
+        """
+        Decodes the chunk header at the start of a chunked frame's body.
+
+        Parameters:
+        chunk_header (bytes): The first CHUNK_HEADER_SIZE bytes of the body.
+
+        Returns:
+        tuple: A tuple containing the chunk index and whether more chunks follow.
+        """
+        flags, index = struct.unpack(CHUNK_HEADER_FORMAT, chunk_header)
+        return index, bool(flags & MORE_CHUNKS)
+
+    @staticmethod
+    def encode_chunks(operation, first, data=b"", chunk_size=CHUNK_SIZE):
+        """
+        Splits a transfer into chunked frames.
+
+        Parameters:
+        operation (int): The operation code.
+        first (str): The body of chunk 0, describing the transfer.
+        data (bytes or file, optional): The payload, or a binary file to read it from chunk by chunk,
+            so it never has to be held in memory at once. Defaults to no payload.
+        chunk_size (int, optional): The largest payload per frame. Defaults to CHUNK_SIZE.
+
+        Yields:
+        bytes: One complete frame per chunk.
+        """
+        read = data.read if hasattr(data, "read") else io.BytesIO(data).read
+        encoded = first.encode(ENCODING)
+        chunk = read(chunk_size)
+        yield WireProtocol.chunk_header(operation, 0, len(encoded), bool(chunk)) + encoded
+        index = 1
+        while chunk:
+            following = read(chunk_size)
+            yield WireProtocol.chunk_header(operation, index, len(chunk), bool(following)) + chunk
+            chunk = following
+            index += 1
+
+    @staticmethod
+    def encode_push(receiver, seq, text):
+        """
+        Builds the body of a MESSAGE push.
+
+        Parameters:
+        receiver (str): The username the message is delivered to.
+        seq (int): The push's sequence number within the receiver's session.
+        text (str): The formatted chat message.
+
+        Returns:
+        str: The push body.
+        """
+        return f"{receiver}\n{seq}\n{text}"
+
+    @staticmethod
+    def encode_presence(receiver, statuses):
+        """
+        Builds the body of a PRESENCE push, or of the answer to SUBSCRIBE_PRESENCE.
+
+        Parameters:
+        receiver (str): The subscriber the statuses are for.
+        statuses (dict): Whether each user is online, by username.
+
+        Returns:
+        str: The receiver, then a "username\\tonline" or "username\\toffline" line per user.
+        """
+        lines = [receiver]
+        lines.extend(f"{name}\t{'online' if online else 'offline'}" for name, online in statuses.items())
+        return "\n".join(lines)
+
+    @staticmethod
+    def decode_presence(body):
+        """
+        Splits the body of a PRESENCE push.
+
+        Parameters:
+        body (str): The push body.
+
+        Returns:
+        tuple: A tuple containing the subscriber and a dict of whether each user is online.
+        """
+        receiver, *lines = body.split("\n")
+        statuses = {}
+        for line in lines:
+            name, _, status = line.partition("\t")
+            statuses[name] = status == "online"
+        return receiver, statuses
+
+    @staticmethod
+    def encode_account_changes(epoch, changes):
+        """
+        Builds the body of an ACCOUNTS_CHANGED push.
+
+        Parameters:
+        epoch (str): The server's registry epoch, which changes when it restarts.
+        changes (list): (version, created, username) triples, oldest first.
+
+        Returns:
+        str: The epoch, then a "version\\t+username" line per account created and
+            "version\\t-username" per account deleted.
+        """
+        lines = [epoch]
+        lines.extend(f"{version}\t{'+' if created else '-'}{username}" for version, created, username in changes)
+        return "\n".join(lines)
+
+    @staticmethod
+    def decode_account_changes(body):
+        """
+        Splits the body of an ACCOUNTS_CHANGED push.
+
+        Parameters:
+        body (str): The push body.
+
+        Returns:
+        tuple: A tuple containing the epoch and a list of (version, created, username) triples.
+        """
+        epoch, *lines = body.split("\n")
+        changes = []
+        for line in lines:
+            version, _, change = line.partition("\t")
+            changes.append((int(version), change[:1] == "+", change[1:]))
+        return epoch, changes
+
+    @staticmethod
+    def decode_push(body):
+        """
+        Splits the body of a MESSAGE push.
+
+        Parameters:
+        body (str): The push body.
+
+        Returns:
+        tuple: A tuple containing the receiving username, the sequence number and the chat message.
+        """
+        receiver, seq, text = body.split("\n", 2)
+        return receiver, int(seq), text
@@ -0,0 +1,139 @@
+import collections
+import logging
+import struct
+import threading
+import time
+
+from codes import Requests
+
+# Every capture file starts with this
+MAGIC = b"WPCAP\x01"
+
+# Each recorded frame is:
+# 8 bytes seconds since the recording started (double)
+# 4 bytes connection number
+# 1 byte version
+# 1 byte operation
+# 4 bytes body size
+# followed by the body exactly as it came off the wire
+RECORD_FORMAT = ">dIbbI"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# Operations never captured: their frames carry the admin or cluster secret, and replaying
+# internal store operations against another server would change its data behind its back
+UNRECORDED = frozenset({Requests.ADMIN, Requests.PEER, Requests.PEER_NOTIFY})
+
+
+class TrafficRecorder:
+    """
+    Captures the frames clients send to a server, for replay.py to play back later.
+
+    Recording is cheap for the thread serving the client: a frame is appended
+    to an in-memory queue and a background thread writes it to the capture
+    file. If the writer falls behind by more than max_pending_bytes of frame
+    bodies, new frames are dropped and counted rather than slowing the server
+    down or filling its memory, e.g. with the chunks of a large upload.
+
+    Parameters:
+        path (str): The capture file to write. Overwritten if it exists.
+        max_pending_bytes (int, optional): Bytes of frames queued for the writer before new ones are dropped.
+            Defaults to 64 MiB.
+        flush_interval (float, optional): Seconds between writes to the file. Defaults to 0.05.
+    """
+    def __init__(self, path, max_pending_bytes=64 * 1024 * 1024, flush_interval=0.05):
+        self.path = path
+        self.max_pending_bytes = max_pending_bytes
+        self.flush_interval = flush_interval
+        self.started = time.monotonic()
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.pending_lock = threading.Lock()
+        self.dropped = 0
+        self.recorded = 0
+        self.next_connection = 0
+        self.connection_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def connection_id(self):
+        """
+        Returns:
+        int: A number for a new connection, identifying its frames in the capture.
+        """
+        with self.connection_lock:
+            self.next_connection += 1
+            return self.next_connection
+
+    def record(self, connection, version, operation, body):
+        """
+        Queue a frame received from a client.
+
+        Parameters:
+        connection (int): The connection's number, from connection_id().
+        version (int): The frame's version.
+        operation (int): The frame's operation code.
+        body (bytes): The frame's body, including the chunk header of chunked frames.
+        """
+        with self.pending_lock:
+            if self.pending_bytes + len(body) > self.max_pending_bytes:
+                self.dropped += 1
+                return
+            self.pending_bytes += len(body)
+            self.pending.append((time.monotonic() - self.started, connection, version, operation, body))
+
+    def _write_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        chunks = []
+        with self.pending_lock:
+            pending, self.pending = self.pending, collections.deque()
+            self.pending_bytes = 0
+        for ts, connection, version, operation, body in pending:
+            chunks.append(struct.pack(RECORD_FORMAT, ts, connection, version, operation, len(body)))
+            chunks.append(body)
+        if chunks:
+            self.file.write(b"".join(chunks))
+            self.file.flush()
+            self.recorded += len(chunks) // 2
+
+    def close(self):
+        self.closed.set()
+        self.writer.join()
+        self.file.close()
+        if self.dropped:
+            logging.warning(f"[RECORDER] Dropped {self.dropped} frames the writer could not keep up with")
+        logging.info(f"[RECORDER] Wrote {self.recorded} frames to {self.path}")
+
+
+def read_capture(path):
+    """
+    Read back the frames of a capture file, in the order they were received.
+
+    Parameters:
+    path (str): The capture file.
+
+    Yields:
+    tuple: The seconds since the recording started, connection number, version, operation and body of each frame.
+
+    Raises:
+    ValueError: If the file is not a capture.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a traffic capture")
+        while True:
+            header = f.read(RECORD_SIZE)
+            if len(header) < RECORD_SIZE:
+                # The end, or a record cut short when the server stopped
+                return
+            ts, connection, version, operation, size = struct.unpack(RECORD_FORMAT, header)
+            body = f.read(size)
+            if len(body) < size:
+                return
+            yield ts, connection, version, operation, body
@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import time
+from codes import Requests, Responses
+from protocol import WireProtocol, HEADER_SIZE, CHUNKED_VERSION, CHUNK_HEADER_SIZE, MORE_CHUNKS
+from recorder import UNRECORDED, read_capture
+
+# Requests the server never answers
+NO_RESPONSE = {Requests.ACK, Requests.PEER_NOTIFY, Requests.DISCONNECT}
+
+OPERATION_NAMES = {code: name for name, code in vars(Requests).items() if isinstance(code, int)}
+
+
+def load_capture(path):
+    """
+    Group the frames of a capture by the connection they arrived on.
+
+    Parameters:
+    path (str): The capture file.
+
+    Returns:
+    dict: Each connection number mapped to its (seconds since the recording started, version, operation, body) frames, in order.
+    """
+    connections = collections.defaultdict(list)
+    for ts, connection, version, operation, body in read_capture(path):
+        if operation in UNRECORDED:
+            # Older captures may hold them; internal store operations are never replayed
+            continue
+        connections[connection].append((ts, version, operation, body))
+    return connections
+
+
+def expects_response(version, operation, body):
+    """
+    Returns:
+    bool: Whether the server answers the frame: every request but the fire-and-forget
+        ones, and of a chunked transfer only the last chunk.
+    """
+    if version == CHUNKED_VERSION:
+        return not body[0] & MORE_CHUNKS
+    return operation not in NO_RESPONSE
+
+
+class Stats:
+    """
+    Latencies and outcomes of the replayed requests, by operation.
+    """
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.failures = collections.Counter()
+        self.unanswered = 0
+
+    def add(self, operation, latency, ok):
+        self.latencies[operation].append(latency)
+        if not ok:
+            self.failures[operation] += 1
+
+    def report(self, duration):
+        """
+        Parameters:
+        duration (float): Seconds the replay took.
+
+        Returns:
+        dict: Totals, throughput and latency percentiles in milliseconds, overall and by operation.
+        """
+        everything = [latency for latencies in self.latencies.values() for latency in latencies]
+        report = {
+            "requests": len(everything),
+            "failures": sum(self.failures.values()),
+            "unanswered": self.unanswered,
+            "duration": duration,
+            "throughput": len(everything) / duration if duration else 0.0,
+            "latency_ms": percentiles(everything),
+            "operations": {},
+        }
+        for operation, latencies in sorted(self.latencies.items()):
+            report["operations"][OPERATION_NAMES.get(operation, str(operation))] = {
+                "requests": len(latencies),
+                "failures": self.failures[operation],
+                "latency_ms": percentiles(latencies),
+            }
+        return report
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+    return {"p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": ordered[-1] * 1000}
+
+
+async def replay_connection(frames, connect, speed, window, started, stats, timeout=10.0):
+    """
+    Re-send one captured connection's frames and time the server's answers.
+
+    Responses are matched to requests in order. Pushed chat messages, and all
+    but the last chunk of a download, are read and ignored.
+
+    Parameters:
+    frames (list): The connection's (ts, version, operation, body) frames.
+    connect (callable): Opens a connection, returning a (reader, writer) pair.
+    speed (float): How many times faster than recorded to send, or None to send as fast as
+        the server answers.
+    window (int): Requests in flight at once when sending as fast as possible.
+    started (float): The time.monotonic() value the replay started at.
+    stats (Stats): Where to record the results.
+    timeout (float, optional): Seconds to wait for the last answers. Defaults to 10.
+    """
+    reader, writer = await connect()
+    # (operation, sent at) of each request waiting for its answer, oldest first
+    pending = collections.deque()
+    slots = asyncio.Semaphore(window) if speed is None else None
+    drained = asyncio.Event()
+    drained.set()
+
+    async def read_responses():
+        while True:
+            header = await reader.readexactly(HEADER_SIZE)
+            version, size, code = WireProtocol.decode_header(header)
+            body = await reader.readexactly(size)
+            # Pushes answer no request
+            if code in (Responses.MESSAGE, Responses.PRESENCE, Responses.ACCOUNTS_CHANGED):
+                continue
+            if version == CHUNKED_VERSION and body[0] & MORE_CHUNKS:
+                continue
+            operation, sent = pending.popleft()
+            ok = version == CHUNKED_VERSION or code == Responses.SUCCESS
+            stats.add(operation, time.monotonic() - sent, ok)
+            if slots:
+                slots.release()
+            if not pending:
+                drained.set()
+
+    responses = asyncio.create_task(read_responses())
+    transfer_started = None
+    try:
+        for ts, version, operation, body in frames:
+            if responses.done():
+                break
+            if speed is not None:
+                delay = started + ts / speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if operation == Requests.DISCONNECT:
+                # Let the answers to earlier requests arrive before the server hangs up
+                await drained.wait()
+            answered = expects_response(version, operation, body)
+            if answered and slots:
+                await slots.acquire()
+            now = time.monotonic()
+            if version == CHUNKED_VERSION:
+                index, more = WireProtocol.decode_chunk_header(body[:CHUNK_HEADER_SIZE])
+                if index == 0:
+                    transfer_started = now
+                sent = transfer_started if transfer_started is not None else now
+            else:
+                sent = now
+            if answered:
+                pending.append((operation, sent))
+                drained.clear()
+            writer.write(WireProtocol.get_header(version, len(body), operation) + body)
+            await writer.drain()
+        waiting = asyncio.ensure_future(drained.wait())
+        await asyncio.wait([responses, waiting], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        waiting.cancel()
+    except ConnectionError as e:
+        logging.warning(f"[REPLAY] Connection lost: {e}")
+    finally:
+        responses.cancel()
+        try:
+            await responses
+        except (asyncio.CancelledError, asyncio.IncompleteReadError, ConnectionError):
+            # The server hangs up after DISCONNECT
+            pass
+        stats.unanswered += len(pending)
+        writer.close()
+
+
+async def replay(path, connect, speed=1.0, window=1, connections=None):
+    """
+    Re-drive a capture against a server, with one connection per captured connection.
+
+    Sessions do not carry over: RESUME requests present tokens the server never issued,
+    and fail, so a capture is best recorded from clients that log in.
+
+    Parameters:
+    path (str): The capture file.
+    connect (callable): Opens a connection to the server, returning a (reader, writer) pair.
+    speed (float, optional): How many times faster than recorded to send, or None to send as fast as possible. Defaults to 1.
+    window (int, optional): Requests in flight per connection when sending as fast as possible. Defaults to 1.
+    connections (int, optional): Replay only the first this many connections. Defaults to all.
+
+    Returns:
+    dict: The report from Stats.report.
+    """
+    captured = load_capture(path)
+    selected = sorted(captured)[:connections]
+    if not selected:
+        raise ValueError(f"{path} has no frames")
+    # Start the clock at the first frame replayed rather than when recording started
+    offset = min(captured[c][0][0] for c in selected)
+    stats = Stats()
+    started = time.monotonic()
+    await asyncio.gather(*(
+        replay_connection([(ts - offset, *frame) for ts, *frame in captured[c]], connect, speed, window, started, stats)
+        for c in selected
+    ))
+    return stats.report(time.monotonic() - started)
+
+
+def print_report(report):
+    latency = report["latency_ms"]
+    print(f"{report['requests']} requests in {report['duration']:.2f}s: {report['throughput']:.0f} req/s, "
+          f"{report['failures']} failed, {report['unanswered']} unanswered")
+    if latency:
+        print("latency ms: " + "  ".join(f"{name} {value:.2f}" for name, value in latency.items()))
+    for name, operation in report["operations"].items():
+        latency = operation["latency_ms"]
+        print(f"  {name:<20} {operation['requests']:>8} requests {operation['failures']:>6} failed  "
+              f"p50 {latency['p50']:.2f}  p99 {latency['p99']:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a capture recorded with server.py --record")
+    parser.add_argument("capture")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--path", help="the server's Unix socket, instead of host and port")
+    parser.add_argument("--speed", default="1", help="1 for recorded pace, N for N times faster, or max")
+    parser.add_argument("--window", type=int, default=1, help="requests in flight per connection at max speed")
+    parser.add_argument("--connections", type=int, help="replay only the first N captured connections")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    speed = None if args.speed == "max" else float(args.speed)
+    if args.path:
+        connect = lambda: asyncio.open_unix_connection(args.path)
+    else:
+        connect = lambda: asyncio.open_connection(args.host, args.port)
+    report = asyncio.run(replay(args.capture, connect, speed, args.window, args.connections))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
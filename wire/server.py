@@ -1,12 +1,42 @@
-import socket
+import argparse
+import hmac
+import json
+import os
+import queue
+import secrets
+import sys
 import threading
 import logging
-import fnmatch
 import signal
 import select
+import time
+import weakref
+
+# The storage engine lives in the repository root, shared with the gRPC server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from chatstore import AttachmentStore, ChatStore, HistoryStore, MemoryChatStore, open_store
 from codes import Requests, Responses
-from base_server import BaseServer
-from user import User
+from base_server import BaseServer, configure_logging
+from admission import AdmissionController, parse_operations
+from protocol import WireProtocol, HEADER_SIZE, MAX_FRAME_SIZE
+from session import SessionManager
+from cluster import ClusterChatStore, handle_peer_frame
+from recorder import TrafficRecorder
+from profiler import check_sort_key, format_allocations, format_cprofile, format_samples
+from presence import PresenceService
+from settings import add_arguments, settings_from_args
+from transport import UnixListener, local_address, parse_listener, peer_address, recv_exact
+from handoff import TAKEOVER, await_confirmation, confirm_handoff, request_handoff, send_handoff
+
+# The most messages a HISTORY reply holds
+MAX_HISTORY_PAGE = 500
+# The most messages a SEARCH_MESSAGES reply holds
+MAX_SEARCH_RESULTS = 100
+# Lines per page of an ADMIN report
+ADMIN_PAGE_SIZE = 200
+# The most account changes an ACCOUNTS_CHANGED push holds
+MAX_ACCOUNT_CHANGES = 1000
 
 
 class Server(BaseServer):
@@ -18,27 +48,88 @@ class Server(BaseServer):
         port (int): The port number to use for the server.
         encoding (str): The encoding format to use for the messages.
         header_length (int): The header size of the message in bytes.
-        server (socket.socket): The server socket instance.
+        listeners (list): The listeners the server accepts connections on.
 
     Parameters:
-        host (str, optional): The IP address of the server host. Defaults to the local machine's IP address.
+        host (str, optional): The IP address of the server host. Defaults to the local machine's IP address,
+            looked up when the server starts listening.
         port (int, optional): The port number to use for the server. Defaults to 5050.
         encoding (str, optional): The encoding format to use for the messages. Defaults to 'utf-8'.
-        header_length (int, optional): The header size of the message in bytes. Defaults to 64.
+        header_length (int, optional): The header size of the message in bytes. Defaults to HEADER_SIZE.
+        admission (AdmissionController, optional): Overload protection settings. Defaults to AdmissionController().
+        listeners (list, optional): Listeners to accept connections on. Defaults to a single TCPListener on (host, port).
+        sessions (SessionManager, optional): Session resumption settings. Defaults to SessionManager().
+        store (ChatStore, optional): Where accounts and undelivered messages are kept. Defaults to MemoryChatStore().
+        history (HistoryStore, optional): Where every message is recorded for scrollback. Defaults to no history.
+        attachments (AttachmentStore, optional): Where files sent between users are kept. Defaults to no attachments.
+        max_frame_size (int, optional): The largest frame body accepted. Defaults to MAX_FRAME_SIZE.
+        backlog_batch (int, optional): The most queued messages pushed to a session before the client
+            acknowledges them. Defaults to 64.
+        recorder (TrafficRecorder, optional): Captures every frame clients send, for replay. Defaults to None.
+        admin_secret (str, optional): The secret ADMIN requests must carry. Defaults to None, which
+            turns ADMIN requests off.
+        profile_dir (str, optional): Where ADMIN requests may write profiles. Defaults to None, which
+            only allows reading them back page by page.
+        presence_interval (float, optional): The least seconds between two PRESENCE pushes to a subscriber.
+            Defaults to 1.
+        handoff_socket (str, optional): A Unix socket on which a new server process can take this one
+            over, see hand_off. Defaults to None, which turns handoffs off.
+        handoff_timeout (float, optional): Seconds a handoff waits for busy connections to reach a frame
+            boundary, and for the new process to confirm. Defaults to 10.
     """
     def __init__(self,
-        host: str = socket.gethostbyname(socket.gethostname()),
+        host: str = None,
         port: int = 5050,
         encoding: str = 'utf-8',
-        header_length: int = 64,
+        header_length: int = HEADER_SIZE,
+        admission: AdmissionController = None,
+        listeners: list = None,
+        sessions: SessionManager = None,
+        store: ChatStore = None,
+        history: HistoryStore = None,
+        attachments: AttachmentStore = None,
+        max_frame_size: int = MAX_FRAME_SIZE,
+        backlog_batch: int = 64,
+        recorder: TrafficRecorder = None,
+        admin_secret: str = None,
+        profile_dir: str = None,
+        presence_interval: float = 1.0,
+        handoff_socket: str = None,
+        handoff_timeout: float = 10.0,
     ):
-        super().__init__(host, port, encoding, header_length)
+        super().__init__(host, port, encoding, header_length, admission, listeners, max_frame_size, recorder)
         
         self.clients_lock = threading.Lock()
         self.clients = []
-        self.usernames = []
-        self.username_to_user = {}
         self.active_connections = {}
+        self.store = store if store is not None else MemoryChatStore()
+        self.history = history
+        self.attachments = attachments
+        self.backlog_batch = backlog_batch
+        # The upload in progress on each connection
+        self.uploads = {}
+        self.sessions = sessions or SessionManager()
+        self.presence = PresenceService(self._push_presence, presence_interval)
+        self.admin_secret = admin_secret
+        self.profile_dir = profile_dir
+        # The lines of the last profiling report on each connection, read back page by page
+        self.admin_reports = weakref.WeakKeyDictionary()
+        # Identifies this run of the server, as registry versions start over when it restarts
+        self.registry_epoch = secrets.token_hex(8)
+        # The connections told of every account created or deleted
+        self.account_watchers = set()
+        self.account_watchers_lock = threading.Lock()
+        self.account_changes = queue.Queue()
+        self.store.add_registry_listener(self._registry_changed)
+        self.account_notifier = threading.Thread(target=self._notify_account_watchers, daemon=True)
+        self.account_notifier.start()
+        # Only readable by the server's user, as whoever connects can take the server over
+        self.handoff_listener = UnixListener(handoff_socket, mode=0o600) if handoff_socket else None
+        self.handoff_timeout = handoff_timeout
+        if handoff_socket:
+            self.handoff_wakeup = os.pipe()
+        # Connections handed over by the process this one replaced, served once start() is called
+        self.adopted = []
 
         self.requests = {
             Requests.LOGIN: self.handle_login,
@@ -47,14 +138,23 @@ class Server(BaseServer):
             Requests.LIST_ACCOUNTS: self.handle_list_accounts,
             Requests.SEND_MESSAGE: self.handle_send_message,
             Requests.VIEW_MESSAGES: self.handle_view_messages,
-            Requests.DISCONNECT: self.disconnect
+            Requests.DISCONNECT: self.disconnect,
+            Requests.RESUME: self.handle_resume,
+            Requests.ACK: self.handle_ack,
+            Requests.PEER: self.handle_peer,
+            Requests.PEER_NOTIFY: self.handle_peer_notify,
+            Requests.HISTORY: self.handle_history,
+            Requests.SEARCH_MESSAGES: self.handle_search_messages,
+            Requests.DOWNLOAD_ATTACHMENT: self.handle_download_attachment,
+            Requests.ADMIN: self.handle_admin,
+            Requests.SUBSCRIBE_PRESENCE: self.handle_subscribe_presence,
+            Requests.WATCH_ACCOUNTS: self.handle_watch_accounts,
+        }
+        self.chunked_requests = {
+            Requests.UPLOAD_ATTACHMENT: self.handle_upload_chunk,
         }
 
-        # Create a new server socket instance and bind it to the specified host and port
         self.shutdown_flag = False
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server.bind((self.host, self.port))
 
     def _handle_signal(self, signum, frame):
         self.shutdown_flag = True
@@ -63,24 +163,283 @@ class Server(BaseServer):
     def handle_login(self, conn, msg):
         """
         Handle a login request from a client.
+        A successful login starts a new session, whose token is sent on the second line of the response.
+
+        A client that asks for delivery gets the messages queued while it was
+        offline pushed to it, in batches of at most backlog_batch frames; the
+        next batch goes out as the client acknowledges the last, so the backlog
+        shares the connection with live traffic instead of holding it up.
 
         Parameters:
         conn (socket.socket): The client socket connection.
-        msg (str): The username of the client.
+        msg (str): The username of the client and, optionally on a second line, "deliver"
+            to have queued messages pushed instead of fetched with VIEW_MESSAGES.
 
         Returns:
         dict: The response metadata in the form of a dictionary.
         """
-        username = msg
+        username, _, options = msg.partition("\n")
+        # May ask another cluster node, so not under clients_lock
+        if not self.store.exists(username):
+            return self.generate_payload(Responses.FAILURE, True, "Username does not exist")
         with self.clients_lock:
-            if username in self.usernames:
-                if username in self.active_connections:
-                    return self.generate_payload(Responses.FAILURE, True, "User already logged in")
-                else:
-                    self.active_connections[username] = conn
-                    return self.generate_payload(Responses.SUCCESS, True, "User logged in")
-            else:
-                return self.generate_payload(Responses.FAILURE, True, "Username does not exist")
+            if username in self.active_connections:
+                return self.generate_payload(Responses.FAILURE, True, "User already logged in")
+            self.active_connections[username] = conn
+            previous = self.sessions.get(username)
+            session = self.sessions.create(username, conn)
+            self.presence.set_online(username, True)
+        if previous:
+            # A full login replaces a detached session, keep what it never delivered
+            self._end_session(previous)
+        self._watch_mailbox(session)
+        if options.strip() == "deliver":
+            self._deliver_mailbox(session)
+        return self.generate_payload(Responses.SUCCESS, True, f"User logged in\n{session.token}")
+
+    def handle_resume(self, conn, msg):
+        """
+        Handle a request to reattach a session to a new connection.
+        Pushes the client has not acknowledged are sent again before the response.
+
+        Parameters:
+        conn (socket.socket): The client socket connection.
+        msg (str): The session token and, on a second line, the highest push sequence number the client received.
+
+        Returns:
+        dict: The response metadata in the form of a dictionary.
+        """
+        token, _, last_seq = msg.partition("\n")
+        with self.clients_lock:
+            session, previous = self.sessions.resume(token, conn)
+            if session is None:
+                return self.generate_payload(Responses.FAILURE, True, "Session expired")
+            if previous is not None and previous is not conn:
+                logging.info(f"[RESUME] {session.username} moved off a stale connection")
+            self.active_connections[session.username] = conn
+            self.presence.set_online(session.username, True)
+        self.presence.resync(session.username)
+        with session.lock:
+            session.ack(int(last_seq or 0))
+            pushes = [WireProtocol.encode_push(session.username, seq, self.format_message(sender, text))
+                      for seq, (sender, text) in session.unacked]
+            if pushes:
+                self.send_messages(conn, Responses.MESSAGE, pushes)
+            self._push_backlog(session)
+        return self.generate_payload(Responses.SUCCESS, True, f"Session resumed\n{session.token}")
+
+    def handle_subscribe_presence(self, conn, msg):
+        """
+        Handle a request to watch other users come online and go offline.
+        Changes are pushed as PRESENCE frames, at most one per presence_interval.
+
+        Parameters:
+        conn (socket.socket): The client socket connection.
+        msg (str): The subscribing user, then one username to watch per line. The list replaces
+            any earlier subscription; an empty list unsubscribes.
+
+        Returns:
+        dict: The response metadata in the form of a dictionary, whose message is the current
+            status of each watched user, see WireProtocol.encode_presence.
+        """
+        username, *watched = msg.split("\n")
+        with self.clients_lock:
+            if self.active_connections.get(username) is not conn:
+                return self.generate_payload(Responses.FAILURE, True, "User is not logged in on this connection.")
+        try:
+            statuses = self.presence.subscribe(username, [name for name in watched if name])
+        except ValueError as e:
+            return self.generate_payload(Responses.FAILURE, True, str(e))
+        return self.generate_payload(Responses.SUCCESS, True, WireProtocol.encode_presence(username, statuses))
+
+    def _push_presence(self, username, statuses):
+        """
+        Push status changes to a subscriber, for the presence service.
+
+        Returns:
+        bool: False if the subscriber's session is detached or its connection failed.
+        """
+        session = self.sessions.get(username)
+        conn = session.conn if session else None
+        if conn is None:
+            return False
+        try:
+            self.send_message(conn, Responses.PRESENCE, WireProtocol.encode_presence(username, statuses))
+        except OSError:
+            return False
+        return True
+
+    def handle_watch_accounts(self, conn, msg):
+        """
+        Handle a request to be told of every account created or deleted, for as long as the connection lasts.
+        Changes are pushed as ACCOUNTS_CHANGED frames, numbered by registry version, so a client can
+        keep a cache of LIST_ACCOUNTS results up to date.
+
+        Parameters:
+        conn (socket.socket): The client socket connection.
+        msg (str): Unused.
+
+        Returns:
+        dict: The response metadata in the form of a dictionary, whose message is "epoch:version",
+            the registry version changes will be pushed after.
+        """
+        if isinstance(self.store, ClusterChatStore):
+            # Accounts are created on whichever node owns them, and versions are not shared
+            return self.generate_payload(Responses.FAILURE, True, "Account changes cannot be watched on a cluster.")
+        # Watch before reading the version, so no later change can be missed
+        with self.account_watchers_lock:
+            self.account_watchers.add(conn)
+        return self.generate_payload(Responses.SUCCESS, True, f"{self.registry_epoch}:{self.store.registry_version}")
+
+    def _registry_changed(self, version, created, username):
+        # Called by the store under its registry lock, so changes are queued in version order
+        self.account_changes.put((version, created, username))
+
+    def _notify_account_watchers(self):
+        """
+        Push queued account changes to the watchers, batching whatever piled up while the previous push was sent.
+        Runs until a None is queued.
+        """
+        closing = False
+        while not closing:
+            changes = [self.account_changes.get()]
+            while len(changes) < MAX_ACCOUNT_CHANGES:
+                try:
+                    changes.append(self.account_changes.get_nowait())
+                except queue.Empty:
+                    break
+            if None in changes:
+                closing = True
+                changes = [change for change in changes if change is not None]
+            with self.account_watchers_lock:
+                watchers = list(self.account_watchers)
+            if not changes or not watchers:
+                continue
+            body = WireProtocol.encode_account_changes(self.registry_epoch, changes)
+            for conn in watchers:
+                try:
+                    self.send_message(conn, Responses.ACCOUNTS_CHANGED, body)
+                except OSError:
+                    with self.account_watchers_lock:
+                        self.account_watchers.discard(conn)
+
+    def handle_ack(self, conn, msg):
+        """
+        Handle a client acknowledging the pushes it has received. No response is sent.
+
+        Parameters:
+        conn (socket.socket): The client socket connection.
+        msg (str): The username and, on a second line, the highest push sequence number received.
+
+        Returns:
+        dict: The response metadata in the form of a dictionary.
+        """
+        username, _, seq = msg.partition("\n")
+        session = self.sessions.get(username)
+        if session and session.conn is conn:
+            with session.lock:
+                session.ack(int(seq))
+                self._push_backlog(session)
+        return self.generate_payload(Responses.SUCCESS, True, None)
+
+    def _watch_mailbox(self, session):
+        """
+        Push messages that reach the user's mailbox without going through this server,
+        e.g. sent through another cluster node, for as long as the session lasts.
+
+        Parameters:
+        session (Session): A new session.
+        """
+        session.waiter = lambda: self._deliver_mailbox(session)
+        self.store.add_waiter(session.username, session.waiter)
+
+    def _deliver_mailbox(self, session):
+        with session.lock:
+            if self.sessions.get(session.username) is not session:
+                return
+            session.backlog.extend(self.store.drain(session.username))
+            self._push_backlog(session)
+
+    def _push_backlog(self, session):
+        """
+        Push the next batch of a session's backlog in one write, as far as the window of
+        unacknowledged pushes allows. Must be called with the session's lock held.
+
+        Parameters:
+        session (Session): The session to push to.
+        """
+        if not session.conn:
+            return
+        pushes = []
+        while session.backlog and len(session.unacked) < self.backlog_batch:
+            sender, text = session.backlog.popleft()
+            seq = session.record_push((sender, text))
+            pushes.append(WireProtocol.encode_push(session.username, seq, self.format_message(sender, text)))
+        if pushes:
+            try:
+                self.send_messages(session.conn, Responses.MESSAGE, pushes)
+            except OSError:
+                # Kept as unacknowledged, so they are replayed on resume
+                pass
+
+    def _end_session(self, session):
+        """
+        Stop watching an ended session's mailbox and move its unacknowledged pushes and
+        undelivered backlog back into it.
+
+        Parameters:
+        session (Session): A session that has ended.
+        """
+        if session.waiter:
+            self.store.remove_waiter(session.username, session.waiter)
+        # A new login starts without subscriptions, it has not answered yet so cannot have made any
+        self.presence.unsubscribe(session.username)
+        for seq, (sender, text) in session.unacked:
+            self.store.enqueue(session.username, sender, text)
+        for sender, text in session.backlog:
+            self.store.enqueue(session.username, sender, text)
+
+    @staticmethod
+    def format_message(sender, text):
+        return f"<{sender}>: {text}"
+
+    def expire_sessions(self):
+        """
+        End sessions whose grace period has run out, keeping their undelivered pushes.
+        """
+        expired = self.sessions.expire()
+        if expired:
+            for session in expired:
+                self._end_session(session)
+            logging.info(f"[SESSIONS] Expired {len(expired)} detached sessions")
+
+    def handle_peer(self, conn, msg):
+        """
+        Handle an internal store request from another cluster node.
+
+        Parameters:
+        conn (socket.socket): The peer's connection.
+        msg (str): The JSON encoded request.
+
+        Returns:
+        dict: The response metadata in the form of a dictionary.
+        """
+        status, message = handle_peer_frame(self.store, Requests.PEER, msg)
+        return self.generate_payload(status, True, message)
+
+    def handle_peer_notify(self, conn, msg):
+        """
+        Handle a cluster node telling us a message arrived for a user we are watching. No response is sent.
+
+        Parameters:
+        conn (socket.socket): The peer's connection.
+        msg (str): The JSON encoded notification.
+
+        Returns:
+        dict: The response metadata in the form of a dictionary.
+        """
+        status, message = handle_peer_frame(self.store, Requests.PEER_NOTIFY, msg)
+        return self.generate_payload(status, True, message)
 
     def handle_create_account(self, conn, msg):
         """
@@ -94,14 +453,10 @@ class Server(BaseServer):
         dict: The response metadata in the form of a dictionary.
         """
         username = msg
-        with self.clients_lock:
-            if username in self.usernames:
-                return self.generate_payload(Responses.FAILURE, True, "Username already exists")
-            else:
-                new_user = User(username)
-                self.usernames.append(username)
-                self.username_to_user[username] = new_user
-                return self.generate_payload(Responses.SUCCESS, True, "User Created")
+        if self.store.create_account(username):
+            return self.generate_payload(Responses.SUCCESS, True, "User Created")
+        else:
+            return self.generate_payload(Responses.FAILURE, True, "Username already exists")
 
     def handle_delete_account(self, conn, msg):
         """
@@ -118,14 +473,17 @@ class Server(BaseServer):
         with self.clients_lock:
             if username in self.active_connections:
                 return self.generate_payload(Responses.FAILURE, True, "Account is logged in right now")
-            elif username in self.usernames:
-                user = self.username_to_user[username]
-                del user
-                self.usernames.remove(username)
-                del self.username_to_user[username]
-                return self.generate_payload(Responses.SUCCESS, True, "Account deleted successfully")
-            else:
-                return self.generate_payload(Responses.FAILURE, True, "Account not found")
+            session = self.sessions.end(username)
+        # The store is called without clients_lock, and the detached session's waiter is gone
+        # before the delete wakes it, as the waiter drains the store
+        if session:
+            if session.waiter:
+                self.store.remove_waiter(username, session.waiter)
+            self.presence.unsubscribe(username)
+        if self.store.delete_account(username):
+            return self.generate_payload(Responses.SUCCESS, True, "Account deleted successfully")
+        else:
+            return self.generate_payload(Responses.FAILURE, True, "Account not found")
 
     def handle_list_accounts(self, conn, msg):
         """
@@ -134,16 +492,23 @@ class Server(BaseServer):
 
         Parameters:
         conn (socket.socket): The client socket connection.
-        msg (str): The query to search for.
+        msg (str): The query to search for, optionally followed by a "versioned" line. A versioned
+            request always succeeds, and the answer starts with an "epoch:version" line giving the
+            registry version the result is at least as new as, for a cache kept by WATCH_ACCOUNTS.
 
         Returns:
         dict: The response metadata in the form of a dictionary.
         """
-        query = msg.strip()
-        matching_accounts = []
-        for username in self.usernames:
-            if fnmatch.fnmatch(username, query):
-                matching_accounts.append(username)
+        query, _, options = msg.partition("\n")
+        query = query.strip()
+        if options.strip() == "versioned":
+            # Read before searching: a change made during the search may or may not be in the
+            # result, and is pushed to watchers either way
+            version = self.store.registry_version
+            matching_accounts = self.store.search(query)
+            return self.generate_payload(Responses.SUCCESS, True,
+                "\n".join([f"{self.registry_epoch}:{version}"] + matching_accounts))
+        matching_accounts = self.store.search(query)
         if matching_accounts:
             response_message = "\n".join(matching_accounts)
             return self.generate_payload(Responses.SUCCESS, True, f"\n{response_message}")
@@ -166,25 +531,38 @@ class Server(BaseServer):
         receiver = receiver.strip()
         text_message = text_message.strip()
 
-        if receiver not in self.usernames:
+        if not self.store.exists(receiver):
             return self.generate_payload(Responses.FAILURE, True, "Receiver not found.")
 
-        receiver_conn = None
-        with self.clients_lock:
-            for username in self.usernames:
-                if username == receiver:
-                    receiver_conn = self.active_connections.get(username)
-                    break
+        if self.history:
+            self.history.append(sender, receiver, text_message)
 
-        if receiver_conn:
-            msg = f"\n<{sender}>: {text_message}"
-            self.send_message(receiver_conn, Responses.SUCCESS, msg)
+        session = self.sessions.get(receiver)
+        if session:
+            # Logged in, or disconnected within the grace period: the message is
+            # kept by the session until acknowledged, and replayed if it is resumed
+            with session.lock:
+                if not session.can_push():
+                    # Detached, behind the backlog or with a full window: pushed as the client
+                    # acknowledges or resumes, or put back in the mailbox if the session ends
+                    session.backlog.append((sender, text_message))
+                    self._push_backlog(session)
+                    return self.generate_payload(Responses.SUCCESS, True, "Message Queued.")
+                seq = session.record_push((sender, text_message))
+                push = WireProtocol.encode_push(receiver, seq, self.format_message(sender, text_message))
+                try:
+                    self.send_message(session.conn, Responses.MESSAGE, push)
+                except OSError:
+                    # Not written, so it waits in the backlog rather than counting as pushed
+                    session.unacked.pop()
+                    session.next_seq -= 1
+                    session.backlog.append((sender, text_message))
+                    return self.generate_payload(Responses.SUCCESS, True, "Message Queued.")
             return self.generate_payload(Responses.SUCCESS, True, "Message sent.")
-        else:
-            user = (self.username_to_user[receiver])
-            user.add_message(f"\n<{sender}>: {text_message}")
-            print(user.message_queue)
+        elif self.store.enqueue(receiver, sender, text_message):
             return self.generate_payload(Responses.SUCCESS, True, "Message Queued.")
+        else:
+            return self.generate_payload(Responses.FAILURE, True, "Receiver not found.")
 
 
     def handle_view_messages(self, conn, msg=""):
@@ -193,28 +571,448 @@ class Server(BaseServer):
 
         Parameters:
         conn (socket.socket): The client socket connection.
-        msg (str, optional): The request message. Defaults to an empty string.
+        msg (str, optional): The user whose messages to view, for connections shared by several
+            logged in users. Defaults to the user logged in on this connection.
 
         Returns:
         dict: The response metadata in the form of a dictionary.
         """
         with self.clients_lock:
             username = None
-            for u, connection in self.active_connections.items():
-                if connection == conn:
-                    username = u
-            
+            if msg:
+                if self.active_connections.get(msg) is conn:
+                    username = msg
+            else:
+                for u, connection in self.active_connections.items():
+                    if connection == conn:
+                        username = u
+
             if username:
-                user = self.username_to_user[username]
-                message = ""
-                msg = user.get_message()
-                while msg:
-                    message += (msg)
-                    msg = user.get_message()
+                messages = self.store.drain(username)
+                message = "".join(f"\n{self.format_message(sender, text)}" for sender, text in messages)
                 return self.generate_payload(Responses.SUCCESS, True, message)
             else:
                 return self.generate_payload(Responses.FAILURE, True, "Server thinks user does not exist.")
 
+    def handle_history(self, conn, msg):
+        """
+        Handle a request for a page of the conversation between two users.
+
+        Parameters:
+        conn (socket.socket): The client socket connection.
+        msg (str): The user logged in on this connection, the other user, and optionally the start
+            and end timestamps, the page size and the previous page's token, one per line.
+
+        Returns:
+        dict: The response metadata in the form of a dictionary. On success the first line is the
+            next page's token, empty on the last page, followed by one "timestamp\tsender\ttext"
+            line per message, oldest first.
+        """
+        if not self.history:
+            return self.generate_payload(Responses.FAILURE, True, "History is not enabled.")
+        fields = msg.split("\n")
+        username, peer = fields[0].strip(), fields[1].strip() if len(fields) > 1 else ""
+        with self.clients_lock:
+            if not username or self.active_connections.get(username) is not conn:
+                return self.generate_payload(Responses.FAILURE, True, "Server thinks user does not exist.")
+        try:
+            start = float(fields[2]) if len(fields) > 2 and fields[2] else 0.0
+            end = float(fields[3]) if len(fields) > 3 and fields[3] else float("inf")
+            limit = min(int(fields[4]), MAX_HISTORY_PAGE) if len(fields) > 4 and fields[4] else MAX_HISTORY_PAGE
+            messages, token = self.history.range(username, peer, start, end, max(limit, 1), fields[5] if len(fields) > 5 else "")
+        except ValueError:
+            return self.generate_payload(Responses.FAILURE, True, "Invalid history request.")
+        lines = "".join(f"\n{ts!r}\t{sender}\t{text}" for ts, sender, text in messages)
+        return self.generate_payload(Responses.SUCCESS, True, f"{token}{lines}")
+
+    def handle_search_messages(self, conn, msg):
+        """
+        Handle a search through the messages a user has sent and received.
+
+        Parameters:
+        conn (socket.socket): The client socket connection.
+        msg (str): The user logged in on this connection, the words to look for, and optionally
+            the number of results and the previous page's token, one per line.
+
+        Returns:
+        dict: The response metadata in the form of a dictionary. On success the first line is the
+            next page's token, empty on the last page, followed by one
+            "timestamp\tsender\treceiver\ttext" line per message, newest first.
+        """
+        if not self.history:
+            return self.generate_payload(Responses.FAILURE, True, "History is not enabled.")
+        fields = msg.split("\n")
+        username = fields[0].strip()
+        with self.clients_lock:
+            if not username or self.active_connections.get(username) is not conn:
+                return self.generate_payload(Responses.FAILURE, True, "Server thinks user does not exist.")
+        query = fields[1] if len(fields) > 1 else ""
+        try:
+            limit = min(int(fields[2]), MAX_SEARCH_RESULTS) if len(fields) > 2 and fields[2] else 20
+            messages, token = self.history.search(username, query, max(limit, 1), fields[3] if len(fields) > 3 else "")
+        except ValueError:
+            return self.generate_payload(Responses.FAILURE, True, "Invalid search request.")
+        lines = "".join(f"\n{ts!r}\t{sender}\t{receiver}\t{text}" for ts, sender, receiver, text in messages)
+        return self.generate_payload(Responses.SUCCESS, True, f"{token}{lines}")
+
+    def handle_upload_chunk(self, conn, index, more, payload):
+        """
+        Handle one chunk of an attachment upload. Chunk 0 is the sender, receiver, file name and
+        size, one per line; the file's contents follow in the later chunks and are written straight
+        to disk. The receiver is sent a chat message with the attachment's id once it is complete.
+
+        Parameters:
+        conn (socket.socket): The client socket connection.
+        index (int): The chunk's position within the upload.
+        more (bool): Whether more chunks follow.
+        payload (bytes): The chunk's payload.
+
+        Returns:
+        dict: The response metadata in the form of a dictionary, or None while the upload goes on.
+            On success the message is the attachment's id.
+        """
+        if index == 0:
+            previous = self.uploads.pop(conn, None)
+            if previous:
+                previous.abort()
+            if not self.attachments:
+                return self.generate_payload(Responses.FAILURE, True, "Attachments are not enabled.")
+            try:
+                sender, receiver, filename, size = payload.decode(self.encoding).split("\n")
+                size = int(size)
+            except ValueError:
+                return self.generate_payload(Responses.FAILURE, True, "Invalid attachment.")
+            with self.clients_lock:
+                if self.active_connections.get(sender) is not conn:
+                    return self.generate_payload(Responses.FAILURE, True, "Server thinks user does not exist.")
+            if not self.store.exists(receiver):
+                return self.generate_payload(Responses.FAILURE, True, "Receiver not found.")
+            try:
+                upload = self.attachments.begin(sender, receiver, filename, size)
+            except ValueError as e:
+                return self.generate_payload(Responses.FAILURE, True, str(e))
+            self.uploads[conn] = upload
+        else:
+            upload = self.uploads[conn]
+            if index != upload.next_index or upload.size + len(payload) > upload.info["size"]:
+                self.uploads.pop(conn).abort()
+                return self.generate_payload(Responses.FAILURE, True, "Invalid attachment.")
+            upload.write(payload)
+            upload.next_index += 1
+        if more:
+            return None
+
+        del self.uploads[conn]
+        if upload.size != upload.info["size"]:
+            upload.abort()
+            return self.generate_payload(Responses.FAILURE, True, "Invalid attachment.")
+        info = upload.commit()
+        logging.info(f"[ATTACHMENT] {info['sender']} sent {info['filename']} ({info['size']} bytes) to {info['receiver']}")
+        text = f"sent you {info['filename']} ({info['size']} bytes), attachment {upload.id}"
+        self.handle_send_message(conn, f"{info['sender']}\n{info['receiver']}\n{text}")
+        return self.generate_payload(Responses.SUCCESS, True, upload.id)
+
+    def handle_download_attachment(self, conn, msg):
+        """
+        Handle a request for an attachment. The attachment is sent as chunked SUCCESS frames: chunk 0
+        is its file name and size, one per line, and the file's contents follow.
+
+        Parameters:
+        conn (socket.socket): The client socket connection.
+        msg (str): The user logged in on this connection and the attachment's id, one per line.
+
+        Returns:
+        dict: The response metadata in the form of a dictionary, with no message once the file is sent.
+        """
+        if not self.attachments:
+            return self.generate_payload(Responses.FAILURE, True, "Attachments are not enabled.")
+        username, _, attachment_id = msg.partition("\n")
+        with self.clients_lock:
+            if self.active_connections.get(username) is not conn:
+                return self.generate_payload(Responses.FAILURE, True, "Server thinks user does not exist.")
+        info = self.attachments.info(attachment_id.strip(), username)
+        if info is None:
+            return self.generate_payload(Responses.FAILURE, True, "Attachment not found.")
+        self.send_file(conn, Responses.SUCCESS, f"{info['filename']}\n{info['size']}",
+                       self.attachments.path(attachment_id.strip()), info["size"])
+        return self.generate_payload(Responses.SUCCESS, True, None)
+
+    def handle_admin(self, conn, msg):
+        """
+        Handle an operator command, such as starting or stopping a profiler.
+
+        The request is a JSON object with the admin "secret", a "command" and its options:
+        - status: which profilers are running.
+        - cprofile_start / cprofile_stop: a cProfile session across all handler threads.
+          Stopping reports the top "limit" functions by "sort" (default cumulative).
+        - sample_start / sample_stop: the sampling profiler, every "interval" seconds.
+          Stopping reports folded stacks for a flame graph.
+        - tracemalloc_start / tracemalloc_stop: allocation tracing, keeping "frames" stack frames.
+        - tracemalloc_snapshot: the top "limit" allocation sites of each handler, or their growth
+          since the previous snapshot.
+        - report: page "page" of the last report on this connection.
+        Reports come back "page_size" lines at a time, after a "page N/M" line. With a "file"
+        option they are written to that file in profile_dir instead; a cProfile report is then
+        written as pstats data, for pstats or snakeviz to load.
+
+        Parameters:
+        conn (socket.socket): The client socket connection.
+        msg (str): The JSON encoded command.
+
+        Returns:
+        dict: The response metadata in the form of a dictionary.
+        """
+        try:
+            request = json.loads(msg)
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            return self.generate_payload(Responses.FAILURE, True, "Malformed admin request.")
+        if not self.admin_secret or not hmac.compare_digest(str(request.get("secret", "")), self.admin_secret):
+            logging.warning("[ADMIN] Rejected a request with a bad secret")
+            return self.generate_payload(Responses.FAILURE, True, "Not authorized.")
+        command = request.get("command")
+        profiler = self.profiler
+        logging.info(f"[ADMIN] {command}")
+        try:
+            if command == "status":
+                return self.generate_payload(Responses.SUCCESS, True, json.dumps({
+                    "cprofile": profiler.cprofile is not None,
+                    "sampling": profiler.sampler is not None,
+                    "tracemalloc": profiler.tracing,
+                    "report_lines": len(self.admin_reports.get(conn, ())),
+                }))
+            elif command == "cprofile_start":
+                profiler.start_cprofile()
+            elif command == "cprofile_stop":
+                # Checked first, as the profile is gone once stopped
+                sort = request.get("sort", "cumulative")
+                check_sort_key(sort)
+                limit = int(request.get("limit", 50))
+                stats = profiler.stop_cprofile()
+                if stats is not None and request.get("file"):
+                    path = self._profile_path(request["file"])
+                    stats.dump_stats(path)
+                    return self.generate_payload(Responses.SUCCESS, True, f"Wrote {path}")
+                return self._admin_report(conn, format_cprofile(stats, limit, sort), request)
+            elif command == "sample_start":
+                profiler.start_sampling(float(request.get("interval", 0.005)))
+            elif command == "sample_stop":
+                return self._admin_report(conn, format_samples(profiler.stop_sampling()), request)
+            elif command == "tracemalloc_start":
+                profiler.start_tracemalloc(int(request.get("frames", 25)))
+            elif command == "tracemalloc_stop":
+                profiler.stop_tracemalloc()
+            elif command == "tracemalloc_snapshot":
+                handlers = list(self.requests.values()) + list(self.chunked_requests.values())
+                allocations, previous = profiler.snapshot_allocations(handlers)
+                lines = format_allocations(allocations, previous, int(request.get("limit", 10)))
+                return self._admin_report(conn, lines, request)
+            elif command == "report":
+                return self._admin_page(conn, request)
+            else:
+                return self.generate_payload(Responses.FAILURE, True, f"Unknown admin command {command!r}.")
+        except (ValueError, TypeError, KeyError, OSError) as e:
+            # A bad option must not cost the admin its connection
+            return self.generate_payload(Responses.FAILURE, True, str(e))
+        return self.generate_payload(Responses.SUCCESS, True, f"{command} done.")
+
+    def _profile_path(self, name):
+        if not self.profile_dir:
+            raise ValueError("The server has no profile directory to write to.")
+        # Only a file name is taken, so a request cannot write outside profile_dir
+        return os.path.join(self.profile_dir, os.path.basename(name))
+
+    def _admin_report(self, conn, lines, request):
+        """
+        Keep a report for paging through on this connection, and answer with its first page or write it to a file.
+        """
+        self.admin_reports[conn] = lines
+        if request.get("file"):
+            path = self._profile_path(request["file"])
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            return self.generate_payload(Responses.SUCCESS, True, f"Wrote {path}")
+        return self._admin_page(conn, request)
+
+    def _admin_page(self, conn, request):
+        report = self.admin_reports.get(conn, [])
+        page_size = max(1, int(request.get("page_size", ADMIN_PAGE_SIZE)))
+        pages = max(1, -(-len(report) // page_size))
+        page = int(request.get("page", 1))
+        if not 1 <= page <= pages:
+            return self.generate_payload(Responses.FAILURE, True, f"There are {pages} pages.")
+        lines = report[(page - 1) * page_size:page * page_size]
+        return self.generate_payload(Responses.SUCCESS, True, "\n".join([f"page {page}/{pages}"] + lines))
+
+    def prewarm(self):
+        """
+        Do ahead of time what the first requests would otherwise wait for, such as reading the store
+        from disk, so a freshly started server answers at full speed. Call before start().
+        """
+        started = time.monotonic()
+        self.store.prewarm()
+        # Binding looks up the host, if it is left to default, which can wait on DNS
+        self.open_listeners()
+        logging.info(f"[PREWARM] Ready to serve in {time.monotonic() - started:.3f}s")
+
+    def can_hand_off(self, conn):
+        return conn not in self.uploads and super().can_hand_off(conn)
+
+    def hand_off(self, channel):
+        """
+        Hand the listeners, client connections and sessions over to a new server process that
+        asked on the handoff socket, so restarting the server disconnects nobody.
+
+        Every handler thread stops at its next frame boundary, leaving whatever
+        its client sends next unread in the socket. The listening and client
+        sockets are then passed over `channel` with SCM_RIGHTS, along with the
+        sessions, logins, presence subscriptions and account watchers, the
+        registry version and, for a memory store, every mailbox. Connections part
+        way through an upload get until handoff_timeout to finish it; those that
+        do not, and shared memory connections, are disconnected as at shutdown,
+        and can resume their sessions on the new process. If the new process does
+        not confirm, this one serves on.
+
+        Parameters:
+        channel (socket.socket): The connection from the new process.
+
+        Returns:
+        bool: True if the new process took over, and this one must stop without disconnecting anyone.
+        """
+        if isinstance(self.store, ClusterChatStore):
+            logging.warning("[HANDOFF] Refused, cluster nodes cannot be taken over")
+            return False
+        started = time.monotonic()
+        logging.info("[HANDOFF] Stopping handlers at frame boundaries...")
+        for conn in self.quiesce(self.handoff_timeout):
+            logging.warning(f"[HANDOFF] Disconnecting {peer_address(conn)}, which cannot be handed over")
+            self._send_disconnect(conn)
+        with self.clients_lock:
+            conns = [conn for conn in self.clients if conn in self.parked]
+        conn_ids = {conn: i for i, conn in enumerate(conns)}
+        listeners = [listener for listener in self.listeners if listener.sock]
+        with self.sessions.lock:
+            sessions = list(self.sessions.by_username.values())
+        # Session locks before send locks, the order pushes take them in. Held until the new
+        # process answers, so nothing is pushed from here meanwhile
+        locks = [session.lock for session in sessions] + [self.send_lock(conn) for conn in conns]
+        for lock in locks:
+            lock.acquire()
+        confirmed = False
+        try:
+            with self.clients_lock:
+                active = {username: conn_ids[conn] for username, conn in self.active_connections.items()
+                          if conn in conn_ids}
+            with self.account_watchers_lock:
+                watchers = [conn_ids[conn] for conn in self.account_watchers if conn in conn_ids]
+            state = {
+                "listeners": [listener.describe() for listener in listeners],
+                "active_connections": active,
+                "sessions": self.sessions.export(conn_ids),
+                "subscriptions": self.presence.export(),
+                "account_watchers": watchers,
+                "registry_epoch": self.registry_epoch,
+                "registry_version": self.store.registry_version,
+                "store": self.store.snapshot(),
+            }
+            send_handoff(channel, state, [listener.sock for listener in listeners] + conns)
+            confirmed = await_confirmation(channel, self.handoff_timeout)
+            if confirmed:
+                # Our copies are closed without a shutdown(), which would end the connections for the new process too
+                with self.clients_lock:
+                    for conn in conns:
+                        self.clients.remove(conn)
+                        conn.close()
+                for listener in listeners:
+                    listener.release()
+                self.listeners = [listener for listener in self.listeners if listener not in listeners]
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            for lock in locks:
+                lock.release()
+        if not confirmed:
+            logging.error("[HANDOFF] The new process did not take over, serving on")
+            self.unquiesce()
+            return False
+        self.store.close()
+        if self.history:
+            self.history.close()
+        logging.info(f"[HANDOFF] Handed {len(conns)} connections and {len(sessions)} sessions over "
+                     f"in {time.monotonic() - started:.3f}s")
+        return True
+
+    def adopt(self, state, sockets):
+        """
+        Take over from the server process that sent `state` and `sockets`, see hand_off.
+        Call before start(), which goes on serving the connections.
+
+        Listeners are matched to this server's by address, keeping the connections waiting in
+        their backlogs; one this server is not configured with any more is closed.
+
+        Parameters:
+        state (dict): The state the old process sent.
+        sockets (list): Its listening sockets, then its client connections.
+        """
+        handed_over = dict(zip(state["listeners"], sockets))
+        conns = sockets[len(state["listeners"]):]
+        for listener in self.listeners:
+            sock = handed_over.pop(listener.describe(), None)
+            if sock is not None:
+                listener.adopt(sock)
+                logging.info(f"[HANDOFF] Took over {listener.describe()}")
+        for address, sock in handed_over.items():
+            logging.warning(f"[HANDOFF] Closing {address}, which is not configured any more")
+            sock.close()
+        self.registry_epoch = state["registry_epoch"]
+        if state["store"] is not None:
+            self.store.restore(state["store"])
+        with self.store.registry_lock:
+            self.store.registry_version = state["registry_version"]
+        with self.clients_lock:
+            self.clients.extend(conns)
+            for username, i in state["active_connections"].items():
+                self.active_connections[username] = conns[i]
+                self.presence.set_online(username, True)
+        sessions = self.sessions.restore(state["sessions"], conns)
+        for session in sessions:
+            self._watch_mailbox(session)
+        self.presence.restore(state["subscriptions"])
+        with self.account_watchers_lock:
+            self.account_watchers.update(conns[i] for i in state["account_watchers"])
+        for _ in conns:
+            self.admission.adopt_connection()
+        self.adopted = conns
+        logging.info(f"[HANDOFF] Took over {len(conns)} connections and {len(sessions)} sessions")
+
+    def _accept_takeover(self):
+        """
+        Answer a connection on the handoff socket.
+
+        Returns:
+        bool: True if the server was handed off.
+        """
+        channel, _ = self.handoff_listener.accept()
+        with channel:
+            channel.settimeout(self.handoff_timeout)
+            try:
+                request = recv_exact(channel, len(TAKEOVER))
+            except OSError:
+                request = None
+            if request != TAKEOVER:
+                logging.warning("[HANDOFF] Ignoring a malformed takeover request")
+                return False
+            channel.settimeout(None)
+            return self.hand_off(channel)
+
+    def _send_disconnect(self, conn):
+        try:
+            self.send_message(conn, Responses.DISCONNECT, "You have been disconnected!")
+        except OSError:
+            pass
+        self.disconnect(conn)
+
     def disconnect(self, conn, msg=""):
         """
         Handle a disconnect request from a client.
@@ -226,17 +1024,24 @@ class Server(BaseServer):
         Returns:
         dict: The response metadata in the form of a dictionary.
         """
-        index = self.clients.index(conn)
-        self.clients.pop(index)
-
-        if conn in self.active_connections.values():
-            for k in self.active_connections.copy():
-                if self.active_connections[k] == conn:
-                    print(k, conn)
-                    del self.active_connections[k]
+        upload = self.uploads.pop(conn, None)
+        if upload:
+            upload.abort()
+        # Safe to call more than once for the same connection, e.g. by both the
+        # shutdown loop and the client's handler thread
+        with self.account_watchers_lock:
+            self.account_watchers.discard(conn)
+        with self.clients_lock:
+            if conn in self.clients:
+                self.clients.remove(conn)
+            usernames = [u for u, c in self.active_connections.items() if c is conn]
+            for username in usernames:
+                del self.active_connections[username]
+                self.presence.set_online(username, False)
+            # Sessions stay resumable for the grace period
+            self.sessions.detach(conn, usernames)
         conn.close()
         return self.generate_payload(Responses.SUCCESS, False, "Disconnected!")
-        
 
     def start(self):
         """
@@ -245,31 +1050,123 @@ class Server(BaseServer):
         signal.signal(signal.SIGINT, self._handle_signal)
 
         self.start_logger()
-        self.server.listen()
-        logging.info(f"[LISTENING] Server is listening on port {self.port}")
+        self.open_listeners()
+        if self.handoff_listener:
+            self.handoff_listener.open()
+            logging.info(f"[HANDOFF] A new process can take over on {self.handoff_listener.describe()}")
+        for conn in self.adopted:
+            threading.Thread(target=self.handle_client, args=(conn, peer_address(conn))).start()
+        self.adopted = []
 
-        while not self.shutdown_flag:
-            ready, _, _ = select.select([self.server], [], [], 1.0)
-            if self.server in ready:
-                conn, addr = self.server.accept()
+        handed_off = False
+        while not self.shutdown_flag and not handed_off:
+            self.expire_sessions()
+            waitable = self.listeners + ([self.handoff_listener] if self.handoff_listener else [])
+            ready, _, _ = select.select(waitable, [], [], 1.0)
+            for listener in ready:
+                if listener is self.handoff_listener:
+                    handed_off = self._accept_takeover()
+                    if handed_off:
+                        break
+                    continue
+                try:
+                    conn, addr = listener.accept()
+                except OSError as e:
+                    # e.g. the client gave up before it was accepted, or we are out of file descriptors
+                    logging.warning(f"[ACCEPT] {listener.describe()}: {e!r}")
+                    continue
+                admitted, retry_after, reason = self.admission.admit_connection()
+                if not admitted:
+                    if listener.handshake:
+                        # The hint can only be sent once the handshake is done, which must not hold up accepting
+                        threading.Thread(target=self.reject_client, daemon=True,
+                                         args=(listener, conn, addr, retry_after, reason)).start()
+                    else:
+                        self.reject_connection(conn, addr, retry_after, reason)
+                    continue
                 with self.clients_lock:
                     self.clients.append(conn)
-                thread = threading.Thread(target=self.handle_client, args=(conn, addr))
+                thread = threading.Thread(target=self.serve_client, args=(listener, conn, addr))
                 thread.start()
                 logging.info(f"[ACTIVE CONNECTIONS] {threading.active_count() - 1}")
 
         # Shutdown the server gracefully
-        logging.info("[SHUTTING DOWN] Closing server socket...")
+        logging.info("[SHUTTING DOWN] Closing server sockets...")
 
+        # After a handoff only the connections that could not be handed over are left
         with self.clients_lock:
-            while self.clients:
-                conn = self.clients[0]
-                self.send_message(conn, Responses.DISCONNECT, "You have been disconnected!")
-                self.disconnect(conn)
+            clients = list(self.clients)
+        for conn in clients:
+            self._send_disconnect(conn)
 
-        self.server.close()
+        if self.handoff_listener:
+            if handed_off:
+                # The socket path is the new process's now
+                self.handoff_listener.release()
+            else:
+                self.handoff_listener.close()
+        self.close_listeners()
+        self.presence.close()
+        self.store.remove_registry_listener(self._registry_changed)
+        self.account_changes.put(None)
+        self.account_notifier.join()
+        if self.recorder:
+            self.recorder.close()
         logging.info("[SHUTDOWN COMPLETE] Goodbye!")
 
-if __name__ == "__main__":
-    server = Server()
+def main(settings: dict) -> None:
+    """
+    Build a server and its stores from settings, see settings.load_settings, and run it until it is stopped.
+    """
+    configure_logging()
+    takeover = None
+    if settings["takeover"]:
+        if not settings["handoff_socket"]:
+            raise ValueError("Taking over needs the old server's handoff socket")
+        # The old server stops serving here, before the stores are opened, so they are read
+        # after its last write
+        takeover = request_handoff(settings["handoff_socket"])
+    store = open_store(settings["store"])
+    history = HistoryStore(settings["history"], ttl=settings["history_ttl"]) if settings["history"] else None
+    attachments = AttachmentStore(settings["attachments"]) if settings["attachments"] else None
+    if settings["peers"]:
+        node = settings["node"] or f"{settings['host'] or local_address()}:{settings['port']}"
+        peers = [peer for peer in settings["peers"].split(",") if peer and peer != node]
+        store = ClusterChatStore(store, node, peers, settings["cluster_secret"])
+    recorder = TrafficRecorder(settings["record"]) if settings["record"] else None
+    admission = AdmissionController(
+        max_connections=settings["max_connections"],
+        accept_rate=settings["accept_rate"],
+        accept_burst=settings["accept_burst"],
+        backlog=settings["backlog"],
+        max_inflight=settings["max_inflight"],
+        latency_threshold=settings["latency_threshold"],
+        shed_operations=parse_operations(settings["shed_operations"]),
+        retry_after=settings["retry_after"],
+    )
+    listeners = [parse_listener(spec) for spec in settings["listen"]] or None
+    server = Server(settings["host"], settings["port"], admission=admission, listeners=listeners, store=store, history=history, attachments=attachments,
+                    max_frame_size=settings["max_frame_size"], recorder=recorder,
+                    admin_secret=settings["admin_secret"], profile_dir=settings["profile_dir"],
+                    presence_interval=settings["presence_interval"],
+                    handoff_socket=settings["handoff_socket"], handoff_timeout=settings["handoff_timeout"])
+    if takeover:
+        channel, state, sockets = takeover
+        server.adopt(state, sockets)
+    if settings["prewarm"]:
+        server.prewarm()
+    if takeover:
+        # The old server lets go once told, and serves on if this process fails before
+        confirm_handoff(channel)
+    if settings["peers"]:
+        # Our peers need to reach us before we can hand accounts over
+        server.open_listeners()
+        store.join()
     server.start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wire protocol chat server. Every setting can also be given "
+                                     "in a JSON config file or a CHAT_* environment variable")
+    add_arguments(parser)
+    main(settings_from_args(parser.parse_args()))
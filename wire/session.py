@@ -0,0 +1,241 @@
+import collections
+import secrets
+import threading
+import time
+
+
+class Session:
+    """
+    The server-side state of a logged in user, which outlives its connection for a grace period.
+
+    Every message pushed to the user gets a sequence number and is kept until
+    the client acknowledges it, so a client that resumes the session after a
+    dropped connection is sent exactly the pushes it has not seen.
+
+    Attributes:
+        username (str): The user the session belongs to.
+        token (str): The secret the client presents to resume the session.
+        conn (socket.socket): The connection the session is attached to, or None while detached.
+        detached_at (float): When the session lost its connection, as a time.monotonic() value.
+        next_seq (int): The sequence number of the next push.
+        unacked (collections.deque): (seq, (sender, text)) pairs written to the connection and not yet
+            acknowledged, oldest first. Never more than max_unacked.
+        lock (threading.Lock): Held while recording and writing a push, so pushes reach the client in sequence order.
+        waiter (callable): The callback the server registered with its store for this session, if any.
+        backlog (collections.deque): (sender, text) pairs not pushed yet, oldest first: taken from the
+            mailbox, or sent while the session was detached or its window of unacknowledged pushes was full.
+        max_unacked (int): The most pushes awaiting acknowledgement.
+    """
+    def __init__(self, username, conn, max_unacked):
+        self.username = username
+        self.token = secrets.token_urlsafe(16)
+        self.conn = conn
+        self.detached_at = None
+        self.next_seq = 1
+        self.unacked = collections.deque()
+        self.max_unacked = max_unacked
+        self.lock = threading.Lock()
+        self.waiter = None
+        self.backlog = collections.deque()
+
+    def can_push(self):
+        """
+        Whether a new message can be pushed right away: the session is attached, nothing is waiting
+        in the backlog ahead of it, and the window of unacknowledged pushes has room.
+        Must be called with the session's lock held.
+        """
+        return self.conn is not None and not self.backlog and len(self.unacked) < self.max_unacked
+
+    def record_push(self, message):
+        """
+        Assign the next sequence number to a message and keep it until it is acknowledged.
+
+        Parameters:
+        message (tuple): The (sender, text) pair being pushed.
+
+        Returns:
+        int: The message's sequence number.
+        """
+        seq = self.next_seq
+        self.next_seq += 1
+        self.unacked.append((seq, message))
+        return seq
+
+    def ack(self, seq):
+        """
+        Drop every unacknowledged push up to and including `seq`.
+
+        Parameters:
+        seq (int): The highest sequence number the client has received.
+        """
+        while self.unacked and self.unacked[0][0] <= seq:
+            self.unacked.popleft()
+
+
+class SessionManager:
+    """
+    Issues session tokens at login and lets a new connection reattach to a session.
+
+    All methods are thread-safe. A Session's pushes and acknowledgements are
+    guarded by its own lock, its attachment to a connection by the manager's.
+
+    Parameters:
+        grace_period (float, optional): Seconds a detached session can be resumed. Defaults to 30.
+        max_unacked (int, optional): The most pushes awaiting acknowledgement per session; messages
+            beyond that wait in the session's backlog. Defaults to 1000.
+    """
+    def __init__(self, grace_period=30.0, max_unacked=1000):
+        self.grace_period = grace_period
+        self.max_unacked = max_unacked
+        self.lock = threading.RLock()
+        self.by_username = {}
+        self.by_token = {}
+
+    def get(self, username):
+        """
+        Returns:
+        Session: The user's session, attached or detached, or None.
+        """
+        return self.by_username.get(username)
+
+    def create(self, username, conn):
+        """
+        Start a new session for a user, ending any previous one.
+
+        Parameters:
+        username (str): The user logging in.
+        conn (socket.socket): The connection the user logged in on.
+
+        Returns:
+        Session: The new session.
+        """
+        with self.lock:
+            self.end(username)
+            session = Session(username, conn, self.max_unacked)
+            self.by_username[username] = session
+            self.by_token[session.token] = session
+            return session
+
+    def resume(self, token, conn):
+        """
+        Attach a connection to the session identified by `token`.
+
+        Parameters:
+        token (str): The token issued at login.
+        conn (socket.socket): The new connection.
+
+        Returns:
+        tuple: The session, or None if the token is unknown or expired, and the
+            connection it was previously attached to, if any.
+        """
+        with self.lock:
+            session = self.by_token.get(token)
+            if session is None or self._expired(session, time.monotonic()):
+                return None, None
+            previous, session.conn, session.detached_at = session.conn, conn, None
+            return session, previous
+
+    def detach(self, conn, usernames):
+        """
+        Detach the sessions of users whose connection has gone away.
+
+        Parameters:
+        conn (socket.socket): The closed connection.
+        usernames (list): The users that were logged in on it.
+        """
+        with self.lock:
+            now = time.monotonic()
+            for username in usernames:
+                session = self.by_username.get(username)
+                if session and session.conn is conn:
+                    session.conn = None
+                    session.detached_at = now
+
+    def end(self, username):
+        """
+        Forget a user's session.
+
+        Returns:
+        Session: The ended session, or None if the user had none.
+        """
+        with self.lock:
+            session = self.by_username.pop(username, None)
+            if session:
+                del self.by_token[session.token]
+            return session
+
+    def expire(self):
+        """
+        End every session that has been detached for longer than the grace period.
+
+        Returns:
+        list: The expired sessions, so the caller can keep their unacknowledged messages.
+        """
+        with self.lock:
+            now = time.monotonic()
+            expired = [s for s in self.by_username.values() if self._expired(s, now)]
+            for session in expired:
+                self.end(session.username)
+            return expired
+
+    def export(self, conn_ids):
+        """
+        Describe every session as JSON serializable records, for a server process taking over.
+        Each session's lock must be held, so no push is recorded meanwhile.
+
+        Parameters:
+        conn_ids (dict): The position of each connection handed over, by connection.
+
+        Returns:
+        list: One record per session. A session on a connection not handed over is recorded as detached.
+        """
+        with self.lock:
+            now = time.monotonic()
+            records = []
+            for session in self.by_username.values():
+                conn = conn_ids.get(session.conn)
+                detached_for = None
+                if conn is None:
+                    detached_for = now - session.detached_at if session.detached_at is not None else 0.0
+                records.append({
+                    "username": session.username,
+                    "token": session.token,
+                    "conn": conn,
+                    "detached_for": detached_for,
+                    "next_seq": session.next_seq,
+                    "unacked": list(session.unacked),
+                    "backlog": list(session.backlog),
+                })
+            return records
+
+    def restore(self, records, conns):
+        """
+        Recreate sessions exported by another server process, with their tokens, so clients can
+        carry on or resume as if nothing happened.
+
+        Parameters:
+        records (list): What export() returned.
+        conns (list): The connections handed over, in the positions the records refer to.
+
+        Returns:
+        list: The restored sessions.
+        """
+        with self.lock:
+            now = time.monotonic()
+            sessions = []
+            for record in records:
+                conn = conns[record["conn"]] if record["conn"] is not None else None
+                session = Session(record["username"], conn, self.max_unacked)
+                session.token = record["token"]
+                if conn is None:
+                    session.detached_at = now - record["detached_for"]
+                session.next_seq = record["next_seq"]
+                session.unacked.extend((seq, tuple(message)) for seq, message in record["unacked"])
+                session.backlog.extend(tuple(message) for message in record["backlog"])
+                self.by_username[session.username] = session
+                self.by_token[session.token] = session
+                sessions.append(session)
+            return sessions
+
+    def _expired(self, session, now):
+        return session.detached_at is not None and now - session.detached_at > self.grace_period
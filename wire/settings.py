@@ -0,0 +1,130 @@
+import argparse
+import json
+import os
+
+from protocol import MAX_FRAME_SIZE
+
+# A setting's environment variable is its name in upper case after this prefix, e.g. CHAT_PORT
+ENV_PREFIX = "CHAT_"
+
+# The environment variable naming a config file, when --config is not given
+CONFIG_ENV = "CHAT_CONFIG"
+
+# (name, type, default, help) of every server setting
+SETTINGS = [
+    ("host", str, None, "address to listen on. Defaults to this machine's address"),
+    ("port", int, 5050, "port to listen on"),
+    ("listen", list, [], "listener address, e.g. tcp://0.0.0.0:5050, unix:///run/chat.sock?mode=660 or "
+                         "shm:///run/chat.shm; repeat for several, in place of --host and --port"),
+    ("store", str, "memory", "memory, or journal:<path> / sqlite:<path> to persist"),
+    ("peers", str, "", "comma-separated host:port of the other cluster nodes"),
+    ("node", str, None, "this node's address as peers reach it. Defaults to host:port"),
+    ("cluster_secret", str, "", "secret cluster peers must present, required with --peers"),
+    ("history", str, None, "directory to keep message history in, not with --peers. Defaults to no history"),
+    ("history_ttl", float, None, "seconds to keep history for. Defaults to forever"),
+    ("attachments", str, None, "directory to keep attachments in. Defaults to no attachments"),
+    ("max_frame_size", int, MAX_FRAME_SIZE, "largest frame body accepted, in bytes"),
+    ("record", str, None, "capture every frame clients send to this file, for replay.py"),
+    ("admin_secret", str, None, "secret that allows ADMIN requests, e.g. from admin.py. Defaults to none allowed"),
+    ("profile_dir", str, None, "directory ADMIN requests may write profiles to"),
+    ("presence_interval", float, 1.0, "least seconds between presence pushes to a subscriber"),
+    ("max_connections", int, 1024, "most clients connected at once; more are turned away with a retry-after hint"),
+    ("accept_rate", float, 200.0, "connections accepted per second, sustained"),
+    ("accept_burst", int, 100, "connections accepted in a burst above accept_rate"),
+    ("backlog", int, 128, "listen() backlog of every listener"),
+    ("max_inflight", int, 64, "requests in progress above which shed_operations are dropped"),
+    ("latency_threshold", float, 0.25, "smoothed handler seconds above which shed_operations are dropped"),
+    ("shed_operations", str, "LIST_ACCOUNTS,VIEW_MESSAGES", "comma-separated operations dropped first under load"),
+    ("retry_after", float, 1.0, "least seconds clients turned away are told to wait"),
+    ("prewarm", bool, False, "load the stores into memory before accepting connections"),
+    ("handoff_socket", str, None, "Unix socket a new server process can take this one over on, see --takeover"),
+    ("takeover", bool, False, "start by taking the listeners, clients and sessions over from the server on --handoff-socket"),
+    ("handoff_timeout", float, 10.0, "seconds a handoff waits for uploads in progress and for the new process"),
+]
+
+DEFAULTS = {name: default for name, _, default, _ in SETTINGS}
+TYPES = {name: kind for name, kind, _, _ in SETTINGS}
+
+TRUE = ("1", "true", "yes", "on")
+FALSE = ("0", "false", "no", "off")
+
+
+def parse_value(name: str, text: str):
+    """
+    Convert a setting given as text, e.g. in an environment variable, to the setting's type.
+    A list is given comma-separated.
+
+    Raises:
+    ValueError: If the text is not a valid value.
+    """
+    kind = TYPES[name]
+    if kind is bool:
+        if text.lower() in TRUE:
+            return True
+        if text.lower() in FALSE:
+            return False
+        raise ValueError(f"Invalid value {text!r} for {name}, expected one of {', '.join(TRUE + FALSE)}")
+    if kind is list:
+        return [item.strip() for item in text.split(",") if item.strip()]
+    return kind(text)
+
+
+def load_settings(path: str = None, environ: dict = None, **overrides) -> dict:
+    """
+    Build the server settings from the defaults, an optional JSON config file, the environment
+    and overrides, each taking precedence over the ones before.
+
+    Parameters:
+    path (str, optional): A JSON file with any of the settings. Defaults to $CHAT_CONFIG, if set.
+    environ (dict, optional): Where to look for CHAT_* variables. Defaults to os.environ.
+    **overrides: Settings that take precedence over everything else, e.g. from the command line. None values are ignored.
+
+    Returns:
+    dict: The complete settings.
+
+    Raises:
+    ValueError: If the file or an override has an unknown setting, a variable has an invalid value,
+        or the settings do not go together.
+    """
+    environ = os.environ if environ is None else environ
+    settings = dict(DEFAULTS)
+    path = path or environ.get(CONFIG_ENV)
+    if path:
+        with open(path) as f:
+            settings.update(json.load(f))
+    for name in TYPES:
+        text = environ.get(ENV_PREFIX + name.upper())
+        if text is not None:
+            settings[name] = parse_value(name, text)
+    settings.update({name: value for name, value in overrides.items() if value is not None})
+    unknown = set(settings) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+    if settings["peers"] and not settings["cluster_secret"]:
+        # Peers may read and delete any mailbox, so they must not be open to every client
+        raise ValueError("Cluster mode needs a cluster_secret")
+    if settings["peers"] and settings["history"]:
+        # Each node would only keep the messages sent through it, so no node has a whole conversation
+        raise ValueError("History cannot be kept in cluster mode, drop history or peers")
+    return settings
+
+
+def add_arguments(parser) -> None:
+    """
+    Add a command line flag for every setting to an argparse parser, plus --config.
+    Flags left out fall back to the config file, the environment and the defaults.
+    """
+    parser.add_argument("--config", help=f"JSON file with any of the settings below. Defaults to ${CONFIG_ENV}")
+    for name, kind, _, help in SETTINGS:
+        flag = "--" + name.replace("_", "-")
+        help = f"{help} (${ENV_PREFIX}{name.upper()})"
+        if kind is bool:
+            parser.add_argument(flag, action=argparse.BooleanOptionalAction, default=None, help=help)
+        elif kind is list:
+            parser.add_argument(flag, action="append", default=None, help=help)
+        else:
+            parser.add_argument(flag, type=kind, default=None, help=help)
+
+
+def settings_from_args(args) -> dict:
+    return load_settings(args.config, **{name: getattr(args, name) for name in DEFAULTS})
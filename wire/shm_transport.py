@@ -0,0 +1,465 @@
+import json
+import os
+import socket
+import struct
+import threading
+from multiprocessing import shared_memory
+from transport import Listener, recv_exact, remove_stale_socket
+
+# Ring control block layout, each field on its own 8 byte slot:
+# head (total bytes written), tail (total bytes read),
+# reader waiting flag, writer waiting flag, closed flag.
+HEAD_OFFSET = 0
+TAIL_OFFSET = 8
+READER_WAITING_OFFSET = 16
+WRITER_WAITING_OFFSET = 24
+CLOSED_OFFSET = 32
+# Ring data starts on its own cache line.
+DATA_OFFSET = 64
+
+COUNTER = struct.Struct("<Q")
+
+# Default ring size, per direction. Must be a power of two.
+DEFAULT_CAPACITY = 1 << 20
+
+# How much a reader drains from the ring at once. Like a socket receive buffer,
+# this lets a header and its body be consumed with a single pass over the ring.
+READ_CHUNK = 64 * 1024
+
+# Orders a store to shared memory before the load that follows it, see _fence().
+_FENCE = threading.Lock()
+
+
+def _fence():
+    """
+    A full memory barrier. A side going to sleep stores its waiting flag and then looks at the
+    ring again, while the other side stores a new head or tail and then looks at the flag; without
+    a barrier the CPU may move each load before the store, and both sides miss each other. Taking
+    a lock is an atomic read-modify-write, which is a barrier on every platform CPython runs on.
+    """
+    with _FENCE:
+        pass
+
+
+def _attach(name):
+    """
+    Attach to an existing shared memory block without handing it to this
+    process's resource tracker, which would unlink it when we exit.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class RingBuffer:
+    """
+    A single-producer/single-consumer byte ring in shared memory.
+
+    The producer only advances head and the consumer only advances tail, so
+    neither side takes a lock. Both counters grow monotonically and are reduced
+    modulo the capacity when indexing into the data area. Each side keeps its
+    own counter locally and only reloads the other one from shared memory when
+    the cached value says the ring is full (producer) or empty (consumer).
+
+    Parameters:
+        shm (SharedMemory): The shared memory block backing the ring.
+        capacity (int): Size of the data area in bytes, a power of two.
+        owner (bool): Whether this side created the block and should unlink it.
+    """
+    def __init__(self, shm, capacity, owner):
+        if capacity & (capacity - 1) or DATA_OFFSET + capacity > shm.size:
+            raise ValueError("Ring capacity must be a power of two that fits the shared memory block")
+        self.shm = shm
+        self.owner = owner
+        self.buf = shm.buf
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.head = self.load(HEAD_OFFSET)
+        self.tail = self.load(TAIL_OFFSET)
+
+    @classmethod
+    def create(cls, capacity=DEFAULT_CAPACITY):
+        shm = shared_memory.SharedMemory(create=True, size=DATA_OFFSET + capacity)
+        shm.buf[:DATA_OFFSET] = bytes(DATA_OFFSET)
+        return cls(shm, capacity, owner=True)
+
+    @classmethod
+    def attach(cls, name, capacity):
+        return cls(_attach(name), capacity, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def load(self, offset):
+        return COUNTER.unpack_from(self.buf, offset)[0]
+
+    def store(self, offset, value):
+        COUNTER.pack_into(self.buf, offset, value)
+
+    def writable(self):
+        """
+        Returns:
+        int: Free space in bytes, as seen by the producer.
+        """
+        self.tail = self.load(TAIL_OFFSET)
+        return self.capacity - (self.head - self.tail)
+
+    def write(self, data):
+        """
+        Copy as much of `data` into the ring as fits. Producer side only.
+
+        Parameters:
+        data (memoryview): The bytes to write.
+
+        Returns:
+        int: The number of bytes written.
+        """
+        head = self.head
+        size = len(data)
+        if size > self.capacity - (head - self.tail):
+            size = min(size, self.writable())
+            if size <= 0:
+                return 0
+        start = head & self.mask
+        first = min(size, self.capacity - start)
+        self.buf[DATA_OFFSET + start:DATA_OFFSET + start + first] = data[:first]
+        if first < size:
+            self.buf[DATA_OFFSET:DATA_OFFSET + size - first] = data[first:size]
+        # Publish the data only after it has been copied in.
+        self.head = head + size
+        self.store(HEAD_OFFSET, self.head)
+        return size
+
+    def read(self, length):
+        """
+        Take up to `length` bytes out of the ring. Consumer side only.
+
+        Returns:
+        bytes: The bytes read, empty if the ring is empty.
+        """
+        tail = self.tail
+        available = self.head - tail
+        if available <= 0:
+            self.head = self.load(HEAD_OFFSET)
+            available = self.head - tail
+            if available <= 0:
+                return b""
+        size = min(length, available)
+        start = tail & self.mask
+        first = min(size, self.capacity - start)
+        data = bytes(self.buf[DATA_OFFSET + start:DATA_OFFSET + start + first])
+        if first < size:
+            data += bytes(self.buf[DATA_OFFSET:DATA_OFFSET + size - first])
+        self.tail = tail + size
+        self.store(TAIL_OFFSET, self.tail)
+        return data
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class ShmConnection:
+    """
+    A socket-like connection that moves bytes through a pair of shared memory rings.
+
+    The Unix socket used for the handshake stays open as a doorbell: a side
+    only writes a byte to it when the peer has flagged that it is asleep, so a
+    busy stream moves frames without any system calls, and a side with nothing
+    to do sleeps in a blocking recv() on it. It also carries EOF if the peer
+    process dies. The connection exposes the subset of the socket API used by
+    BaseServer and Client (recv, send, sendall, close, fileno), so wire
+    protocol frames behave exactly as they do over TCP.
+
+    Parameters:
+        sock (socket.socket): The connected Unix socket used as the doorbell.
+        tx (RingBuffer): The ring this side writes to.
+        rx (RingBuffer): The ring this side reads from.
+    """
+    def __init__(self, sock, tx, rx):
+        self.sock = sock
+        self.tx = tx
+        self.rx = rx
+        self.send_lock = threading.Lock()
+        self.closed = False
+        self.pending = b""
+        self.pending_offset = 0
+        # A receiving and a sending thread may both be asleep. One of them reads the doorbell
+        # and wakes the other, as a byte does not say which of them it was meant for.
+        self.doorbell = threading.Condition()
+        self.listening = False
+        self.peer_gone = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def _ring_doorbell(self, ring, waiting_offset):
+        _fence()
+        if ring.load(waiting_offset):
+            ring.store(waiting_offset, 0)
+            try:
+                self.sock.send(b"\x01")
+            except OSError:
+                pass
+
+    def _wait_doorbell(self, ring, waiting_offset, ready):
+        """
+        Sleep until `ready()` is true, flagging in the ring that this side is asleep
+        so the peer rings the doorbell once it has moved the ring along.
+
+        Parameters:
+        ring (RingBuffer): The ring holding the flag.
+        waiting_offset (int): READER_WAITING_OFFSET or WRITER_WAITING_OFFSET.
+        ready (callable): Whether this side can carry on.
+
+        Returns:
+        bool: False if the peer has gone away, or the connection was closed.
+        """
+        with self.doorbell:
+            while True:
+                # Flag, then look again, so a move that raced with the flag is not missed
+                ring.store(waiting_offset, 1)
+                _fence()
+                if ready():
+                    break
+                if self.peer_gone:
+                    ring.store(waiting_offset, 0)
+                    return False
+                if self.listening:
+                    self.doorbell.wait()
+                    continue
+                self.listening = True
+                self.doorbell.release()
+                try:
+                    rung = bool(self.sock.recv(4096))
+                except OSError:
+                    rung = False
+                finally:
+                    self.doorbell.acquire()
+                    self.listening = False
+                    self.doorbell.notify_all()
+                if not rung:
+                    self.peer_gone = True
+        ring.store(waiting_offset, 0)
+        return True
+
+    def recv(self, length, flags=0):
+        """
+        Receive up to `length` bytes, blocking until at least one is available.
+
+        Parameters:
+        length (int): Maximum number of bytes to return.
+        flags (int, optional): Only socket.MSG_DONTWAIT is honoured.
+
+        Returns:
+        bytes: The received bytes, or b"" once the peer has closed the connection.
+        """
+        # Most calls, e.g. for a frame's body after its header, are served from what was
+        # drained last time, so that path is kept to a few operations
+        if self.pending_offset < len(self.pending):
+            return self._take_pending(length)
+        try:
+            return self._recv(length, flags)
+        except (TypeError, ValueError):
+            # The rings were released by close() on another thread.
+            if self.closed:
+                raise OSError("Shared memory connection is closed")
+            raise
+
+    def _recv(self, length, flags):
+        peer_alive = True
+        yielded = False
+        while not self.closed:
+            data = self.rx.read(READ_CHUNK)
+            if data:
+                self._ring_doorbell(self.rx, WRITER_WAITING_OFFSET)
+                self.pending, self.pending_offset = data, 0
+                return self._take_pending(length)
+            if not peer_alive or self.rx.load(CLOSED_OFFSET):
+                return b""
+            if flags & socket.MSG_DONTWAIT:
+                raise BlockingIOError("No data available")
+            if not yielded:
+                # Let the peer, e.g. on the same CPU, write more before paying for a doorbell
+                yielded = True
+                os.sched_yield()
+                continue
+            peer_alive = self._wait_doorbell(self.rx, READER_WAITING_OFFSET, self._readable)
+        return b""
+
+    def _readable(self):
+        return self.closed or self.rx.load(HEAD_OFFSET) != self.rx.tail or self.rx.load(CLOSED_OFFSET)
+
+    def _writable(self):
+        return self.closed or self.tx.writable() > 0 or self.rx.load(CLOSED_OFFSET)
+
+    def _take_pending(self, length):
+        start = self.pending_offset
+        end = min(start + length, len(self.pending))
+        self.pending_offset = end
+        if start == 0 and end == len(self.pending):
+            return self.pending
+        return self.pending[start:end]
+
+    def sendall(self, data):
+        """
+        Write all of `data`, blocking while the ring is full.
+
+        Parameters:
+        data (bytes): The bytes to send.
+        """
+        with self.send_lock:
+            try:
+                self._send(memoryview(data))
+            except (TypeError, ValueError):
+                if self.closed:
+                    raise BrokenPipeError("Shared memory connection is closed")
+                raise
+
+    def _send(self, view):
+        while view:
+            if self.closed or self.rx.load(CLOSED_OFFSET):
+                raise BrokenPipeError("Shared memory connection is closed")
+            written = self.tx.write(view)
+            if written:
+                view = view[written:]
+                self._ring_doorbell(self.tx, READER_WAITING_OFFSET)
+                continue
+            if not self._wait_doorbell(self.tx, WRITER_WAITING_OFFSET, self._writable):
+                raise BrokenPipeError("Shared memory peer went away")
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Mark our outgoing ring closed so the peer reads EOF once it is drained.
+        if self.tx.buf is not None:
+            self.tx.store(CLOSED_OFFSET, 1)
+            self._ring_doorbell(self.tx, READER_WAITING_OFFSET)
+        try:
+            # Wakes a thread of ours asleep on the doorbell, which close() alone would not
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        finally:
+            self.tx.close()
+            self.rx.close()
+
+
+class ShmListener(Listener):
+    """
+    Accepts same-host clients on a Unix socket and moves them onto shared memory rings.
+
+    The handshake is a single JSON line from the server naming the two rings,
+    answered by one byte from the client once it has attached to them.
+
+    Parameters:
+        path (str): Filesystem path of the handshake socket.
+        capacity (int, optional): Size of each ring in bytes, a power of two. Defaults to 1 MiB.
+        handshake_timeout (float, optional): Seconds to wait for a client to attach. Defaults to 1.0.
+        backlog: See Listener.
+    """
+    handshake = True
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, handshake_timeout=1.0, backlog=None):
+        super().__init__(backlog)
+        self.path = path
+        self.capacity = capacity
+        self.handshake_timeout = handshake_timeout
+
+    def create_socket(self):
+        remove_stale_socket(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        return sock
+
+    def accept(self):
+        """
+        Accept a client on the handshake socket. The rings are set up by establish().
+
+        Returns:
+        tuple: The handshake socket and its path.
+        """
+        sock, _ = self.sock.accept()
+        return sock, self.path
+
+    def establish(self, sock):
+        """
+        Set up a client's rings and move it onto them.
+
+        Returns:
+        ShmConnection: The connection to the client.
+
+        Raises:
+        OSError: If the client does not attach within handshake_timeout, or goes away. The socket is closed.
+        """
+        to_client = RingBuffer.create(self.capacity)
+        to_server = RingBuffer.create(self.capacity)
+        try:
+            sock.settimeout(self.handshake_timeout)
+            handshake = {"rx": to_client.name, "tx": to_server.name, "capacity": self.capacity}
+            sock.sendall(json.dumps(handshake).encode() + b"\n")
+            if recv_exact(sock, 1) != b"\x01":
+                raise ConnectionError("Shared memory handshake failed")
+            sock.settimeout(None)
+        except OSError:
+            sock.close()
+            to_client.close()
+            to_server.close()
+            raise
+        return ShmConnection(sock, tx=to_client, rx=to_server)
+
+    def close(self):
+        super().close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def describe(self):
+        return f"shm://{self.path}"
+
+
+def shm_connect(path, timeout=None):
+    """
+    Connect to a ShmListener.
+
+    Parameters:
+    path (str): Filesystem path of the server's handshake socket.
+    timeout (float, optional): Handshake timeout in seconds. Defaults to blocking.
+
+    Returns:
+    ShmConnection: The connection to the server.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(path)
+    line = b""
+    while not line.endswith(b"\n"):
+        chunk = sock.recv(256)
+        if not chunk:
+            sock.close()
+            raise ConnectionError("Server closed the connection during the handshake")
+        line += chunk
+    handshake = json.loads(line)
+    rx = RingBuffer.attach(handshake["rx"], handshake["capacity"])
+    tx = RingBuffer.attach(handshake["tx"], handshake["capacity"])
+    sock.sendall(b"\x01")
+    sock.settimeout(None)
+    return ShmConnection(sock, tx=tx, rx=rx)
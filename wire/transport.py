@@ -0,0 +1,336 @@
+import functools
+import os
+import socket
+import stat
+import urllib.parse
+
+
+@functools.lru_cache(maxsize=None)
+def local_address():
+    """
+    Look up this machine's IP address, the default for servers to listen on and clients to connect to.
+    The lookup can wait on DNS, so it is done on first use and only once.
+
+    Returns:
+    str: The address.
+    """
+    return socket.gethostbyname(socket.gethostname())
+
+
+def recv_exact(conn, length):
+    """
+    Receive exactly `length` bytes from a connection.
+
+    Parameters:
+    conn (socket.socket): The socket (or socket-like connection) to read from.
+    length (int): The number of bytes to read.
+
+    Returns:
+    bytes: The received bytes. Shorter than `length` only if the peer closed the connection.
+    """
+    if length == 0:
+        return b""
+    chunk = conn.recv(length)
+    if len(chunk) == length or not chunk:
+        return chunk
+    chunks = [chunk]
+    remaining = length - len(chunk)
+    while remaining:
+        chunk = conn.recv(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def remove_stale_socket(path):
+    """
+    Remove a socket file left behind at `path`, so a listener can bind there. Anything else at
+    the path, e.g. a regular file given by mistake, is left alone and the bind fails.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def peer_address(conn):
+    """
+    Returns:
+    The address of a connection's client, or the socket path for a Unix socket, whose clients have none.
+    None if the connection is already closed.
+    """
+    try:
+        if conn.family == socket.AF_UNIX:
+            return conn.getsockname()
+        return conn.getpeername()
+    except OSError:
+        return None
+
+
+def apply_socket_options(sock, nodelay=False, rcvbuf=None, sndbuf=None):
+    """
+    Apply per-listener options to a socket.
+
+    Parameters:
+    sock (socket.socket): The socket to configure.
+    nodelay (bool, optional): Disable Nagle's algorithm on TCP sockets. Defaults to False.
+    rcvbuf (int, optional): SO_RCVBUF size in bytes. Defaults to the kernel default.
+    sndbuf (int, optional): SO_SNDBUF size in bytes. Defaults to the kernel default.
+    """
+    if nodelay and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+
+
+class Listener:
+    """
+    Base class for a listening endpoint the server accepts connections on.
+
+    Subclasses implement `create_socket` and `describe`. A listener is bound
+    only when `open` is called, so constructing a server never touches the network.
+
+    Parameters:
+        backlog (int, optional): The listen() backlog. Defaults to the server's admission backlog.
+        rcvbuf (int, optional): SO_RCVBUF size for accepted connections.
+        sndbuf (int, optional): SO_SNDBUF size for accepted connections.
+    """
+    # Whether establish() does a handshake, which the client expects before any frame
+    handshake = False
+
+    def __init__(self, backlog=None, rcvbuf=None, sndbuf=None):
+        self.backlog = backlog
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.sock = None
+
+    def create_socket(self):
+        raise NotImplementedError
+
+    def describe(self):
+        raise NotImplementedError
+
+    def configure(self, conn):
+        """
+        Apply this listener's options to an accepted connection.
+        """
+        apply_socket_options(conn, rcvbuf=self.rcvbuf, sndbuf=self.sndbuf)
+
+    def open(self, default_backlog=128):
+        """
+        Create, bind and start listening on the socket. Does nothing if it is already open.
+
+        Parameters:
+        default_backlog (int, optional): Backlog to use if the listener has none configured. Defaults to 128.
+        """
+        if self.sock:
+            return
+        self.sock = self.create_socket()
+        self.sock.listen(self.backlog or default_backlog)
+
+    def adopt(self, sock):
+        """
+        Listen on a socket another process opened, e.g. one handed over by the server this one
+        replaces, instead of binding a new one. Connections waiting in its backlog are kept.
+
+        Parameters:
+        sock (socket.socket): The listening socket.
+        """
+        self.sock = sock
+
+    def release(self):
+        """
+        Close this process's copy of the socket, leaving the endpoint to a process it was handed to.
+        """
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def accept(self):
+        """
+        Accept a connection and apply the listener's socket options to it.
+
+        Returns:
+        tuple: The connection and the address of the client.
+        """
+        conn, addr = self.sock.accept()
+        self.configure(conn)
+        return conn, addr
+
+    def establish(self, conn):
+        """
+        Finish setting up an accepted connection, e.g. with a handshake. Runs on the thread that
+        serves the connection, so a slow client does not hold up accepting others.
+
+        Parameters:
+        conn (socket.socket): The connection returned by accept().
+
+        Returns:
+        The connection to serve. Plain sockets are served as they are.
+        """
+        return conn
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+class TCPListener(Listener):
+    """
+    A TCP listener.
+
+    Parameters:
+        host (str): The IP address to bind to. None for local_address(), looked up when the listener opens.
+        port (int): The port to bind to.
+        nodelay (bool, optional): Set TCP_NODELAY on accepted connections. Defaults to True.
+        backlog, rcvbuf, sndbuf: See Listener.
+    """
+    def __init__(self, host, port, nodelay=True, backlog=None, rcvbuf=None, sndbuf=None):
+        super().__init__(backlog, rcvbuf, sndbuf)
+        self.host = host
+        self.port = port
+        self.nodelay = nodelay
+
+    def create_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Buffer sizes set on the listening socket are inherited by accepted ones.
+        apply_socket_options(sock, rcvbuf=self.rcvbuf, sndbuf=self.sndbuf)
+        if self.host is None:
+            self.host = local_address()
+        sock.bind((self.host, self.port))
+        return sock
+
+    def configure(self, conn):
+        apply_socket_options(conn, nodelay=self.nodelay, rcvbuf=self.rcvbuf, sndbuf=self.sndbuf)
+
+    def describe(self):
+        return f"tcp://{self.host or local_address()}:{self.port}"
+
+
+class UnixListener(Listener):
+    """
+    A Unix domain socket listener for clients on the same host.
+
+    Parameters:
+        path (str): Filesystem path of the socket. A stale socket file at this path is replaced.
+        mode (int, optional): Permissions applied to the socket file. Defaults to 0o660.
+        backlog, rcvbuf, sndbuf: See Listener.
+    """
+    def __init__(self, path, mode=0o660, backlog=None, rcvbuf=None, sndbuf=None):
+        super().__init__(backlog, rcvbuf, sndbuf)
+        self.path = path
+        self.mode = mode
+
+    def create_socket(self):
+        remove_stale_socket(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        apply_socket_options(sock, rcvbuf=self.rcvbuf, sndbuf=self.sndbuf)
+        sock.bind(self.path)
+        os.chmod(self.path, self.mode)
+        return sock
+
+    def accept(self):
+        conn, _ = self.sock.accept()
+        self.configure(conn)
+        # Unix sockets have no peer address, report the socket path instead.
+        return conn, self.path
+
+    def close(self):
+        super().close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def describe(self):
+        return f"unix://{self.path}"
+
+
+# The type of each per-listener option given in a listener address
+LISTENER_OPTIONS = {
+    "backlog": int,
+    "rcvbuf": int,
+    "sndbuf": int,
+    "nodelay": lambda text: text.lower() in ("1", "true", "yes", "on"),
+    "mode": lambda text: int(text, 8),
+    "capacity": int,
+    "handshake_timeout": float,
+}
+
+
+def parse_listener(spec, **options):
+    """
+    Build a listener from an address string.
+
+    Parameters:
+    spec (str): "tcp://host:port" or "host:port", "unix:///path/to/socket" or "unix:/path", or
+        "shm:///path/to/socket" for a ShmListener. Listener options may follow as a query string,
+        e.g. "tcp://0.0.0.0:5050?nodelay=0&rcvbuf=262144" or "unix:///run/chat.sock?mode=660".
+    options: Extra keyword arguments passed to the listener constructor.
+
+    Returns:
+    Listener: The listener described by `spec`.
+
+    Raises:
+    ValueError: If the address or an option is not understood.
+    """
+    spec, _, query = spec.partition("?")
+    for name, value in urllib.parse.parse_qsl(query, strict_parsing=bool(query)):
+        if name not in LISTENER_OPTIONS:
+            raise ValueError(f"Unknown listener option {name!r}")
+        options[name] = LISTENER_OPTIONS[name](value)
+    scheme, _, path = spec.partition(":")
+    if scheme in ("unix", "shm"):
+        if path.startswith("//"):
+            path = path[2:]
+        options.pop("nodelay", None)
+        if scheme == "unix":
+            listener, args = UnixListener, (path,)
+        else:
+            # Imported here, as the shared memory transport builds on this module
+            from shm_transport import ShmListener
+            listener, args = ShmListener, (path,)
+    else:
+        if spec.startswith("tcp://"):
+            spec = spec[len("tcp://"):]
+        host, _, port = spec.rpartition(":")
+        listener, args = TCPListener, (host or None, int(port))
+    try:
+        return listener(*args, **options)
+    except TypeError:
+        raise ValueError(f"{listener.__name__} does not take the options {', '.join(sorted(options))}") from None
+
+
+def connect(host=None, port=None, path=None, nodelay=True, timeout=None):
+    """
+    Open a client connection over TCP or a Unix domain socket.
+
+    Parameters:
+    host (str, optional): The server host, for TCP connections. Defaults to local_address().
+    port (int, optional): The server port, for TCP connections.
+    path (str, optional): The server socket path. Takes precedence over host and port.
+    nodelay (bool, optional): Set TCP_NODELAY on TCP connections. Defaults to True.
+    timeout (float, optional): Connect timeout in seconds. Defaults to blocking.
+
+    Returns:
+    socket.socket: The connected socket, in blocking mode.
+    """
+    if path:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(path)
+    else:
+        sock = socket.create_connection((host or local_address(), port), timeout=timeout)
+        apply_socket_options(sock, nodelay=nodelay)
+    sock.settimeout(None)
+    return sock